@@ -52,6 +52,10 @@ ARP_TYPE = 0x806
 # updating in both places eventually.
 CUSTOM_NEXT_TABLE_PORT = 0xfff4
 
+# Flow stats requests whose reply has not come within this many seconds are
+# forgotten.
+STATS_SCOPE_TIMEOUT_SEC = 30
+
 def inport_value_hack(outport):
     if outport > 1:
         return 1
@@ -151,7 +155,12 @@ class BackendChannel(asynchat.async_chat):
             self.of_client.barrier(switch)
         elif msg[0] == 'flow_stats_request':
             switch = msg[1]
-            self.of_client.flow_stats_request(switch)
+            table_id = int(msg[2])
+            cookie = int(msg[3])
+            cookie_mask = int(msg[4])
+            pred = self.dict2OF(msg[5]) if msg[5] else None
+            self.of_client.flow_stats_request(switch,table_id,cookie,
+                                              cookie_mask,pred,msg[5])
         else:
             print "ERROR: Unknown msg from frontend %s" % msg
 
@@ -803,14 +812,35 @@ class POXClient(revent.EventMixin):
             print "WARNING: couldn't send barrier to switch %s (%s)" % (
                 str(switch), e)
 
-    def flow_stats_request(self,switch):
+    def flow_stats_request(self,switch,table_id=0xff,cookie=0,cookie_mask=0,
+                           pred=None,pyretic_pred=None):
+        """ Request the stats of flows in table `table_id` (0xff for all
+        tables) whose cookies agree with `cookie` on the bits set in
+        `cookie_mask`, and which are at least as specific as `pred`. The reply
+        carries the scope of the request back to pyretic, along with
+        `pyretic_pred`, the predicate as pyretic sent it.
+
+        OpenFlow 1.0 flow stats requests carry no cookie, so the cookie scope
+        is applied to the reply (see _handle_FlowStatsReceived), before it is
+        converted and sent to pyretic. With nicira extensions, `pred` is not
+        used: the request only takes an OpenFlow 1.0 match. """
         sr = of.ofp_stats_request()
         sr.body = of.ofp_flow_stats_request()
-        match = of.ofp_match()
+        if pred and not self.use_nx:
+            match = self.build_of_match(switch,pred.get('port'),pred)
+        else:
+            match = of.ofp_match()
         sr.body.match = match
-        sr.body.table_id = 0xff
+        sr.body.table_id = table_id
         sr.body.out_port = of.OFPP_NONE
         try:
+            scopes = self.switches[switch]['stats_scopes']
+            now = time.time()
+            for (xid, (sent, _)) in scopes.items():
+                if now - sent > STATS_SCOPE_TIMEOUT_SEC:
+                    del scopes[xid]
+            scopes[sr.xid] = (now, (table_id, cookie, cookie_mask,
+                                    pyretic_pred))
             self.switches[switch]['connection'].send(sr)
         except KeyError, e:
             print ( ("ERROR:flow_stats_request: No connection to switch %d" +
@@ -854,6 +884,7 @@ class POXClient(revent.EventMixin):
         self.switches[event.dpid] = {}
         self.switches[event.dpid]['connection'] = event.connection
         self.switches[event.dpid]['ports'] = {}
+        self.switches[event.dpid]['stats_scopes'] = {}
 
         if self.use_nx:
             """ Enable nicira packet-ins (e.g., to get rule cookies) """
@@ -967,8 +998,16 @@ class POXClient(revent.EventMixin):
             actions = self.of_actions_to_dicts(flow_stat.actions)
             flow_stat_dict['actions'] = actions
             return flow_stat_dict
-        flow_stats = [handle_ofp_flow_stat(s) for s in event.stats]
-        self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats])
+        """ Drop the flows outside the cookie scope of the request. """
+        try:
+            (_, scope) = self.switches[dpid]['stats_scopes'].pop(
+                event.ofp[0].xid)
+        except (KeyError, IndexError):
+            scope = (0xff, 0, 0, None)
+        (table_id, cookie, cookie_mask, _) = scope
+        flow_stats = [handle_ofp_flow_stat(s) for s in event.stats
+                      if (s.cookie & cookie_mask) == (cookie & cookie_mask)]
+        self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats,list(scope)])
 
     def _handle_PortStatus(self, event):
         port = event.ofp.desc
@@ -148,12 +148,32 @@ def parseArgs():
     op.add_option('--use_pyretic', action="store_true",
                   dest = 'use_pyretic',
                   help = "Use the pyretic compiler (uses netkat by default)")
+    op.add_option('--use_fdd_compiler', action="store_true",
+                  dest = 'use_fdd_compiler',
+                  help = ("Use the in-process FDD compiler (uses netkat by "
+                          "default)"))
     op.add_option('--write_log', dest="write_log",
                   help = ("Location of the runtime's write log for post-run"
                           "debugging"))
     op.add_option('--use_fdd', action="store_true",
                   dest = 'use_fdd',
                   help = "Use FDD for predicate decomposition")
+    op.add_option('--stage_workers', type = int,
+                  dest = 'stage_workers',
+                  help = ("Number of processes compiling path query stages "
+                          "concurrently (1 compiles them serially)"))
+    op.add_option('--enable_cost_pack', action="store_true",
+                  dest = 'cost_pack_enabled',
+                  help = ("pack path queries into stages by their estimated "
+                          "rule cost (with --enable_preddecomp)"))
+    op.add_option('--stage_rule_limit', type = int,
+                  dest = 'stage_rule_limit',
+                  help = ("Per-switch rule budget of each path query stage, "
+                          "with --enable_cost_pack"))
+    op.add_option('--max_queries', type = int,
+                  dest = 'max_queries',
+                  help = ("Maximum number of queries that groupby path "
+                          "queries may expand into"))
     op.set_defaults(frontend_only=False, mode='proactive0', enable_profile=False,
                     disjoint_enabled=False, default_enabled=False,
                     integrate_enabled=False, multitable_enabled=False,
@@ -162,7 +182,9 @@ def parseArgs():
                     edge_contraction_enabled=False,
                     preddecomp_enabled=False,
                     nx=False, use_pyretic=False, use_fdd=False,
-                    write_log="rt_log.txt")
+                    use_fdd_compiler=False, stage_workers=1,
+                    max_queries=None, cost_pack_enabled=False,
+                    stage_rule_limit=None, write_log="rt_log.txt")
 
     options, args = op.parse_args()
 
@@ -249,7 +271,8 @@ def main():
         Stat.start(options.eval_result_path)
 
     """ Start the frenetic compiler-server """
-    if not options.use_pyretic and options.mode == 'proactive0':
+    if (not (options.use_pyretic or options.use_fdd_compiler) and
+        options.mode == 'proactive0'):
         netkat_cmd = "bash start-frenetic.sh"
         try:
             output = subprocess.Popen(netkat_cmd, shell=True,
@@ -272,6 +295,11 @@ def main():
                       pipeline=options.pipeline,
                       use_pyretic=options.use_pyretic,
                       use_fdd=options.use_fdd,
+                      use_fdd_compiler=options.use_fdd_compiler,
+                      stage_workers=options.stage_workers,
+                      max_queries=options.max_queries,
+                      cost_pack_enabled=options.cost_pack_enabled,
+                      stage_rule_limit=options.stage_rule_limit,
                       write_log=options.write_log)
 
     """ Start pox backend. """
@@ -110,7 +110,7 @@ class BackendChannel(asynchat.async_chat):
             cookie = msg[2]
             self.backend.runtime.handle_packet_in(packet, cookie)
         elif msg[0] == 'flow_stats_reply':
-            self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2])
+            self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2],msg[3])
         elif msg[0] == 'flow_removed':
             self.backend.runtime.handle_flow_removed(msg[1], msg[2])
         else:
@@ -154,8 +154,10 @@ class Backend(object):
     def send_clear(self,switch,table_id):
         self.send_to_OF_client(['clear',switch,table_id])
 
-    def send_flow_stats_request(self,switch):
-        self.send_to_OF_client(['flow_stats_request',switch])
+    def send_flow_stats_request(self,switch,table_id=0xff,cookie=0,
+                                cookie_mask=0,pred=None):
+        self.send_to_OF_client(['flow_stats_request',switch,table_id,cookie,
+                                cookie_mask,pred])
 
     def send_barrier(self,switch):
         self.send_to_OF_client(['barrier',switch])
@@ -27,6 +27,8 @@ class Rule(object):
         - "empty_parallel", when two classifiers which are added results in a
         drop classifier because of zero intersection.
         - "policy" (this is a leaf rule directly generated from a policy)
+        - "netkat" or "fdd", for rules generated by the NetKAT or FDD
+        compilers, which keep no parents
         """
         self.op = op
 
@@ -66,7 +68,7 @@ def get_rule_derivation_tree(r, pre_spaces='', only_leaves=False):
     assert isinstance(r, Rule)
     op = r.op
     assert op in ["policy", "parallel", "empty_parallel",
-                  "sequential", "negate", "netkat"]
+                  "sequential", "negate", "netkat", "fdd"]
     extra_ind = '    '
     output = ''
     if op == "parallel" or op == "negate" or op == "sequential":
@@ -88,7 +90,7 @@ def get_rule_derivation_tree(r, pre_spaces='', only_leaves=False):
             sys.exit(0)
     elif op == "empty_parallel":
         output = pre_spaces + "empty classifier\n"
-    elif op == "netkat":
+    elif op == "netkat" or op == "fdd":
         output = pre_spaces + str(r) + '\n'
     else:
         raise TypeError
@@ -100,7 +102,7 @@ def get_rule_derivation_leaves(r):
     assert isinstance(r, Rule)
     op = r.op
     assert op in ["policy", "parallel", "empty_parallel",
-                  "sequential", "negate", "netkat"]
+                  "sequential", "negate", "netkat", "fdd"]
     leaf_list = []
     if op == "parallel" or op == "negate" or op == "sequential":
         for rp in r.parents:
@@ -110,7 +112,7 @@ def get_rule_derivation_leaves(r):
             leaf_list += [r.parents[0]]
     elif op == "empty_parallel":
         pass
-    elif op == "netkat":
+    elif op == "netkat" or op == "fdd":
         leaf_list += [r]
     else:
         raise TypeError
@@ -46,10 +46,13 @@ from pyretic.core.netkat import netkat_backend, NETKAT_PORT
 from pyretic.evaluations import stat
 
 from multiprocessing import Lock, Condition
+from array import array
 import copy
 
 NO_CACHE=False
 NETKAT_CLASSIFIER_CACHE=True
+COUNTER_SERIES_SIZE=64
+COUNTER_EWMA_ALPHA=0.25
 
 basic_headers = ["srcmac", "dstmac", "srcip", "dstip", "tos", "srcport", "dstport",
                  "ethtype", "protocol"]
@@ -383,6 +386,7 @@ class match(Filter):
             return map_dict
 
         self.map = util.frozendict(_get_processed_map(*args, **kwargs))
+        self._translated = None
         self._classifier = self.generate_classifier()
         super(match,self).__init__()
 
@@ -394,7 +398,12 @@ class match(Filter):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _match(**self.map).eval(pkt)
+        from pyretic.core.runtime import abstract_virtual_field as avf
+        # Translate virtual fields again only when their declarations change.
+        gen = avf.get_generations()
+        if self._translated is None or self._translated[0] != gen:
+            self._translated = (gen, _match(**self.map))
+        return self._translated[1].eval(pkt)
 
     def generate_classifier(self):
         c = _match(**self.map).generate_classifier()
@@ -521,8 +530,12 @@ class _match(match):
             try:
                 v = pkt[field]
                 if field in ['srcip', 'dstip']:
-                    v = util.string_to_IP(v)
-                    if pattern is None or not v in pattern:
+                    if pattern is None:
+                        return set()
+                    if isinstance(v, IPAddr):
+                        if not v.in_network(pattern):
+                            return set()
+                    elif not util.string_to_IP(v) in pattern:
                         return set()
                 elif field == 'vlan_id':
                     assert 'vlan_pcp' in self.map, "Incorrect VLAN setting."
@@ -591,6 +604,7 @@ class modify(Policy):
                        acc and (f in compilable_headers),
                    self.map.keys(),
                    True)
+        self._translated = None
         self._classifier = self.generate_classifier()
         super(modify,self).__init__()
 
@@ -602,7 +616,12 @@ class modify(Policy):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _modify(**self.map).eval(pkt)
+        from pyretic.core.runtime import abstract_virtual_field as avf
+        # Translate virtual fields again only when their declarations change.
+        gen = avf.get_generations()
+        if self._translated is None or self._translated[0] != gen:
+            self._translated = (gen, _modify(**self.map))
+        return self._translated[1].eval(pkt)
 
     def generate_classifier(self):
         c = _modify(**self.map).generate_classifier()
@@ -907,6 +926,7 @@ class MatchingAggregateBucket(Query):
     class match_entry(object):
         def __init__(self,match,priority,version):
             self.match = util.frozendict(match)
+            self.rule_match = self.match
             self.priority = priority
             self.version = version
 
@@ -927,6 +947,8 @@ class MatchingAggregateBucket(Query):
                     ',version=' + repr(self.version) + ')')
 
     class rule_entry(match_entry):
+        """ A match entry identified by the switch, priority and version of
+        its rule; the full match of the rule is kept in `rule_match`. """
         def __init__(self, match, priority, version):
             super(MatchingAggregateBucket.rule_entry, self).__init__(
                 match, priority, version)
@@ -975,10 +997,206 @@ class MatchingAggregateBucket(Query):
         raise NotImplementedError
 
 
+class CounterSeries(object):
+    """
+    Time series of a cumulative (packets, bytes) counter, as a ring buffer of
+    its last `size` samples. Samples are kept in preallocated arrays, so the
+    memory of a series is fixed. Rates are in units per second, and are
+    clamped at zero if the counter goes down.
+
+    :param size: number of samples kept
+    :type size: int
+    :param alpha: weight of the latest rate in the moving average rate
+    :type alpha: float
+    """
+    PACKETS = 0
+    BYTES = 1
+
+    def __init__(self, size=COUNTER_SERIES_SIZE, alpha=COUNTER_EWMA_ALPHA):
+        self.size = size
+        self.alpha = alpha
+        self.times = array('d', [0.0]) * size
+        self.packets = array('d', [0.0]) * size
+        self.bytes = array('d', [0.0]) * size
+        self.next = 0 # index of the next sample in the arrays
+        self.num_samples = 0
+        self.ewma_rates = None
+        self.subscriptions = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __repr__(self):
+        return "CounterSeries %s" % repr(self.samples())
+
+    def sample(self, i):
+        """ The i'th newest sample, as (timestamp, packets, bytes). """
+        j = (self.next - 1 - i) % self.size
+        return (self.times[j], self.packets[j], self.bytes[j])
+
+    def samples(self):
+        """ All samples, oldest first. """
+        with self.lock:
+            return [self.sample(i)
+                    for i in reversed(range(self.num_samples))]
+
+    def append(self, timestamp, packets, bytes):
+        """ Record the counter values at `timestamp`. A sample no newer than
+        the latest one replaces it. """
+        with self.lock:
+            if self.num_samples and timestamp <= self.sample(0)[0]:
+                self.next = (self.next - 1) % self.size
+                self.num_samples -= 1
+            elif self.num_samples:
+                rates = self.delta(self.sample(0),
+                                   (timestamp, packets, bytes), True)
+                if self.ewma_rates is None:
+                    self.ewma_rates = rates
+                else:
+                    self.ewma_rates = tuple(
+                        self.alpha * r + (1 - self.alpha) * e
+                        for (r, e) in zip(rates, self.ewma_rates))
+            self.times[self.next] = timestamp
+            self.packets[self.next] = packets
+            self.bytes[self.next] = bytes
+            self.next = (self.next + 1) % self.size
+            self.num_samples = min(self.num_samples + 1, self.size)
+        self.notify_subscribers()
+
+    def delta(self, old, new, per_sec):
+        """ Increase of the counters between samples `old` and `new`, or its
+        rate if `per_sec`. """
+        (packets, bytes) = (max(0.0, new[1] - old[1]),
+                            max(0.0, new[2] - old[2]))
+        if not per_sec:
+            return (packets, bytes)
+        dt = new[0] - old[0]
+        if dt <= 0:
+            return (0.0, 0.0)
+        return (packets / dt, bytes / dt)
+
+    def span(self, window):
+        """ The newest sample, and the newest sample at least `window` seconds
+        older than it (or the oldest sample). With no window, the sample before
+        the newest one. """
+        newest = self.sample(0)
+        if window is None:
+            return (newest, self.sample(1))
+        for i in range(1, self.num_samples):
+            older = self.sample(i)
+            if older[0] <= newest[0] - window:
+                break
+        return (newest, older)
+
+    def rate(self, window=None):
+        """ Average (packets, bytes) per second over the last `window`
+        seconds, or between the last two samples. """
+        with self.lock:
+            if self.num_samples < 2:
+                return (0.0, 0.0)
+            (new, old) = self.span(window)
+            return self.delta(old, new, True)
+
+    def window_sum(self, window):
+        """ Increase of (packets, bytes) over the last `window` seconds. """
+        with self.lock:
+            if self.num_samples < 2:
+                return (0.0, 0.0)
+            (new, old) = self.span(window)
+            return self.delta(old, new, False)
+
+    def recent_rates(self, n):
+        """ The (packets, bytes) rates between the last n+1 samples, newest
+        first. """
+        with self.lock:
+            return [self.delta(self.sample(i + 1), self.sample(i), True)
+                    for i in range(min(n, self.num_samples - 1))]
+
+    def ewma(self):
+        """ Exponentially weighted moving average of the (packets, bytes)
+        rates between successive samples. """
+        with self.lock:
+            return self.ewma_rates or (0.0, 0.0)
+
+    def subscribe(self, threshold, callback, field=PACKETS, window=None):
+        """ Call `callback(rate, above)` whenever the rate of `field`
+        (CounterSeries.PACKETS or CounterSeries.BYTES) over `window` seconds
+        (see `rate`) crosses `threshold`, where `above` tells whether it went
+        above the threshold. Returns a subscription for `unsubscribe`. """
+        sub = [threshold, callback, field, window, False]
+        with self.lock:
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+
+    def notify_subscribers(self):
+        with self.lock:
+            subs = list(self.subscriptions)
+        for sub in subs:
+            (threshold, callback, field, window, was_above) = sub
+            r = self.rate(window)[field]
+            above = r > threshold
+            if above != was_above:
+                sub[4] = above
+                callback(r, above)
+
+
+class AdaptivePollInterval(object):
+    """
+    Interval between pulls of the stats of a counting bucket, adapted to the
+    CounterSeries of its counts. The interval is divided by `backoff` (down to
+    `min_interval`) when the packet rate changed by more than a fraction
+    `change` between the last two samples, or is within a fraction `margin`
+    of the threshold of a rate subscription. It is multiplied by `backoff`
+    (up to `max_interval`) while no packets are counted.
+
+    :param interval: initial interval, in seconds
+    :type interval: float
+    """
+    def __init__(self, interval, min_interval=None, max_interval=None,
+                 backoff=2.0, change=0.25, margin=0.2):
+        self.interval = interval
+        self.min_interval = min_interval or interval / 4.0
+        self.max_interval = max_interval or interval * 8.0
+        self.backoff = backoff
+        self.change = change
+        self.margin = margin
+
+    def near_threshold(self, series):
+        with series.lock:
+            subs = list(series.subscriptions)
+        for (threshold, _, field, window, _) in subs:
+            r = series.rate(window)[field]
+            if abs(r - threshold) <= self.margin * threshold:
+                return True
+        return False
+
+    def next(self, series):
+        """ The interval until the next pull, given the counts so far. """
+        rates = [r[CounterSeries.PACKETS] for r in series.recent_rates(2)]
+        if not rates:
+            return self.interval
+        changing = (len(rates) == 2 and
+                    abs(rates[0] - rates[1]) > self.change * max(rates[1], 1.0))
+        if changing or self.near_threshold(series):
+            self.interval = max(self.min_interval,
+                                self.interval / self.backoff)
+        elif rates[0] == 0:
+            self.interval = min(self.max_interval,
+                                self.interval * self.backoff)
+        return self.interval
+
+
 class CountBucket(MatchingAggregateBucket):
     """
     Class for registering callbacks on counts of packets sent to
-    the controller.
+    the controller. The counts returned to callbacks are also recorded in a
+    CounterSeries (`series`), whose rates can be queried or subscribed to.
     """
     def __init__(self, bname=None):
         self.bname = str(bname) if bname else str(id(self))
@@ -998,6 +1216,9 @@ class CountBucket(MatchingAggregateBucket):
         self.byte_count_persistent_removed = 0
         self.byte_count_persistent_existing = 0
         self.new_bucket = True
+        self.rule_index = {} # (switch, priority, cookie) -> rule_entry
+        self.pending_replies = [] # (switch, flow stats) at hand when pulled
+        self.series = CounterSeries()
         self.max_num_callbacks = 0
         self.max_num_callbacks_lock = Lock()
         self._classifier = self.generate_classifier()
@@ -1110,6 +1331,7 @@ class CountBucket(MatchingAggregateBucket):
                 # if we get a "flow removed" message before we got
                 # the first ever stats reply from an existing rule.
                 del self.matches[k]
+                self.rule_index.pop(self.rule_key(k), None)
 
     def add_pull_stats(self, fun):
         """
@@ -1139,19 +1361,43 @@ class CountBucket(MatchingAggregateBucket):
                 queries_issued = pull_function() # return value denotes whether
                                                  # we expect a stats_reply in
                                                  # future
+            pending = self.pending_replies
+            self.pending_replies = []
+        # Replies already at hand are handled once the bucket is released, as
+        # they may call back into user code.
+        for (switch, flow_stats) in pending:
+            self.handle_flow_stats_reply(switch, flow_stats)
         return queries_issued
 
+    def add_pending_flow_stats_reply(self, switch, flow_stats):
+        """ Queue a flow stats reply found by a pull in progress, to be handled
+        when the pull is over (see pull_helper). """
+        self.pending_replies.append((switch, flow_stats))
+
     def pull_stats(self):
         """Issue stats queries from the runtime on user program's request."""
-        queries_issued = self.pull_helper(self.runtime_stats_query_fun)
+        # Allow the callback before pulling, as recently pulled stats may be
+        # returned right away.
         self.increment_max_num_callbacks()
+        queries_issued = self.pull_helper(self.runtime_stats_query_fun)
         # If no queries were issued, then no matches, so just call userland
         # registered callback routines
         if not queries_issued:
             self.clear_transient_counters()
             self.log.info("Didn't issue stat queries; directly returning!")
-            self.call_callbacks([self.packet_count_persistent,
-                                 self.byte_count_persistent])
+            self.report_counts([self.packet_count_persistent,
+                                self.byte_count_persistent])
+
+    def report_counts(self, counts):
+        """ Record pulled (packets, bytes) counts and call back with them. """
+        self.series.append(time.time(), counts[0], counts[1])
+        self.call_callbacks(counts)
+
+    def subscribe_rate(self, threshold, callback,
+                       field=CounterSeries.PACKETS, window=None):
+        """ Call `callback(rate, above)` when the rate of the pulled counts
+        crosses `threshold` (see CounterSeries.subscribe). """
+        return self.series.subscribe(threshold, callback, field, window)
 
     def call_callbacks(self, args):
         """ Pace callbacks according to pull_stats issued by application. """
@@ -1198,39 +1444,13 @@ class CountBucket(MatchingAggregateBucket):
         Given a flow_stats_reply from switch s, collect only those
         counts which are relevant to this bucket.
 
-        Very simple processing for now: just collect all packet and
-        byte counts from rules that have a match that is in the set of
-        matches this bucket is interested in.
+        The runtime assumes that rules are uniquely identified by their
+        switch, priority and cookie (which denotes the table and the version
+        number of the entire policy), so flow stats are attributed to the
+        rules of this bucket through `rule_index`, without looking at their
+        matches.
         """
-        def entries_print_helper(pfx_string=""):
-            """ Pretty print bucket match entries. """
-            out = ""
-            for k in self.matches.keys():
-                out += pfx_string + str(k) + "\n"
-            return out
-
-        def stat_in_bucket(flow_stat, s):
-            """Return a matching entry for the given flow_stat in
-            bucket.matches."""
-            f = copy.copy(flow_stat['match'])
-            f['switch'] = s
-            ''' To restore using matches, uncomment the following lines.
-            # fme = self.match_entry(self.str_convert_match(f),
-            #                        flow_stat['priority'],
-            #                        flow_stat['cookie'])
-            Note that the change from match_entry to rule_entry implicitly
-            denotes the assumption about the runtime that rules are uniquely
-            identified by their cookie and priority, which denote (1) priority
-            in a given table, (2) the table itself, and (3) the version number
-            of the entire policy.
-            '''
-            fme = self.rule_entry(self.str_convert_match(f),
-                                  flow_stat['priority'],
-                                  flow_stat['cookie'])
-            if fme in self.matches.keys():
-                return fme
-            return None
-
+        debug = self.log.isEnabledFor(logging.DEBUG)
         self.log.debug("Got a reply from switch %s" % switch)
         with self.in_update_cv:
             while self.in_update:
@@ -1239,44 +1459,34 @@ class CountBucket(MatchingAggregateBucket):
             self.log.debug("Current set of outstanding switches is:")
             self.log.debug(str(self.outstanding_switches))
             if switch in self.outstanding_switches:
+                (table_pkts, table_bytes) = (0, 0)
+                (existing_pkts, existing_bytes) = (0, 0)
                 for f in flow_stats:
-                    if 'match' in f:
-                        me = stat_in_bucket(f, switch)
-                        extracted_pkts = f['packet_count']
-                        extracted_bytes = f['byte_count']
-                        if extracted_pkts > 0 and not me:
-                            self.log.debug("Packet not counted: \n%s %s %s" %
-                                           (str(f['match']),
-                                            "priority=%d" % f['priority'],
-                                            "version=%d" % f['cookie']))
-                            self.log.debug("Existing keys: \n%s" %
-                                           entries_print_helper())
-                        if me:
-                            if extracted_pkts > 0:
-                                self.log.debug('In bucket ' + self.bname +
-                                               ': found matching stats_reply:')
-                                self.log.debug(str(me))
-                                self.log.debug('packets: ' +
-                                               str(extracted_pkts) + ' bytes: '
-                                               + str(extracted_bytes))
-                            if not self.matches[me].existing_rule:
-                                self.packet_count_table += extracted_pkts
-                                self.byte_count_table   += extracted_bytes
-                            else: # pre-existing rule when bucket was created
-                                self.log.debug(('In bucket %s: removing' +
-                                                'pre-existing rule counts %d' +
-                                                ' %d') %
-                                               (self.bname, extracted_pkts,
-                                                extracted_bytes ))
-                                self.packet_count_persistent -= extracted_pkts
-                                self.byte_count_persistent -= extracted_bytes
-                                self.packet_count_persistent_existing += (
-                                    extracted_pkts)
-                                self.byte_count_persistent_existing += (
-                                    extracted_bytes)
-                                self.clear_existing_rule_flag(me)
-                    else:
-                        raise RuntimeError("weird flow entry")
+                    key = (f['priority'], f['cookie'])
+                    me = (self.rule_index.get((switch,) + key) or
+                          self.rule_index.get((None,) + key))
+                    if me is None:
+                        if debug and f['packet_count'] > 0:
+                            self.log.debug("Packet not counted: priority=%d "
+                                           "version=%d" % key)
+                        continue
+                    if not self.matches[me].existing_rule:
+                        table_pkts += f['packet_count']
+                        table_bytes += f['byte_count']
+                    else: # pre-existing rule when bucket was created
+                        existing_pkts += f['packet_count']
+                        existing_bytes += f['byte_count']
+                        self.clear_existing_rule_flag(me)
+                self.packet_count_table += table_pkts
+                self.byte_count_table += table_bytes
+                if existing_pkts or existing_bytes:
+                    self.log.debug(('In bucket %s: removing pre-existing ' +
+                                    'rule counts %d %d') %
+                                   (self.bname, existing_pkts, existing_bytes))
+                self.packet_count_persistent -= existing_pkts
+                self.byte_count_persistent -= existing_bytes
+                self.packet_count_persistent_existing += existing_pkts
+                self.byte_count_persistent_existing += existing_bytes
                 self.outstanding_switches.remove(switch)
                 self.log.debug("Current set of outstanding switches is:")
                 self.log.debug(str(self.outstanding_switches))
@@ -1297,10 +1507,10 @@ class CountBucket(MatchingAggregateBucket):
                     "perst. total: %d\n" % self.packet_count_persistent,
                     "bucket total: %d\n" % (self.packet_count_table +
                                             self.packet_count_persistent)))
-            self.call_callbacks([(self.packet_count_table +
-                                  self.packet_count_persistent),
-                                 (self.byte_count_table   +
-                                  self.byte_count_persistent)])
+            self.report_counts([(self.packet_count_table +
+                                 self.packet_count_persistent),
+                                (self.byte_count_table   +
+                                 self.byte_count_persistent)])
             self.clear_transient_counters()
 
     def clear_existing_rule_flag(self, entry):
@@ -1309,21 +1519,27 @@ class CountBucket(MatchingAggregateBucket):
         holding the bucket's in_update_cv since it updates the matches
         structure.
         """
-        assert k in self.matches
-        self.matches[k].existing_rule = False
+        assert entry in self.matches
+        self.matches[entry].existing_rule = False
 
     def __eq__(self, other):
         # TODO: if buckets eventually have names, equality should
         # be on names.
         return id(self) == id(other)
 
-    def add_match(self, match, priority, version):
+    def rule_key(self, entry):
+        """ Key of a rule entry in `rule_index`. """
+        return (entry.match.get('switch'), entry.priority, entry.version)
+
+    def add_match(self, match, priority, version, existing_rule=False):
         """Add a match to list of classifier rules to be queried for counts,
-        corresponding to a given version of the classifier.
+        corresponding to a given version of the classifier. `existing_rule`
+        marks rules already on switches when the bucket was created.
         """
         k = self.rule_entry(match, priority, version)
         if not k in self.matches:
-            self.matches[k] = self.match_status()
+            self.matches[k] = self.match_status(existing_rule=existing_rule)
+            self.rule_index[self.rule_key(k)] = k
 
     def delete_match(self, match, priority, version, to_be_deleted=False):
         """If a rule is deleted from the classifier, mark this rule (until we
@@ -1333,6 +1549,7 @@ class CountBucket(MatchingAggregateBucket):
         if k in self.matches:
             if to_be_deleted:
                 del self.matches[k]
+                self.rule_index.pop(self.rule_key(k), None)
             else:
                 self.matches[k].to_be_deleted = True
 
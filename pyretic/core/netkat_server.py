@@ -0,0 +1,299 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+A local, in-process stand-in for the frenetic NetKAT compile server.
+
+The server speaks the same protocol as `frenetic compile-server`: it accepts
+the NetKAT JSON produced by `netkat.compile_to_netkat` as a POST on
+NETKAT_DOM, and replies with the per-switch flow table JSON that
+`netkat.json_to_classifier` consumes, along with the NETKAT_TIME_HDR
+header. Compilation itself goes through the native pyretic classifier
+(pyretic/core/classifier.py), so the transport, caching and parsing layers of
+the netkat backend can be exercised and profiled without frenetic.
+
+Start it from the command line with
+
+  python -m pyretic.core.netkat_server --port 9000
+
+or in-process with `start_local_server(port)`.
+"""
+
+import sys
+import time
+import json
+import logging
+import argparse
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from pyretic.core import util
+from pyretic.core.network import *
+from pyretic.core.netkat import (NETKAT_PORT, NETKAT_DOM, NETKAT_TIME_HDR,
+                                 field_map)
+
+# Reverse of netkat.field_map, i.e., pyretic header -> OpenFlow pattern field.
+pattern_field_map = {v: k for (k, v) in field_map.items()}
+
+# NetKAT header names (netkat.header_val) -> pyretic header names.
+netkat_header_map = {'switch': 'switch', 'ethsrc': 'srcmac',
+                     'ethdst': 'dstmac', 'vlan': 'vlan_id',
+                     'vlanpcp': 'vlan_pcp', 'ethtype': 'ethtype',
+                     'ipproto': 'protocol', 'ip4src': 'srcip',
+                     'ip4dst': 'dstip', 'tcpsrcport': 'srcport',
+                     'tcpdstport': 'dstport'}
+
+TABLE_START_PRIORITY = 65535
+
+def log():
+    return logging.getLogger('%s.netkat_server' % __name__)
+
+############## json to policy ###################
+
+class netkat_json_parser(object):
+    """
+    Convert NetKAT JSON (as generated by `netkat.compile_to_netkat`) back into
+    a pyretic policy. Query locations are mapped to one CountBucket per query
+    name, and pipe locations to the Controller. All switch ids tested anywhere
+    in the policy are collected in `self.switches`.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.switches = set()
+
+    def header_value(self, h, v):
+        if h == 'ethsrc' or h == 'ethdst':
+            return MAC(v)
+        elif h == 'ip4src' or h == 'ip4dst':
+            return "%s/%d" % (v['addr'], v['mask'])
+        else:
+            return v
+
+    def location(self, v):
+        from pyretic.core.language import Controller, CountBucket
+        if v['type'] == 'physical':
+            return {'port': v['port']}
+        elif v['type'] == 'pipe':
+            return Controller
+        elif v['type'] == 'query':
+            name = v['name']
+            if not name in self.buckets:
+                self.buckets[name] = CountBucket(name)
+            return self.buckets[name]
+        else:
+            raise TypeError("unknown location %s" % str(v))
+
+    def to_pred(self, p):
+        from pyretic.core.language import (match, identity, drop, negate,
+                                           union, intersection)
+        t = p['type']
+        if t == 'true':
+            return identity
+        elif t == 'false':
+            return drop
+        elif t == 'test':
+            h = p['header']
+            if h == 'location':
+                return match(**self.location(p['value']))
+            if h == 'switch':
+                self.switches.add(p['value'])
+            return match(**{netkat_header_map[h]:
+                            self.header_value(h, p['value'])})
+        elif t == 'neg':
+            return negate([self.to_pred(p['pred'])])
+        elif t == 'and':
+            return intersection(map(self.to_pred, p['preds']))
+        elif t == 'or':
+            return union(map(self.to_pred, p['preds']))
+        else:
+            raise TypeError("unknown predicate %s" % str(p))
+
+    def to_pol(self, p):
+        from pyretic.core.language import (modify, parallel, sequential,
+                                           identity)
+        t = p['type']
+        if t == 'filter':
+            return self.to_pred(p['pred'])
+        elif t == 'mod':
+            h = p['header']
+            if h == 'location':
+                loc = self.location(p['value'])
+                return modify(**loc) if isinstance(loc, dict) else loc
+            return modify(**{netkat_header_map[h]:
+                             self.header_value(h, p['value'])})
+        elif t == 'union' or t == 'disjoint':
+            return parallel(map(self.to_pol, p['pols']))
+        elif t == 'seq':
+            return sequential(map(self.to_pol, p['pols']))
+        else:
+            raise TypeError("unknown policy %s" % str(p))
+
+############## classifier to json ###################
+
+def pattern_value(f, v):
+    """ Encode a single match value the way frenetic reports it. """
+    if f == 'srcmac' or f == 'dstmac':
+        # NetKAT reports MAC addresses in patterns reversed; see
+        # netkat.create_match.
+        return ':'.join(repr(v).split(':')[::-1])
+    elif f == 'srcip' or f == 'dstip':
+        return util.network_to_string(v)
+    else:
+        return v
+
+def modify_field(f):
+    """ Name of the OpenFlow set-field action for pyretic header `f`, in the
+    form that netkat.create_action decodes. """
+    pf = pattern_field_map[f]
+    if pf in ['dlVlan', 'dlVlanPcp']:
+        return 'Set' + pf[2:]
+    return 'Set' + pf[0].upper() + pf[1:]
+
+def action_to_json(act):
+    """ Encode a single classifier action as a frenetic action sequence. Returns
+    None for actions which are reported as queries rather than actions. """
+    from pyretic.core.language import (modify, identity, Controller,
+                                       CountBucket)
+    if act == Controller:
+        return [["Output", {"type": "controller", "bytes": 65535}]]
+    elif isinstance(act, CountBucket):
+        return None
+    elif act == identity:
+        return [["Output", {"type": "inport"}]]
+    elif isinstance(act, modify):
+        seq = []
+        for (f, v) in sorted(act.map.items()):
+            if f == 'port' or f == 'switch':
+                continue
+            if f in ['srcmac', 'dstmac', 'srcip', 'dstip']:
+                v = str(v)
+            seq.append(["Modify", [modify_field(f), v]])
+        if 'port' in act.map:
+            seq.append(["Output", {"type": "physical",
+                                   "port": act.map['port']}])
+        else:
+            seq.append(["Output", {"type": "inport"}])
+        return seq
+    else:
+        raise TypeError("unknown action %s" % repr(act))
+
+def rule_to_json(r, prio):
+    from pyretic.core.language import CountBucket
+    fmap = getattr(r.match, 'map', {})
+    pattern = {}
+    for (f, v) in fmap.items():
+        if f == 'switch':
+            continue
+        pattern[pattern_field_map[f]] = pattern_value(f, v)
+    actions = []
+    queries = []
+    for act in r.actions:
+        if isinstance(act, CountBucket):
+            queries.append(act.bname)
+        else:
+            actions.append(action_to_json(act))
+    actions.sort()
+    queries.sort()
+    return {'priority': prio, 'pattern': pattern, 'action': actions,
+            'queries': queries}
+
+def classifier_to_json(c, switches):
+    """ Split a (switch-agnostic) classifier into one flow table per switch,
+    in the frenetic output format. If no switches are known, a single table
+    with switch id 0 is produced, which netkat.create_match treats as a
+    wildcard on the switch. """
+    tables = []
+    for s in (sorted(switches) or [0]):
+        tbl = []
+        for r in c.rules:
+            fmap = getattr(r.match, 'map', {})
+            if s and 'switch' in fmap and fmap['switch'] != s:
+                continue
+            tbl.append(rule_to_json(r, TABLE_START_PRIORITY - len(tbl)))
+        tables.append({'switch_id': s, 'tbl': tbl})
+    return tables
+
+def compile_json(json_input):
+    """ Compile a NetKAT JSON policy string. Returns (output_json_string,
+    compile_time_in_seconds). """
+    start = time.time()
+    parser = netkat_json_parser()
+    pol = parser.to_pol(json.loads(json_input))
+    c = pol.compile()
+    out = json.dumps(classifier_to_json(c, parser.switches))
+    return (out, time.time() - start)
+
+############## HTTP server ###################
+
+class netkat_request_handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != NETKAT_DOM:
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader('content-length', 0))
+        json_input = self.rfile.read(length)
+        try:
+            (out, ctime) = compile_json(json_input)
+        except Exception as e:
+            log().error("Local netkat compilation failed: %s" % str(e))
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.send_header(NETKAT_TIME_HDR, "%f" % ctime)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        log().debug(format % args)
+
+def start_local_server(port=NETKAT_PORT):
+    """ Start a local compile server on a daemon thread. Returns the server;
+    call its `shutdown()` method to stop it. """
+    server = HTTPServer(('localhost', port), netkat_request_handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local NetKAT compile server"
+                                     " using the pyretic classifier compiler")
+    parser.add_argument('--port', '-p', type=int, default=NETKAT_PORT,
+                        help='Port to listen on (default %d)' % NETKAT_PORT)
+    args = parser.parse_args()
+    server = HTTPServer(('localhost', args.port), netkat_request_handler)
+    print "Local netkat compile server listening on port %d" % args.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,7 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
+import re
 import socket
 import struct
 from bitarray import bitarray
@@ -64,12 +65,13 @@ class IPPrefix(object):
             self.masklen = int(parts[1])
         else:
             raise TypeError
-        self.prefix = self.pattern.to_bits()[:self.masklen]
+        self.mask = (0xffffffff << (32 - self.masklen)) & 0xffffffff
+        self.prefix = self.pattern.value & self.mask
 
     def __eq__(self, other):
         """Match by checking prefix equality"""
         if isinstance(other,IPAddr):
-            return self.prefix == other.to_bits()[:self.masklen]
+            return self.prefix == other.value & self.mask
         else:
             return False
 
@@ -82,117 +84,175 @@ class IPPrefix(object):
     def __repr__(self):
         return "%s/%d" % (repr(self.pattern),self.masklen)
 
-class IPAddr(object):
-    def __init__(self, ip):
+# Bound on the number of interned addresses (and of the inputs they were
+# built from); the cache starts over when it is full.
+ADDR_CACHE_SIZE = 1 << 16
+
+class Addr(object):
+    """
+    Base of the fixed width address types: immutable values backed by an
+    integer. Addresses are interned, so that constructing an address again,
+    e.g., on every packet-in from the same host, returns the existing object
+    without parsing its input again.
+    """
+    __slots__ = ['value']
+    cache = {}
+
+    def __new__(cls, addr):
+        cache = Addr.cache
+        key = (cls, addr)
+        try:
+            return cache[key]
+        except (KeyError, TypeError):
+            pass
+        value = cls.parse(addr)
+        obj = cache.get((cls, value))
+        if obj is None:
+            obj = object.__new__(cls)
+            object.__setattr__(obj, 'value', value)
+        if len(cache) >= ADDR_CACHE_SIZE:
+            cache.clear()
+        cache[(cls, value)] = obj
+        try:
+            cache[key] = obj
+        except TypeError:
+            pass
+        return obj
+
+    @classmethod
+    def parse(cls, addr):
+        """ The integer value of `addr`. """
+        raise NotImplementedError
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
+
+    def __int__(self):
+        return self.value
+
+    def to_bits(self):
+        b = bitarray()
+        b.frombytes(self.to_bytes())
+        return b
 
+    def __hash__(self):
+        return hash(self.value)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+class IPAddr(Addr):
+    __slots__ = []
+
+    @classmethod
+    def parse(cls, ip):
         # already a IP object
         if isinstance(ip, IPAddr):
-            self.bits = ip.bits
+            return ip.value
+
+        elif isinstance(ip, (int, long)):
+            if not 0 <= ip <= 0xffffffff:
+                raise ValueError(ip)
+            return ip
 
         # otherwise will be in byte or string encoding
         else:
             assert isinstance(ip, basestring)
-            
-            b = bitarray()
-
-            # byte encoding
-            if len(ip) == 4:
-                b.frombytes(ip)
 
             # string encoding
-            else:
-                b.frombytes(socket.inet_aton(ip))
-
-            self.bits = b
+            if len(ip) != 4:
+                ip = socket.inet_aton(ip)
 
-    def to_bits(self):
-        return self.bits
+            return struct.unpack('!I', ip)[0]
 
     def to01(self):
-        return self.bits.to01()
+        return format(self.value, '032b')
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack('!I', self.value)
 
     def fromRaw(self):
         return self.to_bytes()
 
+    def in_network(self, net):
+        """ Whether this address lies in IPv4Network `net`. """
+        return ((self.value ^ int(net.network)) >> (32 - net.prefixlen)) == 0
+
     def __repr__(self):
         return socket.inet_ntoa(self.to_bytes())
 
-    def __hash__(self):
-        return hash(self.to_bytes())    
-
     def __eq__(self,other):
-        return repr(self) == repr(other)
-
-    def __ne__(self, other):
-        return not (self == other)
+        return self is other or (isinstance(other, IPAddr) and
+                                 self.value == other.value)
 
 class IP(IPAddr):
-    pass
+    __slots__ = []
 
-            
-class EthAddr(object):
-    def __init__(self, mac):
+MAC_PATTERN = re.compile(r"""(?xi)
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})
+                         """)
 
+class EthAddr(Addr):
+    __slots__ = []
+
+    @classmethod
+    def parse(cls, mac):
         # already a MAC object
         if isinstance(mac, EthAddr):
-            self.bits = mac.bits
+            return mac.value
+
+        elif isinstance(mac, (int, long)):
+            if not 0 <= mac <= 0xffffffffffff:
+                raise ValueError(mac)
+            return mac
 
         # otherwise will be in byte or string encoding
         else:
             assert isinstance(mac, basestring)
-            
-            b = bitarray()
 
             # byte encoding
             if len(mac) == 6:
-                b.frombytes(mac)
+                (hi, lo) = struct.unpack("!HI", mac)
+                return (hi << 32) | lo
 
             # string encoding
             else:
-                import re
-                m = re.match(r"""(?xi)
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})
-                             """, mac)
+                m = MAC_PATTERN.match(mac)
                 if not m:
                     raise ValueError
-                else:
-                    b.frombytes(struct.pack("!BBBBBB", *(int(s, 16) for s in m.groups())))
-
-            self.bits = b
-        
-    def to_bits(self):
-        return self.bits
+                value = 0
+                for part in m.groups():
+                    value = (value << 8) | int(part, 16)
+                return value
 
     def to01(self):
-        return self.bits.to01()
+        return format(self.value, '048b')
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack("!HI", self.value >> 32, self.value & 0xffffffff)
 
     def __repr__(self):
         parts = struct.unpack("!BBBBBB", self.to_bytes())
         mac = ":".join(hex(part)[2:].zfill(2) for part in parts)
         return mac
 
-    def __hash__(self):
-        return hash(self.to_bytes())
-
     def __eq__(self,other):
-        return repr(self) == repr(other)
-
-    def __ne__(self, other):
-        return not (self == other)
+        return self is other or (isinstance(other, EthAddr) and
+                                 self.value == other.value)
 
 class MAC(EthAddr):
-    pass
+    __slots__ = []
 
 ################################################################################
 # Tools
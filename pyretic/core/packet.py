@@ -5,7 +5,7 @@ from ryu.lib.packet import *
 from ryu.lib        import addrconv
 
 from pyretic.core import util
-from pyretic.core.network import IPAddr, EthAddr
+from pyretic.core.network import IPAddr, EthAddr, IP, MAC
 
 __all__ = ['of_field', 'of_fields', 'get_packet_processor', 'Packet']
 _field_list = dict()
@@ -171,8 +171,32 @@ class Processor(object):
             return str(pkt.data)
 
 
+        def expand_pyretic(raw):
+            headers = parse_headers(raw)
+            if headers is None:
+                headers = {}
+                for (h, v) in expand(raw).items():
+                    if v is None:
+                        continue
+                    elif h in ['srcmac', 'dstmac']:
+                        v = MAC(v)
+                    elif h in ['srcip', 'dstip']:
+                        v = IP(v)
+                    headers[h] = v
+            return headers
+
+        def repack(pyr_pkt, dirty):
+            raw = None
+            if dirty is not None and not 'raw' in dirty:
+                raw = patch_headers(pyr_pkt['raw'], pyr_pkt, dirty)
+            if raw is None:
+                raw = contract(pyr_pkt)
+            return raw
+
         setattr(self, 'unpack', expand)
+        setattr(self, 'unpack_pyretic', expand_pyretic)
         setattr(self, 'pack', contract)
+        setattr(self, 'repack', repack)
 
         # Build the packet processor pipeline
         return self
@@ -184,6 +208,259 @@ def get_packet_processor():
         get_packet_processor.processor = Processor().compile()
         return get_packet_processor.processor
 
+################################################################################
+# Fast path header parser
+################################################################################
+ETH_HEADER  = struct.Struct('!6s6sH')
+VLAN_HEADER = struct.Struct('!HH')
+IPV4_HEADER = struct.Struct('!BBH4xxBxx4s4s')
+TCP_HEADER  = struct.Struct('!HH8xB7x')
+UDP_HEADER  = struct.Struct('!HH4x')
+ARP_HEADER  = struct.Struct('!6xH6s4s6s4s')
+ICMP_HEADER = struct.Struct('!BBH')
+
+ETH_HEADER_LEN = ETH_HEADER.size
+# ICMP types whose messages ryu parses further (see ryu.lib.packet.icmp).
+ICMP_PARSED_TYPES = [0, 3, 8, 11]
+
+def parse_headers(raw):
+    """
+    Decode the headers of `raw` as Processor.unpack does, but in one pass of
+    struct unpacking, with MAC and IP addresses as MAC and IP. Only the common
+    layouts (Ethernet, optionally with one VLAN tag, carrying ARP, or IPv4
+    carrying TCP, UDP or ICMP) are decoded; returns None for other packets,
+    to be decoded with ryu instead. As with ryu, the fields of a truncated
+    header are left out.
+    """
+    if not isinstance(raw, str) or len(raw) < ETH_HEADER_LEN:
+        return None
+    (dstmac, srcmac, ethtype) = ETH_HEADER.unpack_from(raw)
+    headers = {'srcmac': MAC(srcmac), 'dstmac': MAC(dstmac),
+               'header_len': ETH_HEADER_LEN, 'payload_len': len(raw)}
+    offset = ETH_HEADER_LEN
+    if ethtype == VLAN:
+        if len(raw) < offset + VLAN_HEADER.size:
+            return None
+        (tci, ethtype) = VLAN_HEADER.unpack_from(raw, offset)
+        headers['vlan_pcp'] = tci >> 13
+        headers['vlan_id'] = tci & 0xfff
+        offset += VLAN_HEADER.size
+    headers['ethtype'] = ethtype
+
+    if ethtype == IPV4:
+        if len(raw) < offset + IPV4_HEADER.size:
+            return headers
+        (ver_ihl, tos, total_length, proto, srcip, dstip) = \
+            IPV4_HEADER.unpack_from(raw, offset)
+        ihl = (ver_ihl & 0xf) * 4
+        if ihl < IPV4_HEADER.size or not proto in [TCP_PROTO, UDP_PROTO,
+                                                   ICMP_PROTO]:
+            return None
+        headers['srcip'] = IP(srcip)
+        headers['dstip'] = IP(dstip)
+        headers['protocol'] = proto
+        headers['tos'] = tos
+        # The transport header lies within the total length of the datagram.
+        start = offset + ihl
+        length = min(offset + total_length, len(raw)) - start
+        if proto == ICMP_PROTO:
+            if length < ICMP_HEADER.size:
+                return headers
+            (icmp_type, icmp_code, _) = ICMP_HEADER.unpack_from(raw, start)
+            # ryu drops ICMP headers whose message body is truncated.
+            if (icmp_type in ICMP_PARSED_TYPES and
+                ICMP_HEADER.size < length < ICMP_HEADER.size + 4):
+                return headers
+            headers['srcport'] = icmp_type
+            headers['dstport'] = icmp_code
+        elif proto == TCP_PROTO:
+            if length < TCP_HEADER.size:
+                return headers
+            (srcport, dstport, data_offset) = TCP_HEADER.unpack_from(raw,
+                                                                     start)
+            # ryu takes a TCP header with no length for a missing one.
+            if data_offset >> 4:
+                headers['srcport'] = srcport
+                headers['dstport'] = dstport
+        elif length >= UDP_HEADER.size:
+            (srcport, dstport) = UDP_HEADER.unpack_from(raw, start)
+            headers['srcport'] = srcport
+            headers['dstport'] = dstport
+        return headers
+    elif ethtype == ARP:
+        if len(raw) >= offset + ARP_HEADER.size:
+            (opcode, _, srcip, _, dstip) = ARP_HEADER.unpack_from(raw, offset)
+            headers['protocol'] = opcode
+            headers['srcip'] = IP(srcip)
+            headers['dstip'] = IP(dstip)
+        return headers
+    return None
+
+################################################################################
+# Fast path header rewriting
+################################################################################
+# Headers that Processor.pack writes into the raw packet.
+PACKED_FIELDS = ['srcmac', 'dstmac', 'vlan_id', 'vlan_pcp', 'ethtype',
+                 'srcip', 'dstip', 'protocol', 'tos', 'srcport', 'dstport']
+
+def checksum(buf):
+    """ The internet checksum of the (even length) bytes `buf`. """
+    s = sum(struct.unpack('!%dH' % (len(buf) / 2), str(buf)))
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+def checksum_update(csum, old, new):
+    """ Update checksum `csum` for the (even length, aligned) bytes `old` of
+    the data it covers replaced by `new` (RFC 1624). """
+    n = len(old) / 2
+    s = ~csum & 0xffff
+    s += sum(~w & 0xffff for w in struct.unpack('!%dH' % n, str(old)))
+    s += sum(struct.unpack('!%dH' % n, str(new)))
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+def patch_headers(raw, headers, dirty):
+    """
+    Write the values in `headers` of the fields `dirty` into packet `raw`, as
+    Processor.pack does, but in place in a copy of raw, and fixing up the
+    IPv4, TCP, UDP and ICMP checksums they affect. Only the layouts decoded by
+    parse_headers are rewritten, and neither the ethertype nor the IPv4
+    protocol; returns None for other rewrites, to be packed with ryu instead.
+    """
+    dirty = [h for h in dirty if h in PACKED_FIELDS]
+    if not dirty:
+        return raw
+    if (not isinstance(raw, str) or len(raw) < ETH_HEADER_LEN or
+        'ethtype' in dirty):
+        return None
+    buf = bytearray(raw)
+    (_, _, ethtype) = ETH_HEADER.unpack_from(raw)
+    offset = ETH_HEADER_LEN
+    tagged = (ethtype == VLAN)
+    if tagged:
+        if len(raw) < offset + VLAN_HEADER.size:
+            return None
+        (tci, ethtype) = VLAN_HEADER.unpack_from(raw, offset)
+        offset += VLAN_HEADER.size
+
+    def get(h):
+        """ The new value of dirty field h, or None if pack leaves it as is. """
+        if h in dirty:
+            return headers.get(h)
+        return None
+
+    def write(start, new):
+        old = str(buf[start:start+len(new)])
+        buf[start:start+len(new)] = new
+        return (old, new)
+
+    try:
+        for (h, start) in [('dstmac', 0), ('srcmac', 6)]:
+            if get(h) is not None:
+                write(start, EthAddr(get(h)).to_bytes())
+
+        l3_dirty = [h for h in ['srcip', 'dstip', 'protocol', 'tos',
+                                'srcport', 'dstport'] if get(h) is not None]
+        if l3_dirty and ethtype == IPV4:
+            if len(raw) < offset + IPV4_HEADER.size or 'protocol' in l3_dirty:
+                return None
+            (ver_ihl, _, total_length, proto, _, _) = \
+                IPV4_HEADER.unpack_from(raw, offset)
+            ihl = (ver_ihl & 0xf) * 4
+            if ihl < IPV4_HEADER.size or len(raw) < offset + ihl:
+                return None
+            # Changes to the pseudo header and to the transport header.
+            pseudo = []
+            l4 = []
+            for (h, start) in [('srcip', 12), ('dstip', 16)]:
+                if get(h) is not None:
+                    pseudo.append(write(offset + start,
+                                        IPAddr(get(h)).to_bytes()))
+            if get('tos') is not None:
+                buf[offset + 1] = get('tos')
+            struct.pack_into('!H', buf, offset + 10, 0)
+            struct.pack_into('!H', buf, offset + 10,
+                             checksum(buf[offset:offset+ihl]))
+
+            start = offset + ihl
+            length = min(offset + total_length, len(raw)) - start
+            if proto == ICMP_PROTO:
+                # Type and code, in the srcport and dstport fields.
+                if length < ICMP_HEADER.size + 4:
+                    return None
+                (icmp_type, icmp_code, csum) = ICMP_HEADER.unpack_from(raw,
+                                                                       start)
+                if get('srcport') is not None:
+                    icmp_type = get('srcport')
+                if get('dstport') is not None:
+                    icmp_code = get('dstport')
+                (old, new) = write(start, struct.pack('!BB', icmp_type,
+                                                      icmp_code))
+                struct.pack_into('!H', buf, start + 2,
+                                 checksum_update(csum, old, new))
+            elif proto in [TCP_PROTO, UDP_PROTO]:
+                if proto == TCP_PROTO:
+                    if (length < TCP_HEADER.size or
+                        not TCP_HEADER.unpack_from(raw, start)[2] >> 4):
+                        return None
+                    csum_offset = start + 16
+                else:
+                    if length < UDP_HEADER.size:
+                        return None
+                    csum_offset = start + 6
+                for (h, port_offset) in [('srcport', 0), ('dstport', 2)]:
+                    if get(h) is not None:
+                        l4.append(write(start + port_offset,
+                                        struct.pack('!H', get(h))))
+                (csum,) = struct.unpack_from('!H', raw, csum_offset)
+                # A zero UDP checksum is no checksum at all.
+                if proto == TCP_PROTO or csum != 0:
+                    for (old, new) in pseudo + l4:
+                        csum = checksum_update(csum, old, new)
+                    if proto == UDP_PROTO and csum == 0:
+                        csum = 0xffff
+                    struct.pack_into('!H', buf, csum_offset, csum)
+            else:
+                return None
+        elif l3_dirty and ethtype == ARP:
+            if (len(raw) < offset + ARP_HEADER.size or
+                get('srcport') is not None or get('dstport') is not None or
+                get('tos') is not None):
+                return None
+            if get('protocol') is not None:
+                struct.pack_into('!H', buf, offset + 6, get('protocol'))
+            for (h, start) in [('srcip', 14), ('dstip', 24)]:
+                if get(h) is not None:
+                    write(offset + start, IPAddr(get(h)).to_bytes())
+        elif l3_dirty:
+            return None
+
+        # Last, as adding or removing the VLAN tag moves the headers after it.
+        if 'vlan_id' in dirty or 'vlan_pcp' in dirty:
+            (vid, pcp) = (headers.get('vlan_id'), headers.get('vlan_pcp'))
+            # As with pack, the tag is only kept along with a VLAN id.
+            if vid is None:
+                if tagged:
+                    del buf[ETH_HEADER_LEN-2:ETH_HEADER_LEN+2]
+                return str(buf)
+            if not 0 <= vid <= 0xfff:
+                return None
+            if not tagged:
+                tci = 0
+                buf[ETH_HEADER_LEN-2:ETH_HEADER_LEN-2] = struct.pack('!HH',
+                                                                     VLAN, 0)
+            tci = (tci & ~0xfff) | vid
+            if pcp is not None:
+                if not 0 <= pcp <= 7:
+                    return None
+                tci = (tci & 0x1fff) | (pcp << 13)
+            struct.pack_into('!H', buf, ETH_HEADER_LEN, tci)
+    except (AssertionError, ValueError, TypeError, struct.error):
+        return None
+    return str(buf)
+
 ################################################################################
 # Field Validators
 ################################################################################
@@ -487,10 +764,43 @@ class ArpDstIp(object): pass
 # Packet 
 ################################################################################
 class Packet(object):
-    __slots__ = ["header"]
+    """
+    A located packet: an immutable map from header fields to values. A packet
+    decoded from a raw packet (see Packet.from_raw) keeps the headers it was
+    decoded into, so that the fields rewritten since (see dirty_headers) can
+    be written back into the raw packet without packing it again.
+    """
+    __slots__ = ["header", "decoded"]
     
-    def __init__(self, state={}):
-        self.header = util.frozendict(state)
+    def __init__(self, state={}, decoded=None):
+        if isinstance(state, util.frozendict):
+            self.header = state
+        else:
+            self.header = util.frozendict(state)
+        self.decoded = decoded
+
+    @classmethod
+    def from_raw(cls, headers):
+        """ The packet with `headers`, as decoded from headers['raw']. """
+        pkt = cls(headers)
+        pkt.decoded = pkt.header
+        return pkt
+
+    def dirty_headers(self):
+        """ The fields written by Processor.pack, and 'raw', whose values
+        differ from those decoded from the raw packet, or None if the packet
+        was not decoded from one. """
+        if self.decoded is None:
+            return None
+        (header, decoded) = (self.header, self.decoded)
+        if header is decoded:
+            return set()
+        dirty = set()
+        for h in PACKED_FIELDS + ['raw']:
+            (v, dv) = (header.get(h), decoded.get(h))
+            if not v is dv and v != dv:
+                dirty.add(h)
+        return dirty
 
     def available_fields(self):
         return self.header.keys()
@@ -511,7 +821,7 @@ class Packet(object):
                 delete.append(k)
             else:
                 add[k] = v
-        return Packet(self.header.update(add).remove(delete))
+        return Packet(self.header.update_remove(add, delete), self.decoded)
 
 
     def modify(self, **kwargs):
@@ -38,13 +38,25 @@ from pyretic.core.classifier import get_rule_derivation_tree
 from pyretic.core.classifier import get_rule_derivation_leaves
 
 from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
+from threading import Timer
 import logging, sys, time
 from datetime import datetime
 import copy
+from pyretic.backend.comm import dict_to_ascii
 
 TABLE_MISS_PRIORITY = 0
 TABLE_START_PRIORITY = 60000
-STATS_REQUERY_THRESHOLD_SEC = 4
+STATS_POLL_INTERVAL_SEC = 1
+STATS_REPLY_TIMEOUT_SEC = 4
+STATS_REQUEST_BUDGET = 10 # flow stats requests per second per switch
+STATS_ALL_TABLES = 0xff
+FULL_STATS_SCOPE = (STATS_ALL_TABLES, 0, 0) # (table_id, cookie, cookie_mask)
+# Header fields on which OpenFlow 1.0 flow stats requests can be narrowed.
+STATS_MATCH_FIELDS = ['port', 'srcmac', 'dstmac', 'ethtype', 'vlan_id',
+                      'vlan_pcp', 'protocol', 'srcip', 'dstip', 'tos',
+                      'srcport', 'dstport']
+COOKIE_VERSION_MASK = 0x7ff
+COOKIE_TABLE_MASK = 0b11111 << 11
 NUM_PATH_TAGS = 32000
 DEFAULT_NX_TABLE_ID=1
 MAX_STAGES = 13 # max. for extensively multi-staged pipelines
@@ -68,6 +80,9 @@ class Runtime(object):
     :type verbosity: string
     :param use_nx: use nicira extensions for multi-table rule installation
     :type use_nx: boolean
+    :param use_fdd_compiler: compile policies locally through forwarding
+    decision diagrams (pyretic.lib.fdd) instead of crossing classifiers
+    :type use_fdd_compiler: boolean
     :param pipeline: for multi-stage switches, a pipeline configuration
     :type pipeline: pipeline_config
     """
@@ -76,7 +91,9 @@ class Runtime(object):
     def __init__(self, backend, main, path_main, kwargs, mode='interpreted',
                  verbosity='normal',use_nx=False, pipeline="default_pipeline",
                  opt_flags=None, use_pyretic=False, use_fdd=False, offline=False,
-                 write_log='rt_log.txt', restart_frenetic=False):
+                 write_log='rt_log.txt', restart_frenetic=False,
+                 use_fdd_compiler=False, stage_workers=1, max_queries=None,
+                 cost_pack_enabled=False, stage_rule_limit=None):
         self.verbosity = self.verbosity_numeric(verbosity)
         self.use_nx = use_nx
         self.pipeline = pipeline
@@ -86,7 +103,8 @@ class Runtime(object):
         self.prev_network = self.network.copy()
         self.forwarding = main(**kwargs)
         self.get_subpol_stats = True # TODO: make cmdline option to pyretic.py
-        self.use_pyretic_compiler = use_pyretic
+        self.use_pyretic_compiler = use_pyretic or use_fdd_compiler
+        self.use_fdd_compiler = use_fdd_compiler
 
         """ Set runtime flags for specific optimizations. """
         self.set_optimization_opts(path_main, opt_flags)
@@ -95,7 +113,11 @@ class Runtime(object):
         self.in_path_recompile = False
         self.init_path_query(path_main, kwargs, self.partition_cnt,
                              self.cache_enabled, self.edge_contraction_enabled,
-                             use_fdd=use_fdd, write_log=self.write_log)
+                             use_fdd=use_fdd, write_log=self.write_log,
+                             stage_workers=stage_workers,
+                             max_queries=max_queries,
+                             cost_pack_enabled=cost_pack_enabled,
+                             stage_rule_limit=stage_rule_limit)
         """ Initialize a `policy map', which determines how the network policy
         is mapped onto the tables on switches. By default (i.e., a single stage
         table), the entire policy goes into the first table on each switch.
@@ -125,10 +147,7 @@ class Runtime(object):
             self.in_bucket_apply = False
             self.network_triggered_policy_update = False
             self.bucket_triggered_policy_update = False
-            self.global_outstanding_queries_lock = Lock()
-            self.global_outstanding_queries = {}
-            self.last_queried_time_lock = Lock()
-            self.last_queried_time = {}
+            self.stats_poller = stats_poller(self)
             self.global_outstanding_deletes_lock = Lock()
             self.global_outstanding_deletes = {}
             self.manager = Manager()
@@ -299,7 +318,7 @@ class Runtime(object):
         if sketch:
             for s in sketch:
                 if self.use_pyretic_compiler:
-                    s[0].compile()
+                    self.local_compile(s[0])
                 else:
                     self.write_log.info("starting to compile %s" % s[0].name)
                     if restart_frenetic:
@@ -502,12 +521,20 @@ class Runtime(object):
             cp = p
         return cp
 
+    def local_compile(self, pol):
+        """ Compile a policy in-process, with the FDD compiler if enabled and
+        by crossing classifiers otherwise. """
+        if self.use_fdd_compiler:
+            from pyretic.lib.fdd import fdd_compile
+            return fdd_compile(pol)
+        return pol.compile()
+
     @Stat.classifier_stat
     @Stat.elapsed_time
     def whole_policy_compile(self):
         cp = self.vlan_preprocessed_policy(self.policy)
         if self.use_pyretic_compiler:
-            p = cp.compile()
+            p = self.local_compile(cp)
         elif self.path_policy:
             p = self.netkat_classifier_compile(cp)
         else:
@@ -527,10 +554,10 @@ class Runtime(object):
             if table > 0 and not self.use_pyretic_compiler:
                 (c, t) = pol.netkat_compile(self.sw_cnt(), multistage=True)
             else:
-                c = pol.compile()
+                c = self.local_compile(pol)
         elif self.pipeline == 'path_query_pipeline' or self.pipeline == 'mt':
             if self.use_pyretic_compiler:
-                c = pol.compile()
+                c = self.local_compile(pol)
             else:
                 (c, t) = pol.netkat_compile(self.sw_cnt(), multistage=True)
         else:
@@ -616,15 +643,20 @@ class Runtime(object):
             p.attach(self.handle_policy_change)
 
 
-    def handle_path_change(self):
+    def handle_path_change(self, incremental=False):
         """ When a dynamic path policy updates its path_policy, initiate
         recompilation of the path (and hence pyretic) policy. """
-        self.recompile_paths()
+        self.recompile_paths(incremental)
         self.update_dynamic_sub_path_pols(self.path_policy)
         if self.path_triggered_policy_update:
             self.update_switch_classifiers()
             self.path_triggered_policy_update = False
 
+    def handle_path_query_change(self):
+        """ When a dynamic path policy adds or removes queries, only recompile
+        the query stages affected. """
+        self.handle_path_change(incremental=True)
+
     def handle_path_change_dyn_pred(self, sub_pol):
         dyn_preds = self.dynamic_path_preds
         for policy_tuple in dyn_preds:
@@ -653,7 +685,7 @@ class Runtime(object):
         for pp in (old_dynamic_sub_path_pols - self.dynamic_sub_path_pols):
             pp.path_detach()
         for pp in (self.dynamic_sub_path_pols - old_dynamic_sub_path_pols):
-            pp.path_attach(self.handle_path_change)
+            pp.path_attach(self.handle_path_query_change)
         old_dynamic_path_preds = copy.copy(self.dynamic_path_preds)
         dyn_preds_tuples = re_tree_gen.global_dyn_list()
         self.dynamic_path_preds = set(re_tree_gen.global_dyn_list())
@@ -665,56 +697,68 @@ class Runtime(object):
             news.pred.set_network(self.network)
             news.pred.path_attach(self.handle_path_change_dyn_pred)
 
-    def recompile_paths(self):
+    def recompile_paths(self, incremental=False):
         """ Recompile DFA based on new path policy, which in turns updates the
-        runtime's policy member. """
+        runtime's policy member. If `incremental`, and the upstream queries
+        are unchanged, only the downstream query stages whose queries changed
+        are recompiled (see pathcomp.update_downstream). If nothing the query
+        stages depend on has changed (see get_path_stage_key), e.g., on a
+        topology change, only the upstream queries are recompiled. """
         self.in_path_recompile = True
         from pyretic.lib.path import pathcomp, path, path_grouping, path_empty
         path_grouping.set_rtm_fvlist(self.sw_port_ids())
+        if incremental and self.recompile_paths_incremental():
+            self.path_stage_key = self.get_path_stage_key()
+            self.in_path_recompile = False
+            return
+        if (not self.path_stage_key is None and
+            self.path_stage_key[0] == self.get_path_stage_key()[0]):
+            self.recompile_upstream_paths()
+            self.in_path_recompile = False
+            return
         """ TODO(ngsrinivas): Clearing of virtual fields assumes that path
         queries are the only users of virtual fields. This may not at all be
         true in general!
         """
         virtual_field.clear()
-        expanded_paths = path_grouping.expand_groupby(self.path_policy)
-        self.ds_path_policy = pathcomp.get_directional_pathpol(expanded_paths,
-                                                               path.MEASURE_LOC_DOWNSTREAM)
-        self.us_path_policy = pathcomp.get_directional_pathpol(expanded_paths,
-                                                               path.MEASURE_LOC_UPSTREAM)
+        """ Downstream queries are expanded while they are packed into
+        stages, so that the expansions of groupby queries are never all in
+        memory at once. Upstream queries are compiled together. """
+        self.ds_path_policy = pathcomp.get_directional_pathpol(
+            self.path_policy, path.MEASURE_LOC_DOWNSTREAM)
+        us_path_policy = pathcomp.get_directional_pathpol(
+            self.path_policy, path.MEASURE_LOC_UPSTREAM)
+        if isinstance(us_path_policy, path_empty):
+            self.us_path_policy = us_path_policy
+        else:
+            self.us_path_policy = path_grouping.expand_groupby(
+                us_path_policy, max_queries=pathcomp.max_queries)
+        if isinstance(self.ds_path_policy, path_empty):
+            ds_queries = self.ds_path_policy
+        else:
+            ds_queries = path_grouping.iter_expand_groupby(
+                self.ds_path_policy, max_queries=pathcomp.max_queries)
 
-        ds_policy_fragments = pathcomp.compile_downstream(self.ds_path_policy,
+        ds_policy_fragments = pathcomp.compile_downstream(ds_queries,
             NUM_PATH_TAGS, self.disjoint_enabled, self.default_enabled,
             self.integrate_enabled,
             self.ragel_enabled, self.partition_enabled, self.preddecomp_enabled)
 
-        if self.us_path_policy == path_empty():
-            us_policy = drop
-        else:
-            us_policy = pathcomp.compile_upstream(self.us_path_policy,
-                self.sw_port_ids(), self.nw_edges(), self.forwarding,
-                self.sw_cnt(),
-                NUM_PATH_TAGS, self.disjoint_enabled, self.default_enabled,
-                self.integrate_enabled,
-                self.ragel_enabled, self.partition_enabled)
-        self.path_up_table.policy = us_policy
+        self.recompile_upstream_paths()
+        self.us_path_queries = self.get_upstream_path_queries()
 
         (in_res, out_res) = ds_policy_fragments
-        if self.integrate_enabled:
-            assert len(in_res) == len(out_res)
-            for i in range(0, len(in_res)):
-                self.path_in_table_list[i].policy  =  in_res[i]
-                self.path_out_table_list[i].policy = out_res[i]
-        else:
-            self.path_ingress = in_res
-            self.path_egress  = out_res
-            assert len(in_res) == len(out_res)
-            for i in range(0, len(in_res)):
-                (intagp , incapp)  =  in_res[i]
-                (outtagp, outcapp) = out_res[i]
-                self.path_in_table_list[i].policy  =  intagp + incapp
-                self.path_out_table_list[i].policy = outtagp + outcapp
+        assert len(in_res) == len(out_res)
+        if not self.integrate_enabled:
+            self.path_ingress = []
+            self.path_egress  = []
+        for i in range(0, len(in_res)):
+            self.set_path_stage(i, in_res[i], out_res[i])
+        for i in range(len(in_res), MAX_STAGES):
+            self.clear_path_stage(i)
         self.path_in_table.policy = sequential(self.path_in_table_list)
         self.path_out_table.policy = sequential(self.path_out_table_list)
+        self.path_stage_key = self.get_path_stage_key()
         self.in_path_recompile = False
         '''(in_tag, in_cap, out_tag, out_cap) = policy_fragments
         self.path_in_tagging.policy  = in_tag
@@ -725,6 +769,89 @@ class Runtime(object):
         self.path_out_table.policy = out_tag + out_cap
         '''
 
+    def recompile_upstream_paths(self):
+        """ Recompile the upstream path queries against the current topology
+        and forwarding policy. """
+        from pyretic.lib.path import pathcomp, path_empty
+        if self.us_path_policy == path_empty():
+            us_policy = drop
+        else:
+            us_policy = pathcomp.compile_upstream(self.us_path_policy,
+                self.sw_port_ids(), self.nw_edges(), self.forwarding,
+                self.sw_cnt(),
+                NUM_PATH_TAGS, self.disjoint_enabled, self.default_enabled,
+                self.integrate_enabled,
+                self.ragel_enabled, self.partition_enabled)
+        self.path_up_table.policy = us_policy
+
+    def get_path_stage_key(self):
+        """ What the compiled query stages depend on, besides the compilation
+        options: the (unexpanded) path queries, the switch ports that their
+        groupby atoms expand over, and the policies of the dynamic predicates
+        in them. Returns (key, refs), where `refs` holds on to the objects
+        whose ids are in the key. """
+        from pyretic.lib.path import path_policy_utils, re_tree_gen
+        prims = path_policy_utils.get_primitive_pathpols(self.path_policy)
+        dyn_preds = re_tree_gen.global_dyn_list()
+        key = (frozenset(map(id, prims)), self.sw_port_ids(),
+               frozenset([(id(d.pred), id(d.pred.policy))
+                          for d in dyn_preds]))
+        return (key, (prims, [d.pred.policy for d in dyn_preds]))
+
+    def get_upstream_path_queries(self):
+        """ The set of (unexpanded) upstream queries in the path policy. """
+        from pyretic.lib.path import path, path_policy_utils
+        prims = path_policy_utils.get_primitive_pathpols(self.path_policy)
+        return set([p for p in prims
+                    if p.path.measure_loc == path.MEASURE_LOC_UPSTREAM])
+
+    def recompile_paths_incremental(self):
+        """ Recompile only the downstream query stages affected by queries
+        added to or removed from the path policy. Returns False if the path
+        policy must be compiled afresh instead. """
+        from pyretic.lib.path import pathcomp, path
+        if self.get_upstream_path_queries() != self.us_path_queries:
+            return False
+        changes = pathcomp.update_downstream(self.path_policy)
+        if changes is None:
+            return False
+        for (i, parts) in sorted(changes.items()):
+            if parts is None:
+                self.clear_path_stage(i)
+            else:
+                self.set_path_stage(i, parts[0], parts[1])
+        self.ds_path_policy = pathcomp.get_directional_pathpol(
+            self.path_policy, path.MEASURE_LOC_DOWNSTREAM)
+        return True
+
+    def clear_path_stage(self, i):
+        """ Empty the path tables of query stage `i`, if it was in use. """
+        for table in [self.path_in_table_list[i], self.path_out_table_list[i]]:
+            if not table.policy == identity:
+                table.policy = identity
+        if not self.integrate_enabled:
+            for stage_list in [self.path_ingress, self.path_egress]:
+                if i < len(stage_list):
+                    stage_list[i] = (identity, drop)
+
+    def set_path_stage(self, i, in_part, out_part):
+        """ Install the compiled in and out parts of query stage `i` into its
+        path tables. """
+        if self.integrate_enabled:
+            self.path_in_table_list[i].policy  = in_part
+            self.path_out_table_list[i].policy = out_part
+        else:
+            for (stage_list, part) in [(self.path_ingress, in_part),
+                                       (self.path_egress, out_part)]:
+                if i >= len(stage_list):
+                    stage_list.extend([(identity, drop)] *
+                                      (i + 1 - len(stage_list)))
+                stage_list[i] = part
+            (intagp , incapp)  =  in_part
+            (outtagp, outcapp) = out_part
+            self.path_in_table_list[i].policy  =  intagp + incapp
+            self.path_out_table_list[i].policy = outtagp + outcapp
+
 #######################
 # REACTIVE COMPILATION
 #######################
@@ -818,14 +945,34 @@ class Runtime(object):
         """ Set a cookie which contains information both about the
         classifier version of the rule as well as the table it's going
         into. """
-        return (((table_id & 0b11111) << 11) | (version & 0x7ff))
+        return (((table_id << 11) & COOKIE_TABLE_MASK) |
+                (version & COOKIE_VERSION_MASK))
 
     def get_version_table_from_cookie(self, cookie):
         """ Return a classifier version number and table_id from a cookie. """
-        table_id = (cookie >> 11) & 0b11111
-        version  = cookie & 0x7ff
+        table_id = (cookie & COOKIE_TABLE_MASK) >> 11
+        version  = cookie & COOKIE_VERSION_MASK
         return (version, table_id)
 
+    def get_stats_scope(self, cookies):
+        """ Return the narrowest flow stats request covering the rules with
+        the given cookies on a switch, as a (table_id, cookie, cookie_mask)
+        tuple. A single cookie pins down both the classifier version and the
+        table of its rules; cookies of the same table share the table
+        bits. Rules only sit in the table of their cookie with nicira
+        extensions. """
+        cookies = set(cookies)
+        tables = set([self.get_version_table_from_cookie(c)[1]
+                      for c in cookies])
+        if len(tables) != 1:
+            return FULL_STATS_SCOPE
+        table_id = tables.pop()
+        wire_table_id = table_id if self.use_nx else STATS_ALL_TABLES
+        if len(cookies) == 1:
+            return (wire_table_id, cookies.pop(),
+                    COOKIE_TABLE_MASK | COOKIE_VERSION_MASK)
+        return (wire_table_id, self.get_cookie(0, table_id), COOKIE_TABLE_MASK)
+
     def install_defaults(self, s, table_id):
         """ Install backup rules on switch s by default. """
         # Fallback "send to controller" rule under table miss
@@ -1105,17 +1252,24 @@ class Runtime(object):
                 table_id = rule.table_id
                 hashable_match = util.frozendict(match)
                 rule_key = (hashable_match, priority, version)
+                switch = match.get('switch')
                 for act in actions:
                     if isinstance(act, CountBucket):
                         if op == "add":
                             act.add_match(match, priority, version)
+                            self.stats_poller.add_rule(switch, version,
+                                                       priority, act)
                         elif op == "delete":
                             act.delete_match(match, priority, version)
+                            self.stats_poller.remove_rule(switch, version,
+                                                          priority, act)
                             self.add_global_outstanding_delete(rule_key, act)
                         elif op == "stay" or op == "modify":
                             if act.is_new_bucket():
                                 act.add_match(match, priority, version,
                                               existing_rule=True)
+                                self.stats_poller.add_rule(switch, version,
+                                                           priority, act)
 
                 # debug: check the existence of entries in outstanding_deletes
                 # for all buckets in actions list, if op is deleting the rule.
@@ -1738,71 +1892,78 @@ class Runtime(object):
 # QUERYING SUPPORT
 ###################
 
-    def pull_switches_for_preds(self, concrete_preds, bucket):
-        """Given a list of concrete predicates, query the list of switches
-        corresponding to the switches where these predicates apply.
+    def pull_switches_for_preds(self, entries, bucket):
+        """Given a list of match entries of `bucket`, query the switches where
+        their rules apply, through the shared stats poller.
         """
-        switch_list = []
-        if not concrete_preds:
+        if not entries:
             return False
         self.log.debug('-------------------------------------------------------------')
-        self.log.debug('--- In pull_switches_for_preds: printing concrete predicates:')
-        for concrete_pred in concrete_preds:
-            self.log.debug(str(concrete_pred))
+        self.log.debug('--- In pull_switches_for_preds: printing match entries:')
+        for me in entries:
+            self.log.debug(str(me))
         self.log.debug('-------------------------------------------------------------')
-        for concrete_pred in concrete_preds:
-            if 'switch' in concrete_pred:
-                switch_id = concrete_pred['switch']
-                if ((not switch_id in switch_list) and
-                    (switch_id in self.network.switch_list())):
-                    switch_list.append(switch_id)
+        switches = set()
+        for me in entries:
+            if 'switch' in me.match:
+                switches.add(me.match['switch'])
             else:
-                switch_list = self.network.switch_list()
+                switches = None
                 break
+        switch_list = [s for s in self.network.switch_list()
+                       if switches is None or s in switches]
         self.log.info('Pulling stats from switches '
                       + str(switch_list) + ' for bucket ' +
                       str(id(bucket)))
         if not switch_list:
             """ This means no switch will actually be queried. This happens if
-            none of the switches associated with any of the concrete_preds is
+            none of the switches associated with any of the match entries is
             actually _up_ in the network currently. These data plane counts can
             be transiently or permanently lost as they are fate-shared with
             switches."""
             return False
         self.log.debug('Non-empty query switch list.')
-        for s in switch_list:
-            bucket.add_outstanding_switch_query(s)
-            already_queried = self.add_global_outstanding_query(s, bucket)
-            need_to_query = not already_queried
-            """ Also check if some time has passed since the switch was last
-            queried. """
-            if already_queried:
-                with self.last_queried_time_lock:
-                    if not s in self.last_queried_time:
-                        self.log.error("Did not find the switch in last queried table!!")
-                        self.log.error("Switch %s" % s)
-                        self.log.error("last queried time list: %s" %
-                                       str(self.last_queried_time))
-                    assert s in self.last_queried_time
-                    need_to_query = ((time.time() - self.last_queried_time[s])
-                                       > STATS_REQUERY_THRESHOLD_SEC)
-            if need_to_query:
-                self.request_flow_stats(s)
-                self.add_last_queried_time(s)
-                self.log.debug('in pull_stats: sent out stats query to switch '
-                               + str(s))
-            else:
-                self.log.debug("in pull_stats: didn't send stats req to switch"
-                               + str(s))
+        self.stats_poller.pull(bucket, switch_list,
+                               self.get_stats_preds(entries, switch_list))
         return True
 
+    def get_stats_preds(self, entries, switches):
+        """ For each of `switches`, the narrowest predicate a flow stats
+        request to it can carry while covering the rules of the match
+        `entries` there: the header fields on which all those rules agree, in
+        the form sent to the OpenFlow client. None stands for match-all, which
+        is also used with nicira extensions, where the OpenFlow client does
+        not narrow requests. """
+        if self.use_nx:
+            return dict.fromkeys(switches)
+        common = {} # switch -> items shared by the matches on the switch
+        for me in entries:
+            s = me.rule_match.get('switch')
+            items = set((f, v) for (f, v) in me.rule_match.items()
+                        if f in STATS_MATCH_FIELDS or
+                        f == 'vlan_total_stages')
+            common[s] = common[s] & items if s in common else items
+        preds = {}
+        for s in switches:
+            items = common.get(s, common.get(None))
+            if s in common and None in common:
+                items = items & common[None]
+            pred = dict(items or ())
+            if pred.get('vlan_total_stages') != 1:
+                pred.pop('vlan_id', None)
+            pred.pop('vlan_total_stages', None)
+            if pred.get('ethtype') == IPV6_TYPE:
+                """ IPv6 matches are not OpenFlow 1.0 matches. """
+                pred = {}
+            preds[s] = util.frozendict(dict_to_ascii(pred)) if pred else None
+        return preds
+
     def pull_stats_for_bucket(self,bucket):
         """
         Returns a function that can be used by counting buckets to
         issue queries from the runtime."""
         def pull_bucket_stats():
-            preds = [me.match for me in bucket.matches.keys()]
-            return self.pull_switches_for_preds(preds, bucket)
+            return self.pull_switches_for_preds(bucket.matches.keys(), bucket)
         return pull_bucket_stats
 
     def pull_existing_stats_for_bucket(self,bucket):
@@ -1810,8 +1971,8 @@ class Runtime(object):
         at least one rule that was already created in an earlier classifier.
         """
         def pull_existing_bucket_stats():
-            preds = [me.match for me,ms in bucket.matches.items() if ms.existing_rule]
-            return self.pull_switches_for_preds(preds, bucket)
+            entries = [me for me,ms in bucket.matches.items() if ms.existing_rule]
+            return self.pull_switches_for_preds(entries, bucket)
         return pull_existing_bucket_stats
 
     def add_global_outstanding(self, global_dict, global_lock, key, val):
@@ -1827,41 +1988,21 @@ class Runtime(object):
                 entry_found = True
         return entry_found
 
-    def add_global_outstanding_query(self, s, bucket):
-        return self.add_global_outstanding(self.global_outstanding_queries,
-                                           self.global_outstanding_queries_lock,
-                                           s, bucket)
-
     def add_global_outstanding_delete(self, rule, bucket):
         return self.add_global_outstanding(self.global_outstanding_deletes,
                                            self.global_outstanding_deletes_lock,
                                            rule, bucket)
 
-    def add_last_queried_time(self, s):
-        with self.last_queried_time_lock:
-            self.last_queried_time[s] = time.time()
-
 ####################################
 # PACKET MARSHALLING/UNMARSHALLING 
 ####################################
 
     def concrete2pyretic(self,raw_pkt):
-        packet = get_packet_processor().unpack(raw_pkt['raw'])
+        packet = get_packet_processor().unpack_pyretic(raw_pkt['raw'])
         packet['raw'] = raw_pkt['raw']
         packet['switch'] = raw_pkt['switch']
         packet['port'] = raw_pkt['port']
-
-        def convert(h,val):
-            if h in ['srcmac','dstmac']:
-                return MAC(val)
-            elif h in ['srcip','dstip']:
-                return IP(val)
-            else:
-                return val
-
-        pyretic_packet = Packet(util.frozendict())
-        d = { h : convert(h,v) for (h,v) in packet.items() }
-        return pyretic_packet.modifymany(d)
+        return Packet.from_raw(packet)
 
     def pyretic2concrete(self,packet):
         concrete_packet = {}
@@ -1887,8 +2028,10 @@ class Runtime(object):
             except:
                 pass
 
-        concrete_packet = dict(concrete_packet.items() + virtual_field.expand(headers).items())
-        concrete_packet['raw'] = get_packet_processor().pack(headers)
+        if virtual_field.fields:
+            concrete_packet.update(virtual_field.expand(headers))
+        concrete_packet['raw'] = get_packet_processor().repack(
+            headers, packet.dirty_headers())
         return concrete_packet
 
 #######################
@@ -1933,8 +2076,13 @@ class Runtime(object):
         p.daemon = True
         p.start()
 
-    def request_flow_stats(self,switch):
-        self.backend.send_flow_stats_request(switch)
+    def request_flow_stats(self, switch, table_id=STATS_ALL_TABLES, cookie=0,
+                           cookie_mask=0, pred=None):
+        """ Request the stats of flows on `switch` in table `table_id`, whose
+        cookies agree with `cookie` on the bits of `cookie_mask`, and which
+        are at least as specific as the concrete predicate `pred`. """
+        self.backend.send_flow_stats_request(switch, table_id, cookie,
+                                             cookie_mask, pred)
 
     def inject_discovery_packet(self,dpid, port):
         self.backend.inject_discovery_packet(dpid,port)
@@ -1990,11 +2138,30 @@ class Runtime(object):
         output += '\n\t cookie: \t' + str(flow_stat['cookie'])
         return output
 
-    def handle_flow_stats_reply(self, switch, flow_stats):
+    def handle_flow_stats_reply(self, switch, flow_stats,
+                                scope=FULL_STATS_SCOPE):
+        """ Hand the reply to a flow stats request with the given `scope` (see
+        request_flow_stats, followed by the request's predicate, if any) to
+        the stats poller. Flows outside the cookie scope
+        are dropped, in case the OpenFlow client did not do so. Flows are
+        attributed to buckets by their cookie and priority, so their matches
+        and actions are only parsed for debug logging. """
         self.log.info('received a flow stats reply from switch ' + str(switch))
+        scope = tuple(scope)
+        (_, cookie, cookie_mask) = scope[:3]
+        pred = scope[3] if len(scope) > 3 else None
+        if cookie_mask:
+            flow_stats = [ f for f in flow_stats
+                           if ((f['cookie'] & cookie_mask) ==
+                               (cookie & cookie_mask)) ]
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log_flow_stats_reply(switch, flow_stats)
+        self.stats_poller.handle_reply(switch, flow_stats, scope[:3], pred)
+
+    def log_flow_stats_reply(self, switch, flow_stats):
         flow_stats = [ { f : self.ofp_convert(f,v)
                          for (f,v) in flow_stat.items() }
-                       for flow_stat in flow_stats       ]
+                       for flow_stat in flow_stats ]
         flow_stats = sorted(flow_stats, key=lambda d: -d['priority'])
         self.log.debug(
             '|%s|\n\t%s\n' % (str(datetime.now()),
@@ -2009,15 +2176,6 @@ class Runtime(object):
                                str(f))
                 self.log.debug('packets: ' + str(extracted_pkts) + ' bytes: ' +
                                str(extracted_bytes))
-        buckets_list = []
-        with self.global_outstanding_queries_lock:
-            if switch in self.global_outstanding_queries:
-                buckets_list = self.global_outstanding_queries[switch]
-                del self.global_outstanding_queries[switch]
-            self.log.debug('in stats_reply: outstanding switches is now:' +
-                           str(self.global_outstanding_queries) )
-        for bucket in buckets_list:
-            bucket.handle_flow_stats_reply(switch, flow_stats)
 
     def handle_flow_removed(self, dpid, flow_stat_dict):
         def str_convert_match(m):
@@ -2205,12 +2363,19 @@ class Runtime(object):
 ###############################
 
     def init_path_query(self, path_main, kwargs, partition_cnt, cache_enabled,
-                        edge_contraction_enabled, use_fdd=False, write_log=None):
+                        edge_contraction_enabled, use_fdd=False, write_log=None,
+                        stage_workers=1, max_queries=None,
+                        cost_pack_enabled=False, stage_rule_limit=None):
         """
         Initialization of path query library with optimization parameters.
         * partition_cnt: how many partitions for predicate overlap detection?
         * cache_enabled: is caching of predicates enabled?
         * edge_contraction_enabled: is contraction of DFA edges enabled?
+        * stage_workers: how many processes compile query stages concurrently?
+        * max_queries: how many queries may groupby queries expand into?
+        * cost_pack_enabled: are queries packed into stages by estimated cost?
+        * stage_rule_limit: how many rules per switch may each stage take, when
+          packing by cost? (None for the default)
         """
         self.path_policy = None
         self.us_path_policy = None
@@ -2224,6 +2389,8 @@ class Runtime(object):
         self.path_in_table_list = [DynamicPolicy(identity) for k in range(0,MAX_STAGES)]
         self.path_out_table_list = [DynamicPolicy(identity) for k in range(0,MAX_STAGES)]
         self.path_up_table = DynamicPolicy(drop)
+        self.us_path_queries = set()
+        self.path_stage_key = None
         self.dynamic_sub_path_pols = set()
         self.dynamic_path_preds    = set()
         self.vf_tag_pol = None
@@ -2233,11 +2400,16 @@ class Runtime(object):
         self.path_policy = None
 
         if path_main:
-            from pyretic.lib.path import pathcomp
+            from pyretic.lib.path import pathcomp, STAGE_RULE_LIMIT
+            if stage_rule_limit is None:
+                stage_rule_limit = STAGE_RULE_LIMIT
             pathcomp.init(NUM_PATH_TAGS, self.sw_cnt(),
                           self.cache_enabled, self.edge_contraction_enabled,
                           self.partition_enabled, use_fdd = use_fdd,
-                          write_log=write_log)
+                          write_log=write_log, stage_workers=stage_workers,
+                          max_queries=max_queries,
+                          cost_pack_enabled=cost_pack_enabled,
+                          stage_rule_limit=stage_rule_limit)
             t_s = time.time()
             self.path_policy = path_main(**kwargs)
             self.log.debug("query instantiation time : %f" % (time.time() - t_s))
@@ -2289,6 +2461,217 @@ def extended_values_from(packet):
     return util.frozendict(extended_values)
 
 
+################################################################################
+# Flow Stats Polling
+################################################################################
+
+class stats_poller(object):
+    """ Pulls flow stats from switches on behalf of all counting buckets.
+
+    Each switch is polled at most once per `interval` seconds. Buckets pulling
+    stats while a request to a switch is in flight wait for its reply, and
+    buckets pulling within `interval` of a reply get the cached reply. The
+    request to a switch is scoped (see Runtime.get_stats_scope) to the cookies
+    of all the rules counted there, and narrowed to the predicate given by the
+    pulling bucket (see Runtime.get_stats_preds); requests and replies are
+    shared by the buckets pulling with the same predicate.
+
+    Replies are attributed to buckets through an index from the (switch,
+    cookie, priority) of each counted rule to the buckets counting it. Switch
+    None stands for rules on every switch.
+
+    Requests to each switch are also kept within a `budget` of requests per
+    second (a token bucket holding up to a second's worth); requests over the
+    budget are deferred until it allows them. get_metrics reports the
+    achieved request load, and the staleness of the stats delivered.
+
+    Time is read from `clock`, and deferred requests are scheduled with
+    `timer(delay, function, args)`, which returns a thread to start.
+    """
+    def __init__(self, runtime, interval=STATS_POLL_INTERVAL_SEC,
+                 budget=STATS_REQUEST_BUDGET, clock=time.time, timer=Timer):
+        self.runtime = runtime
+        self.interval = interval
+        self.budget = budget
+        self.clock = clock
+        self.timer = timer
+        self.lock = Lock()
+        self.index = {}
+        self.switch_cookies = {} # switch -> {cookie: number of index keys}
+        self.epochs = {} # switch -> number of index changes on the switch
+        self.in_flight = {} # (switch, scope, pred) -> (time, epoch,
+                            #               {waiting bucket: pull time})
+        self.replies = {} # (switch, pred) -> (time, {bucket: flow stats})
+        self.tokens = {} # switch -> (budget left, time)
+        self.start_time = clock()
+        self.num_requests = 0
+        self.switch_requests = {}
+        self.num_deferred = 0
+        self.num_cached = 0
+        self.num_delivered = 0
+        self.total_staleness = 0.0
+        self.max_staleness = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_rule(self, switch, cookie, priority, bucket):
+        with self.lock:
+            key = (switch, cookie, priority)
+            if not key in self.index:
+                self.index[key] = set()
+                cookies = self.switch_cookies.setdefault(switch, {})
+                cookies[cookie] = cookies.get(cookie, 0) + 1
+            self.index[key].add(bucket)
+            self.invalidate(switch)
+
+    def remove_rule(self, switch, cookie, priority, bucket):
+        with self.lock:
+            key = (switch, cookie, priority)
+            buckets = self.index.get(key)
+            if buckets is None or not bucket in buckets:
+                return
+            buckets.remove(bucket)
+            if not buckets:
+                del self.index[key]
+                cookies = self.switch_cookies[switch]
+                cookies[cookie] -= 1
+                if not cookies[cookie]:
+                    del cookies[cookie]
+            self.invalidate(switch)
+
+    def invalidate(self, switch):
+        """ Forget the cached replies attributed under an outdated index. """
+        if switch is None:
+            for s in set(s for (s, _) in self.replies.keys()):
+                self.epochs[s] = self.epochs.get(s, 0) + 1
+            self.replies = {}
+        else:
+            self.epochs[switch] = self.epochs.get(switch, 0) + 1
+            for key in self.replies.keys():
+                if key[0] == switch:
+                    del self.replies[key]
+
+    def get_scope(self, switch):
+        cookies = set(self.switch_cookies.get(switch, {}).keys())
+        cookies.update(self.switch_cookies.get(None, {}).keys())
+        return self.runtime.get_stats_scope(cookies)
+
+    def pull(self, bucket, switches, preds={}):
+        """ Get the stats of the rules of `bucket` on `switches`, from cached
+        replies if recent enough, else from (shared) flow stats requests,
+        narrowed to the predicates `preds` of the switches, if any. Cached
+        replies are queued on the bucket, which is pulling under its
+        lock, and handled once the pull is over. """
+        for s in switches:
+            bucket.add_outstanding_switch_query(s)
+        now = self.clock()
+        requests = []
+        cached = []
+        with self.lock:
+            for s in switches:
+                pred = preds.get(s)
+                reply = self.replies.get((s, pred))
+                if reply and now - reply[0] < self.interval:
+                    self.num_cached += 1
+                    cached.append((s, reply[1].get(bucket, []),
+                                   now - reply[0]))
+                    continue
+                query = (s, self.get_scope(s), pred)
+                (sent, epoch, waiting) = self.in_flight.get(query, (0, 0, {}))
+                waiting.setdefault(bucket, now)
+                if now - sent > STATS_REPLY_TIMEOUT_SEC:
+                    """ No request in flight, or its reply is lost. """
+                    delay = self.reserve_request(s, now)
+                    self.in_flight[query] = (now + delay,
+                                             self.epochs.get(s, 0), waiting)
+                    requests.append((query, delay))
+                else:
+                    self.in_flight[query] = (sent, epoch, waiting)
+        for (query, delay) in requests:
+            if delay > 0:
+                t = self.timer(delay, self.send_request, (query,))
+                t.daemon = True
+                t.start()
+            else:
+                self.send_request(query)
+        for (s, flow_stats, staleness) in cached:
+            self.record_delivery(staleness, 0.0)
+            bucket.add_pending_flow_stats_reply(s, flow_stats)
+
+    def reserve_request(self, switch, now):
+        """ Take a request to `switch` out of its budget, and return how long
+        the request has to wait for it. """
+        capacity = max(1.0, self.budget)
+        (tokens, last) = self.tokens.get(switch, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * self.budget) - 1
+        self.tokens[switch] = (tokens, now)
+        if tokens >= 0:
+            return 0.0
+        self.num_deferred += 1
+        return -tokens / self.budget
+
+    def send_request(self, query):
+        (s, scope, pred) = query
+        with self.lock:
+            self.num_requests += 1
+            self.switch_requests[s] = self.switch_requests.get(s, 0) + 1
+        self.runtime.request_flow_stats(s, *scope,
+                                        pred=dict(pred.items()) if pred
+                                        else None)
+
+    def record_delivery(self, staleness, latency):
+        """ Account for stats delivered to a bucket `staleness` seconds after
+        they were received, and `latency` seconds after the bucket pulled
+        them. """
+        with self.lock:
+            self.num_delivered += 1
+            self.total_staleness += staleness
+            self.max_staleness = max(self.max_staleness, staleness)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def get_metrics(self):
+        """ Request load and staleness of stats achieved so far: requests
+        (total and per second) per switch, the numbers of requests deferred
+        for the budget and of pulls served from cached replies, and the mean
+        and maximum staleness and latency (see record_delivery) of the stats
+        delivered to buckets. """
+        with self.lock:
+            elapsed = max(self.clock() - self.start_time, 1e-6)
+            n = max(self.num_delivered, 1)
+            return {'requests': dict(self.switch_requests),
+                    'request_rate': { s : c / elapsed for (s, c) in
+                                      self.switch_requests.items() },
+                    'deferred': self.num_deferred,
+                    'cached': self.num_cached,
+                    'delivered': self.num_delivered,
+                    'mean_staleness': self.total_staleness / n,
+                    'max_staleness': self.max_staleness,
+                    'mean_latency': self.total_latency / n,
+                    'max_latency': self.max_latency}
+
+    def handle_reply(self, switch, flow_stats, scope, pred=None):
+        """ Attribute a flow stats reply to every bucket counting its rules,
+        and pass it on to the buckets waiting for it. """
+        attributed = {}
+        with self.lock:
+            for f in flow_stats:
+                for s in (switch, None):
+                    key = (s, f['cookie'], f['priority'])
+                    for bucket in self.index.get(key, ()):
+                        attributed.setdefault(bucket, []).append(f)
+            pred = util.frozendict(pred) if pred else None
+            query = (switch, tuple(scope), pred)
+            if not query in self.in_flight:
+                return
+            (_, epoch, waiting) = self.in_flight.pop(query)
+            now = self.clock()
+            if epoch == self.epochs.get(switch, 0):
+                self.replies[(switch, pred)] = (now, attributed)
+        for (bucket, pull_time) in waiting.items():
+            self.record_delivery(0.0, now - pull_time)
+            bucket.handle_flow_stats_reply(switch, attributed.get(bucket, []))
+
 ################################################################################
 # Concrete Network
 ################################################################################
@@ -2487,12 +2870,56 @@ class ConcreteNetwork(Network):
 ################################################################################
 # Virtual Fields
 ################################################################################
+# Bound on the number of encodings and decodings cached per generation of the
+# virtual fields.
+VF_CACHE_SIZE = 1 << 16
+
+class virtual_field_tables(object):
+    """ Lookup tables for compressing virtual field values into VLAN bits and
+    expanding them back, for one generation of the declared virtual fields.
+
+    The values of the fields of a stage are encoded as a mixed-radix number,
+    with the fields in the order of their names, the last varying fastest.
+    `fields` maps each field name to its (stage, weight in the number of its
+    stage, field, index of None); `stages` maps each stage to its (offset, nbits, number of
+    all None values, [(name, field)] in encoding order). Encodings and
+    decodings are cached as they are computed.
+    """
+    def __init__(self, vcls):
+        self.generation = vcls.generation
+        self.fields = {}
+        self.stages = {}
+        for (stage, vfs) in vcls.stages.iteritems():
+            (offset, nbits) = vcls.stage_offset_nbits[stage]
+            codes = sorted([(vf.name, vf) for vf in vfs])
+            weight = 1
+            none_num = 0
+            for (n, vf) in reversed(codes):
+                none_index = vf.index(None)
+                self.fields[n] = (stage, weight, vf, none_index)
+                none_num += none_index * weight
+                weight *= vf.cardinality
+            self.stages[stage] = (offset, nbits, none_num, codes)
+        self.compressed = {}
+        self.vlans = {}
+        self.expanded = {}
+
+    @classmethod
+    def cache(cls, d, key, value):
+        if len(d) >= VF_CACHE_SIZE:
+            d.clear()
+        d[key] = value
+
 class abstract_virtual_field(object):
-    """ Class members for book-keeping across multiple virtual fields. """
+    """ Class members for book-keeping across multiple virtual fields. The
+    generation counts the changes to the declared fields; lookup tables for
+    compress, map_to_vlan and expand are rebuilt once per generation. """
     fields = {}
     stages = {}
     stage_offset_nbits = {}
     virtual_none = DynamicPolicy(identity)
+    generation = 0
+    tables = None
 
     def __init__(self, name, values, type="string", stage=0):
         self.name   = name
@@ -2501,6 +2928,13 @@ class abstract_virtual_field(object):
         # We need a None value as well
         self.cardinality = len(values) + 1
         self.type   = type
+        self.value_index = {}
+        try:
+            for (i, v) in enumerate(values):
+                self.value_index.setdefault(v, i)
+        except TypeError:
+            # unhashable values are looked up in the list
+            self.value_index = None
         cls = self.__class__
         cls.fields[name] = self
         try:
@@ -2517,8 +2951,42 @@ class abstract_virtual_field(object):
         cls.fields = {}
         cls.stages = {}
         cls.stage_offset_nbits = {}
+        cls.generation += 1
         cls.virtual_none.policy = identity
 
+    @classmethod
+    def remove(cls, name):
+        """ Remove the virtual field `name`, if it exists, e.g., to define it
+        again with new values. Bits of the remaining stages are reallocated,
+        which may move the offsets of other stages. """
+        vf = cls.fields.pop(name, None)
+        if vf is None:
+            return
+        stage_fields = [f for f in cls.stages[vf.stage] if not f is vf]
+        if stage_fields:
+            cls.stages[vf.stage] = stage_fields
+        else:
+            del cls.stages[vf.stage]
+        cls.allocate_stage_bits()
+        if cls.stages:
+            cls.reset_virtual_none()
+        else:
+            cls.virtual_none.policy = identity
+
+    @classmethod
+    def get_tables(cls):
+        """ The lookup tables for the current generation of fields. """
+        tables = cls.tables
+        if tables is None or tables.generation != cls.generation:
+            tables = cls.tables = virtual_field_tables(cls)
+        return tables
+
+    @classmethod
+    def get_generations(cls):
+        """ The generations of the fields of both virtual field classes, which
+        change whenever the translation of virtual fields may change. """
+        return (virtual_field.generation, virtual_virtual_field.generation)
+
     @classmethod
     def get_class(cls, name):
         if name in virtual_field.fields:
@@ -2545,8 +3013,13 @@ class abstract_virtual_field(object):
             nbits = int(math.ceil(math.log(num_total_values, 2)))
             cls.stage_offset_nbits[s] = (bit_offset, nbits)
             bit_offset += nbits
+        cls.generation += 1
 
     def index(self,key):
+        try:
+            return self.value_index[key]
+        except (KeyError, TypeError):
+            pass
         try:
             return self.values.index(key)
         except ValueError as e:
@@ -2564,89 +3037,83 @@ class abstract_virtual_field(object):
 
     @classmethod
     def compress(cls,fields):
-        virtual_fields = cls.fields
-        vf_names       = virtual_fields.keys()
+        tables = cls.get_tables()
+        try:
+            key = frozenset(fields.iteritems())
+            return tables.compressed[key]
+        except KeyError:
+            pass
+        except TypeError:
+            key = None
 
-        undeclared_vfs = set(fields.keys()) - set(vf_names)
+        undeclared_vfs = [n for n in fields if not n in tables.fields]
         if undeclared_vfs:
             raise RuntimeError("Detected use of undefined fields: %s" %
-                               str(undeclared_vfs))
-
-        def vhs_to_num(fields):
-            vheaders = dict(filter(lambda a: a[0] in vf_names, fields.iteritems()))
-            # If we there are no virtual_fields specified we wouldn't want to match on them at all
-            # Just return -1 so that calling function knows that the predicate doesn't have any virtual
-            # fields on it
-            if len(vheaders) == 0: return (-1, 0, 0)
-            stages = set()
-
-            for n in vf_names:
-                if n not in vheaders:
-                    vheaders[n] = None
-                else:
-                    stages.add(virtual_fields[n].stage)
-            if len(stages) != 1:
-                raise RuntimeError("Can't compile virtual headers from different"
-                                   " stages together!")
-            active_stage = list(stages)[0]
-
-            # sort the field name list to have deterministic ordering by field
-            # name
-            field_list = sorted(virtual_fields.items(), key=lambda z: z[0])
-            ret = 0
-            for n,vf in field_list:
-                if virtual_fields[n].stage == active_stage:
-                    ret *= vf.cardinality
-                    ret += vf.index(vheaders[n])
-
-            (offset, nbits) = cls.stage_offset_nbits[active_stage]
-            # shift virtual headers into position
-            ret = ret << offset
-            return (ret, offset, nbits)
-        return vhs_to_num(fields)
+                               str(set(undeclared_vfs)))
+
+        # If we there are no virtual_fields specified we wouldn't want to match on them at all
+        # Just return -1 so that calling function knows that the predicate doesn't have any virtual
+        # fields on it
+        if len(fields) == 0:
+            return (-1, 0, 0)
+        stages = set([tables.fields[n][0] for n in fields])
+        if len(stages) != 1:
+            raise RuntimeError("Can't compile virtual headers from different"
+                               " stages together!")
+        (offset, nbits, ret, _) = tables.stages[stages.pop()]
+        # Start from the number of all None values, and replace the values of
+        # the given fields.
+        for (n, v) in fields.iteritems():
+            (_, weight, vf, none_index) = tables.fields[n]
+            ret += (vf.index(v) - none_index) * weight
+        # shift virtual headers into position
+        res = (ret << offset, offset, nbits)
+        if key is not None:
+            tables.cache(tables.compressed, key, res)
+        return res
 
     @classmethod
     def expand(cls,fields):
         if 'vlan_id' not in fields:
             return {}
 
-        virtual_fields = cls.fields
-        vf_names       = virtual_fields.keys()
         num = (fields['vlan_pcp'] << 12) + fields['vlan_id']
+        tables = cls.get_tables()
+        try:
+            return dict(tables.expanded[num])
+        except KeyError:
+            pass
 
-        def num_to_vhs(num):
-            # If we there are no virtual_fields specified we wouldn't want to match on them at all
-            # Just return -1 so that calling function knows that the predicate doesn't have any virtual
-            # fields on it
-            vfs = {}
-            for stage in cls.stages.keys():
-                (offset, nbits) = cls.stage_offset_nbits[stage]
-                tmp = (num >> offset) & ((1 << nbits) - 1)
-                # sort the field name list to have deterministic ordering by
-                # field name
-                field_list = sorted(virtual_fields.items(), key=lambda z:z[0])
-                for n,vf in reversed(field_list):
-                    if vf.stage == stage:
-                        val    = tmp % vf.cardinality
-                        tmp    = tmp / vf.cardinality
-                        vfs[n] = vf.value(val)
-
-            return vfs
-        return num_to_vhs(num)
+        vfs = {}
+        for (offset, nbits, _, codes) in tables.stages.itervalues():
+            tmp = (num >> offset) & ((1 << nbits) - 1)
+            for (n, vf) in reversed(codes):
+                val    = tmp % vf.cardinality
+                tmp    = tmp / vf.cardinality
+                vfs[n] = vf.value(val)
+        tables.cache(tables.expanded, num, vfs)
+        return dict(vfs)
 
     @classmethod
     def map_to_vlan(cls,compressed):
         (num, offset, nbits) = compressed
         if num == -1: return {}
+        tables = cls.get_tables()
+        try:
+            return dict(tables.vlans[compressed])
+        except KeyError:
+            pass
         if num > (1 << 15):
             raise RuntimeError("Too many virtual values to stuff into VLAN.")
-        return {
+        vlan = {
             "vlan_id" : 0b000111111111111 & num,
             "vlan_pcp": (0b111000000000000 & num) >> 12,
             "vlan_offset": offset,
             "vlan_nbits": nbits,
             "vlan_total_stages": len(cls.stages.keys())
         }
+        tables.cache(tables.vlans, compressed, vlan)
+        return dict(vlan)
 
     @classmethod
     def reset_virtual_none(cls):
@@ -2668,6 +3135,8 @@ class virtual_field(abstract_virtual_field):
     stages = {}
     stage_offset_nbits = {}
     virtual_none = DynamicPolicy(identity)
+    generation = 0
+    tables = None
 
 class virtual_virtual_field(abstract_virtual_field):
     """ Keeping the virtual fields which don't make it to the data plane
@@ -2676,3 +3145,5 @@ class virtual_virtual_field(abstract_virtual_field):
     stages = {}
     stage_offset_nbits = {}
     virtual_none = DynamicPolicy(identity)
+    generation = 0
+    tables = None
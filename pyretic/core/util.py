@@ -62,6 +62,12 @@ def cached(f):
     return wrapper
 
 class frozendict(object):
+    """
+    An immutable dictionary. Updates return a new frozendict, copying the
+    dictionary once. The hash (the XOR of the hashes of the items) is carried
+    over incrementally to frozendicts derived from a hashed one, rehashing only
+    the items that changed.
+    """
     __slots__ = ["_dict", "_cached_hash"]
 
     def __init__(self, new_dict=None, **kwargs):
@@ -71,26 +77,44 @@ class frozendict(object):
         self._dict.update(kwargs)
 
     def update(self, new_dict=None, **kwargs):
-        d = self._dict.copy()
-        
-        if new_dict is not None:
-            d.update(new_dict)    
-        d.update(kwargs)
-        
-        return self.__class__(d)
+        return self.update_remove(new_dict, (), **kwargs)
 
     def remove(self, ks):
-        d = self._dict.copy()
-        for k in ks:
-            if k in d:
-                del d[k]
-        return self.__class__(d)
+        return self.update_remove(None, ks)
+
+    def update_remove(self, new_dict, ks, **kwargs):
+        """ Update with `new_dict` and `kwargs`, then remove the keys `ks`. """
+        changes = {} if new_dict is None else dict(new_dict)
+        changes.update(kwargs)
+        old = self._dict
+        d = old.copy()
+        d.update(changes)
+        removed = set(k for k in ks if k in d)
+        for k in removed:
+            del d[k]
+
+        res = object.__new__(self.__class__)
+        res._dict = d
+        try:
+            h = self._cached_hash
+        except AttributeError:
+            return res
+        for (k, v) in changes.iteritems():
+            if k in old:
+                h ^= hash((k, old[k]))
+            if not k in removed:
+                h ^= hash((k, v))
+        for k in removed:
+            if k in old and not k in changes:
+                h ^= hash((k, old[k]))
+        res._cached_hash = h
+        return res
         
     def pop(self, *ks):
         result = []
         for k in ks:
             result.append(self[k])
-        result.append(self.remove(*ks))
+        result.append(self.remove(ks))
         return result
       
     def __repr__(self):
@@ -130,7 +154,10 @@ class frozendict(object):
         try:
             return self._cached_hash
         except AttributeError:
-            h = self._cached_hash = hash(frozenset(self._dict.items()))
+            h = 0
+            for item in self._dict.iteritems():
+                h ^= hash(item)
+            self._cached_hash = h
             return h
         
     def __eq__(self, other):
@@ -142,6 +169,12 @@ class frozendict(object):
     def __len__(self):
         return len(self._dict)
 
+    def __getstate__(self):
+        return self._dict
+
+    def __setstate__(self, state):
+        self._dict = state
+
 
 def indent_str(s, indent=4):
     return "\n".join(indent * " " + i for i in s.splitlines())
@@ -20,7 +20,8 @@
 
 from argparse import ArgumentParser
 from socket import gethostbyname
-from os import getuid
+from os import getuid, path
+from tempfile import gettempdir
 
 from mininet.log import lg, info
 from mininet.cli import CLI
@@ -41,13 +42,15 @@ class StanfordTopo( Topo ):
     DUMMY_SWITCH_BASE = 1000
     
     PORT_MAP_FILENAME = "pyretic/evaluations/data/port_map.txt"
+    # Graphviz rendering of the switch graph, written along the way
+    DOT_FILENAME = path.join(gettempdir(), "topo.txt")
     TOPO_FILENAME = "pyretic/evaluations/data/backbone_topology.tf"
     
     dummy_switches = set()
 
     def __init__( self ):
         # Read topology info
-        f = open('topo.txt', 'w')
+        f = open(self.DOT_FILENAME, 'w')
         f.write('graph stanford {\n')
         
         ports = self.load_ports(self.PORT_MAP_FILENAME)        
@@ -125,7 +128,7 @@ class StanfordTopo( Topo ):
         @param ports port info from the file
         ''' 
         # First pass, find special ports with more than 1 peer port
-        f = open('topo.txt', 'a') 
+        f = open(self.DOT_FILENAME, 'a') 
         first_pass = {}
         for (src_port_flat, dst_port_flat) in links:
             src_dpid = src_port_flat / self.SWITCH_ID_MULTIPLIER
@@ -33,12 +33,17 @@ class eval_compilation:
         self.edge_contraction_enabled = args.edge_contraction_enabled
         self.preddecomp_enabled = args.preddecomp_enabled
         self.use_pyretic = args.use_pyretic 
+        self.use_fdd_compiler = args.use_fdd_compiler
+        self.local_netkat = args.local_netkat
         if args.write_log:
             self.write_log = args.write_log
         else:
             self.write_log = os.path.join('pyretic/evaluations',
                                           self.results_folder, 'rt_log.txt')
         self.use_fdd = args.use_fdd
+        self.stage_workers = args.stage_workers
+        self.cost_pack_enabled = args.cost_pack_enabled
+        self.stage_rule_limit = args.stage_rule_limit
         
         opt_flags = (self.disjoint_enabled, self.default_enabled, 
                      self.integrate_enabled, self.multitable_enabled,
@@ -49,7 +54,12 @@ class eval_compilation:
                      )
         """ Start the frenetic compiler-server """
         netkat_out = None
-        if not self.use_pyretic:
+        local_server = None
+        local_compile = self.use_pyretic or self.use_fdd_compiler
+        if not local_compile and self.local_netkat:
+            from pyretic.core.netkat_server import start_local_server
+            local_server = start_local_server()
+        elif not local_compile:
             netkat_cmd = "bash ~/pyretic/start-frenetic.sh"
             try:
                 netkat_out = subprocess.Popen(netkat_cmd, shell=True,
@@ -59,16 +69,25 @@ class eval_compilation:
                 print e
                 sys.exit(1)
         
-        Stat.start(self.results_folder, (self.disjoint_enabled, self.integrate_enabled, self.multitable_enabled, self.ragel_enabled))
-        self.runtime = Runtime(None, eval_path.main, eval_path.path_main, kwargs,
-                               opt_flags = opt_flags, mode = 'proactive0',
-                               use_pyretic = self.use_pyretic, use_fdd = self.use_fdd,
-                               offline=True,
-                               write_log = self.write_log, restart_frenetic = False)
-        Stat.stop()
-        if netkat_out:
-            netkat_out.kill()
-        self.kill_netkat_server()
+        try:
+            Stat.start(self.results_folder, (self.disjoint_enabled, self.integrate_enabled, self.multitable_enabled, self.ragel_enabled))
+            self.runtime = Runtime(None, eval_path.main, eval_path.path_main, kwargs,
+                                   opt_flags = opt_flags, mode = 'proactive0',
+                                   use_pyretic = self.use_pyretic, use_fdd = self.use_fdd,
+                                   use_fdd_compiler = self.use_fdd_compiler,
+                                   offline=True, stage_workers = self.stage_workers,
+                                   cost_pack_enabled = self.cost_pack_enabled,
+                                   stage_rule_limit = self.stage_rule_limit,
+                                   write_log = self.write_log, restart_frenetic = False)
+            Stat.stop()
+        finally:
+            if local_server:
+                local_server.shutdown()
+                local_server.server_close()
+            else:
+                if netkat_out:
+                    netkat_out.kill()
+                self.kill_netkat_server()
 
     def kill_netkat_server(self):
         print "Killing frenetic.."
@@ -178,11 +197,31 @@ def parse_args():
     parser.add_argument('--use_pyretic', action="store_true",
                     dest = 'use_pyretic',
                     help = 'Use the pyretic compiler (uses netkat by default)')
+    parser.add_argument('--use_fdd_compiler', action="store_true",
+                    dest = 'use_fdd_compiler',
+                    help = 'Use the in-process FDD compiler (uses netkat by '
+                    'default)')
+    parser.add_argument('--local_netkat', action="store_true",
+                    dest = 'local_netkat',
+                    help = 'Serve netkat compilation requests from the local '
+                    'in-process compile server instead of frenetic')
     parser.add_argument('--write_log', dest="write_log",
                         help = "Runtime write log file location")
     parser.add_argument('--use_fdd', action="store_true",
                     dest = 'use_fdd',
                     help = 'Use FDD for predicate decomposition')
+    parser.add_argument('--stage_workers', type = int, default = 1,
+                    dest = 'stage_workers',
+                    help = 'Number of processes compiling path query stages '
+                    'concurrently (1 compiles them serially)')
+    parser.add_argument('--enable_cost_pack', action="store_true",
+                    dest = 'cost_pack_enabled',
+                    help = 'Pack path queries into stages by their estimated '
+                    'rule cost (with --enable_preddecomp)')
+    parser.add_argument('--stage_rule_limit', type = int,
+                    dest = 'stage_rule_limit',
+                    help = 'Per-switch rule budget of each path query stage, '
+                    'with --enable_cost_pack')
 
     args = parser.parse_args()
 
@@ -0,0 +1,124 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+
+"""
+Compare the FDD compiler (pyretic.lib.fdd) with the classifier compiler
+(Policy.compile) and, optionally, the NetKAT compiler on the forwarding
+policies of the evaluations/Tests workloads. Each workload is set up in an
+offline runtime, and the resulting policy is compiled afresh by each backend.
+
+  python -m pyretic.evaluations.eval_fdd_compile -t dumbbell_congested \\
+      e2e_stanford slice_isolation
+  python -m pyretic.evaluations.eval_fdd_compile -t path_packet_loss \\
+      --params k=4 --netkat --local_netkat
+
+Workloads that cannot be set up are reported, and skipped.
+"""
+
+import time
+import argparse
+import traceback
+
+from pyretic.core.runtime import Runtime
+from pyretic.core.language_tools import ast_map, default_mapper
+from pyretic.lib.path import FDDTranslator
+from pyretic.lib.fdd import fdd_compile
+from pyretic.evaluations import eval_path
+
+OPT_FLAGS = (False, False, False, False, True, False, None, False, False,
+             False)
+
+def setup_policy(test, params, write_log):
+    # The runtime compiles the policy once while starting up; use the FDD
+    # compiler, so that no backend is timed on policies it has cached.
+    kwargs = dict(params)
+    kwargs['test'] = test
+    rt = Runtime(None, eval_path.main, eval_path.path_main, kwargs,
+                 opt_flags=OPT_FLAGS, mode='proactive0',
+                 use_fdd_compiler=True, offline=True, write_log=write_log)
+    return (rt.policy, rt.sw_cnt())
+
+def time_classifier(pol):
+    # Copy the policy so that no classifiers cached on it are reused.
+    pol = ast_map(default_mapper, pol)
+    t_s = time.time()
+    c = pol.compile()
+    return (time.time() - t_s, len(c))
+
+def time_fdd(pol):
+    FDDTranslator.clear_caches()
+    t_s = time.time()
+    c = fdd_compile(pol)
+    return (time.time() - t_s, len(c))
+
+def time_netkat(pol, sw_cnt):
+    t_s = time.time()
+    (c, _) = pol.netkat_compile(sw_cnt, force_compile=True)
+    return (time.time() - t_s, len(c))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the FDD, "
+                                     "classifier and NetKAT compilers")
+    parser.add_argument('--tests', '-t', nargs='+',
+                        default=['dumbbell_congested', 'e2e_stanford',
+                                 'slice_isolation'],
+                        help='Workloads in pyretic/evaluations/Tests')
+    parser.add_argument('--params', '-p', nargs='*', default=[],
+                        help='Workload parameters, as key=value')
+    parser.add_argument('--netkat', action="store_true",
+                        help='Also compile with the NetKAT compile server')
+    parser.add_argument('--local_netkat', action="store_true",
+                        help='Start the local in-process NetKAT compile '
+                        'server (implies --netkat)')
+    parser.add_argument('--write_log', default='/tmp/eval_fdd_compile.log',
+                        help='Runtime write log file location')
+    args = parser.parse_args()
+
+    if args.local_netkat:
+        from pyretic.core.netkat_server import start_local_server
+        start_local_server()
+        args.netkat = True
+    params = [p.split('=', 1) for p in args.params]
+
+    backends = ['fdd', 'classifier'] + (['netkat'] if args.netkat else [])
+    print "test\t" + "\t".join(["%s(s)\t%s rules" % (b, b) for b in backends])
+    for test in args.tests:
+        try:
+            (pol, sw_cnt) = setup_policy(test, params, args.write_log)
+        except Exception as e:
+            print "%s\tskipped: %s" % (test, traceback.format_exc().strip()
+                                       .split('\n')[-1])
+            continue
+        res = [time_fdd(pol), time_classifier(pol)]
+        if args.netkat:
+            res.append(time_netkat(pol, sw_cnt))
+        print test + "\t" + "\t".join(["%f\t%d" % r for r in res])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Benchmark the evaluation of policies on packets, in packets per second: by
+the interpreter (Policy.eval), and by the compiled classifier
+(Classifier.eval), along with the cost of modifying and hashing packets
+(pyretic.core.util.frozendict), on the packets of pcap files.
+
+  python -m pyretic.evaluations.eval_packet_eval
+  python -m pyretic.evaluations.eval_packet_eval -n 64 -r 20
+"""
+
+import time
+import argparse
+
+from pyretic.core.language import *
+from pyretic.core.network import IP, MAC
+from pyretic.evaluations.eval_packet_parse import (read_pcap,
+                                                   fast_concrete2pyretic)
+
+def gen_policy(num_hosts):
+    """ Forward to `num_hosts` hosts by destination IP, rewriting the
+    destination MAC, and mark the traffic of a subnet. """
+    fwd_pol = parallel([match(dstip=IP('10.0.0.%d' % i)) >>
+                        modify(dstmac=MAC('00:00:00:00:00:%02x' % i),
+                               port=i)
+                        for i in range(1, num_hosts + 1)])
+    mark = match(srcip='10.0.0.0/28') >> modify(tos=4, port=1)
+    return (match(switch=1) >> fwd_pol) + mark
+
+def gen_packets(files, num_hosts):
+    pkts = []
+    for f in files:
+        for (i, raw) in enumerate(read_pcap(f)):
+            pkt = fast_concrete2pyretic({'raw': raw, 'switch': 1, 'port': 1})
+            pkts.append(pkt.modify(srcip=IP('10.0.0.%d' % (i % 32 + 1)),
+                                   dstip=IP('10.0.0.%d' % (i % num_hosts +
+                                                           1))))
+    return pkts
+
+def run(evaluate, pkts, rounds):
+    t_s = time.time()
+    for i in xrange(rounds):
+        for pkt in pkts:
+            evaluate(pkt)
+    return (rounds * len(pkts)) / (time.time() - t_s)
+
+def modify_hash(pkt):
+    return hash(pkt.modify(port=2, outport=3))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation "
+                                     "of policies on packets")
+    parser.add_argument('--files', '-f', nargs='+',
+                        default=['pyretic/scratch/testpcap.pcap',
+                                 'pyretic/scratch/vlantest.pcap'],
+                        help='pcap files of packets to evaluate')
+    parser.add_argument('--num_hosts', '-n', type=int, default=16,
+                        help='Number of hosts forwarded to')
+    parser.add_argument('--rounds', '-r', type=int, default=5,
+                        help='Number of evaluations of each packet')
+    args = parser.parse_args()
+
+    policy = gen_policy(args.num_hosts)
+    classifier = policy.compile()
+    pkts = gen_packets(args.files, args.num_hosts)
+    for pkt in pkts:
+        hash(pkt)
+    assert all(policy.eval(p) == classifier.eval(p) for p in pkts)
+    print "packets: %d, headers per packet: %d, classifier rules: %d" % (
+        len(pkts), max(len(p.header) for p in pkts), len(classifier.rules))
+    print "evaluation\tpkts/s"
+    print "modify+hash\t%f" % run(modify_hash, pkts, args.rounds * 10)
+    print "interpreter\t%f" % run(policy.eval, pkts, args.rounds)
+    print "classifier\t%f" % run(classifier.eval, pkts, args.rounds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Benchmark the conversion of packet-ins to pyretic packets (as in
+Runtime.concrete2pyretic), in packets per second, over the packets of pcap
+files: decoding every packet with ryu, against the struct-based fast path of
+pyretic.core.packet.parse_headers. Then benchmark the conversion of the
+packets back to raw packets for packet-outs (as in Runtime.pyretic2concrete),
+after forwarding them (rewriting the port) and after rewriting their
+destination: packing every packet with ryu, against writing only the dirty
+headers of the packet (pyretic.core.packet.patch_headers).
+
+  python -m pyretic.evaluations.eval_packet_parse
+  python -m pyretic.evaluations.eval_packet_parse -f pyretic/scratch/vlantest.pcap -r 20
+"""
+
+import struct
+import time
+import argparse
+
+from pyretic.core import util
+from pyretic.core.packet import Packet, get_packet_processor, parse_headers
+from pyretic.core.network import IP, MAC
+
+PCAP_MAGIC = 0xa1b2c3d4
+
+def read_pcap(filename):
+    """ The raw packets in pcap file `filename`. """
+    data = open(filename, 'rb').read()
+    (magic,) = struct.unpack('<I', data[:4])
+    endian = '<' if magic == PCAP_MAGIC else '>'
+    record = struct.Struct(endian + 'IIII')
+    offset = 24
+    packets = []
+    while offset + record.size <= len(data):
+        (_, _, incl_len, _) = record.unpack_from(data, offset)
+        offset += record.size
+        packets.append(data[offset:offset+incl_len])
+        offset += incl_len
+    return packets
+
+def ryu_concrete2pyretic(raw_pkt):
+    """ Packet-in conversion decoding all packets with ryu. """
+    packet = get_packet_processor().unpack(raw_pkt['raw'])
+    packet['raw'] = raw_pkt['raw']
+    packet['switch'] = raw_pkt['switch']
+    packet['port'] = raw_pkt['port']
+
+    def convert(h,val):
+        if h in ['srcmac','dstmac']:
+            return MAC(val)
+        elif h in ['srcip','dstip']:
+            return IP(val)
+        else:
+            return val
+
+    pyretic_packet = Packet(util.frozendict())
+    d = { h : convert(h,v) for (h,v) in packet.items() }
+    return pyretic_packet.modifymany(d)
+
+def fast_concrete2pyretic(raw_pkt):
+    """ Packet-in conversion as in Runtime.concrete2pyretic. """
+    packet = get_packet_processor().unpack_pyretic(raw_pkt['raw'])
+    packet['raw'] = raw_pkt['raw']
+    packet['switch'] = raw_pkt['switch']
+    packet['port'] = raw_pkt['port']
+    return Packet.from_raw(packet)
+
+def fwd(pkt):
+    return pkt.modify(port=2)
+
+def rewrite_dst(pkt):
+    return pkt.modify(port=2, dstmac=MAC('00:00:00:00:00:99'),
+                      dstip=IP('10.0.0.99'))
+
+def ryu_pyretic2concrete(pkt):
+    """ Packet-out conversion packing all packets with ryu. """
+    return get_packet_processor().pack(dict(pkt.header))
+
+def fast_pyretic2concrete(pkt):
+    """ Packet-out conversion as in Runtime.pyretic2concrete. """
+    return get_packet_processor().repack(dict(pkt.header),
+                                         pkt.dirty_headers())
+
+def run(convert, corpus, rounds):
+    t_s = time.time()
+    for i in xrange(rounds):
+        for raw_pkt in corpus:
+            convert(raw_pkt)
+    return (rounds * len(corpus)) / (time.time() - t_s)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark packet-in "
+                                     "conversion to pyretic packets")
+    parser.add_argument('--files', '-f', nargs='+',
+                        default=['pyretic/scratch/testpcap.pcap',
+                                 'pyretic/scratch/vlantest.pcap'],
+                        help='pcap files of packets to convert')
+    parser.add_argument('--rounds', '-r', type=int, default=10,
+                        help='Number of conversions of each packet')
+    args = parser.parse_args()
+
+    corpus = []
+    for f in args.files:
+        corpus += [{'raw': raw, 'switch': 1, 'port': 1}
+                   for raw in read_pcap(f)]
+    num_fast = len([p for p in corpus if not parse_headers(p['raw']) is None])
+    mismatches = len([p for p in corpus if fast_concrete2pyretic(p) !=
+                      ryu_concrete2pyretic(p)])
+    print "packets: %d, fast path: %d, mismatches: %d" % (len(corpus),
+                                                          num_fast, mismatches)
+    print "parser\tpkts/s"
+    print "ryu\t%f" % run(ryu_concrete2pyretic, corpus, args.rounds)
+    print "fast\t%f" % run(fast_concrete2pyretic, corpus, args.rounds)
+
+    print "policy\tpacker\tpkts/s"
+    for policy in [fwd, rewrite_dst]:
+        pkts = [policy(fast_concrete2pyretic(p)) for p in corpus]
+        for (name, convert) in [('ryu', ryu_pyretic2concrete),
+                                ('fast', fast_pyretic2concrete)]:
+            print "%s\t%s\t%f" % (policy.__name__, name,
+                                   run(convert, pkts, args.rounds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Benchmark predicate partitioning (re_tree_gen.get_re_tree, or the FDD-based
+fdd_re_tree_gen with --use_fdd) for growing numbers of atom predicates.
+Predicates pin a switch and a port, like those of typical path queries, with a
+fraction of them overlapping on header fields.
+
+  python -m pyretic.evaluations.eval_pred_part -n 1000 5000 10000 50000
+  python -m pyretic.evaluations.eval_pred_part -n 1000 --no_index
+  python -m pyretic.evaluations.eval_pred_part -n 1000 5000 --use_fdd
+"""
+
+import random
+import time
+import argparse
+
+from pyretic.core.language import match
+from pyretic.lib.path import (re_tree_gen, __in_re_tree_gen__, __in__,
+                              __fdd_in_re_tree_gen__, classifier_utils,
+                              FDDTranslator)
+
+def gen_preds(num_preds, num_ports, overlap, seed):
+    """ Generate `num_preds` distinct predicates pinning a switch and port.
+    A fraction `overlap` of them are split further by source IP prefixes that
+    intersect each other. """
+    rand = random.Random(seed)
+    preds = []
+    num_switches = max(1, num_preds / num_ports)
+    for i in range(num_preds):
+        (sw, port) = (i / num_ports + 1, i % num_ports + 1)
+        if rand.random() < overlap:
+            sw = rand.randint(1, num_switches)
+            plen = rand.choice([8, 16, 24])
+            pfx = '10.%d.%d.0/%d' % (rand.randint(0, 3), rand.randint(0, 3),
+                                     plen)
+            preds.append(match(switch=sw, port=port, srcip=pfx))
+        else:
+            preds.append(match(switch=sw, port=port))
+    return preds
+
+def run(num_preds, num_ports, overlap, index_enabled, seed):
+    re_tree_gen.pred_index_enabled = index_enabled
+    classifier_utils.__set_init_vars__(False)
+    cg = __in_re_tree_gen__()
+    cg.clear()
+    preds = gen_preds(num_preds, num_ports, overlap, seed)
+    t_s = time.time()
+    for p in preds:
+        __in__(p).gen_re_tree(cg)
+    first = time.time() - t_s
+    ''' Partition the same predicates again, as on a recompilation. '''
+    cg.clear()
+    t_s = time.time()
+    for p in preds:
+        __in__(p).gen_re_tree(cg)
+    second = time.time() - t_s
+    return (len(cg.get_symlist()), first, second)
+
+def run_fdd(num_preds, num_ports, overlap, seed):
+    classifier_utils.__set_init_vars__(False)
+    cg = __fdd_in_re_tree_gen__()
+    preds = gen_preds(num_preds, num_ports, overlap, seed)
+    times = []
+    for i in range(2):
+        cg.clear()
+        t_s = time.time()
+        for p in preds:
+            __in__(p).add_to_fdd(cg)
+        cg.prep_re_tree()
+        times.append(time.time() - t_s)
+    return (len(cg.symbol_to_pred), times[0], times[1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark predicate "
+                                     "partitioning of path query atoms")
+    parser.add_argument('--num_preds', '-n', type=int, nargs='+',
+                        default=[1000, 5000, 10000, 50000],
+                        help='Numbers of atom predicates to partition')
+    parser.add_argument('--num_ports', '-p', type=int, default=16,
+                        help='Ports per switch')
+    parser.add_argument('--overlap', '-o', type=float, default=0.1,
+                        help='Fraction of predicates that overlap others')
+    parser.add_argument('--no_index', action="store_true",
+                        help='Check every existing predicate for overlaps')
+    parser.add_argument('--use_fdd', action="store_true",
+                        help='Partition using forwarding decision diagrams')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print "preds\tleaves\tfirst(s)\trecompile(s)"
+    for n in args.num_preds:
+        if args.use_fdd:
+            FDDTranslator.clear_caches()
+            (leaves, first, second) = run_fdd(n, args.num_ports, args.overlap,
+                                              args.seed)
+        else:
+            classifier_utils.overlap_cache = {}
+            (leaves, first, second) = run(n, args.num_ports, args.overlap,
+                                          not args.no_index, args.seed)
+        print "%d\t%d\t%f\t%f" % (n, leaves, first, second)
+    if args.use_fdd:
+        print "fdd nodes: %d, apply cache hit rate: %f" % (
+            FDDTranslator.get_num_nodes(), FDDTranslator.get_cache_hit_rate())
+
+if __name__ == '__main__':
+    main()
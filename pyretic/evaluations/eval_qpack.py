@@ -0,0 +1,152 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Compare the packers of path queries into stages (pack_queries_stagelimited,
+the rule-limited pack_queries, and the cost-model-driven pack_queries_cost)
+on the path queries of the evaluations/Tests workloads. For each packer,
+report the number of stages, the rules and tag bits estimated by the cost
+model (see pyretic.lib.path.stage_cost), and, with --compile, the rules of the
+compiled stage tables.
+
+  python -m pyretic.evaluations.eval_qpack -t path_packet_loss \\
+      --params k=24 fout=2
+  python -m pyretic.evaluations.eval_qpack -t path_packet_loss \\
+      --params k=4 fout=2 --rule_limit 20 --compile
+
+The queries are built straight from the workloads' path_main, without
+compiling the workloads in a runtime. Workloads that cannot be set up are
+reported, and skipped.
+"""
+
+import time
+import logging
+import argparse
+import traceback
+
+from pyretic.core.runtime import virtual_field
+from pyretic.lib.path import *
+from pyretic.evaluations import eval_path
+
+PACKERS = ['stagelimited', 'rulelimited', 'cost']
+
+def setup_queries(test, params):
+    kwargs = dict(params)
+    kwargs['test'] = test
+    path_pol = eval_path.path_main(**kwargs)
+    return list(path_grouping.iter_expand_groupby(path_pol))
+
+def pack_with(packer, queries, numstages, rule_limit):
+    if packer == 'stagelimited':
+        return pack_queries_stagelimited(queries, numstages)
+    elif packer == 'rulelimited':
+        return pack_queries(queries, rule_limit)
+    elif packer == 'cost':
+        return pack_queries_cost(queries, numstages, rule_limit)
+    raise ValueError("unknown packer %s" % packer)
+
+def estimate(stages):
+    """ Total rules and tag bits of `stages`, estimated by the cost model. """
+    rules = 0
+    bits = 0
+    for qs in stages.values():
+        costs = [stage_cost.of_query(q) for q in iter_stage_queries(qs)
+                 if not isinstance(q, path_empty)]
+        if costs:
+            c = reduce(lambda acc, x: acc.join(x), costs)
+            rules += c.rules()
+            bits += c.tag_bits()
+    return (rules, bits)
+
+def compiled_rules(stages):
+    kwargs = {'max_states': NUM_PATH_TAGS, 'disjoint_enabled': False,
+              'default_enabled': False, 'integrate_enabled': True,
+              'ragel_enabled': True, 'match_enabled': False}
+    # Only the tag fields of these stages should take up header bits.
+    virtual_field.clear()
+    results = pathcomp.compile_stages(sorted(stages.items()), kwargs)
+    rules = 0
+    for (tables, _) in results:
+        for t in tables:
+            rules += len(t.compile().rules)
+    return rules
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare packers of path "
+                                     "queries into stages")
+    parser.add_argument('--tests', '-t', nargs='+',
+                        default=['path_packet_loss'],
+                        help='Workloads in pyretic/evaluations/Tests')
+    parser.add_argument('--params', '-p', nargs='*', default=['k=24',
+                                                              'fout=2'],
+                        help='Workload parameters, as key=value')
+    parser.add_argument('--numstages', '-n', type=int, default=MAX_STAGES,
+                        help='Maximum number of stages')
+    parser.add_argument('--rule_limit', '-r', type=int,
+                        default=STAGE_RULE_LIMIT,
+                        help='Per-switch rule budget of each stage')
+    parser.add_argument('--compile', action="store_true",
+                        help='Also compile the stages and count their rules')
+    parser.add_argument('--write_log', default='/tmp/eval_qpack.log',
+                        help='Path compilation write log file location')
+    args = parser.parse_args()
+    params = [p.split('=', 1) for p in args.params]
+    write_log = logging.getLogger('%s.write' % __name__)
+    write_log.setLevel(logging.INFO)
+    write_log.addHandler(logging.FileHandler(args.write_log, mode='w'))
+    pathcomp.init(NUM_PATH_TAGS, write_log=write_log)
+
+    print "test\tqueries\tpacker\tstages\test. rules\ttag bits\ttime(s)" + (
+        "\trules" if args.compile else "")
+    for test in args.tests:
+        try:
+            queries = setup_queries(test, params)
+        except Exception as e:
+            print "%s\tskipped: %s" % (test, traceback.format_exc().strip()
+                                       .split('\n')[-1])
+            continue
+        for packer in PACKERS:
+            t_s = time.time()
+            try:
+                stages = pack_with(packer, queries, args.numstages,
+                                   args.rule_limit)
+            except Exception as e:
+                print "%s\t%d\t%s\tfailed: %s" % (test, len(queries), packer,
+                                                  repr(e))
+                continue
+            elapsed = time.time() - t_s
+            (rules, bits) = estimate(stages)
+            line = "%s\t%d\t%s\t%d\t%d\t%d\t%f" % (test, len(queries), packer,
+                                                   len(stages), rules, bits,
+                                                   elapsed)
+            if args.compile:
+                line += "\t%d" % compiled_rules(stages)
+            print line
+
+if __name__ == '__main__':
+    main()
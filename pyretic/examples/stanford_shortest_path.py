@@ -148,7 +148,7 @@ def get_firewall_query(topo):
     for sw in switches:
         if sw == fw:
             continue
-        p = len(nx.neighbors(topo, sw))
+        p = len(list(nx.neighbors(topo, sw)))
         if edge_predicate is None:
             edge_predicate = match(switch = sw, port = p)
         else:
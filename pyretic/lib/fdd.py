@@ -1,43 +1,305 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+
+"""
+Compilation of whole policies into forwarding decision diagrams (FDDs), as an
+in-process alternative to crossing classifiers (Policy.compile) and to the
+NetKAT compiler server (Policy.netkat_compile).
+
+The FDDs are those of pyretic.lib.path, with frozensets of action keys at the
+leaves: ('mod', items) for a modify of the fields in `items` (identity being
+the empty modify), and ('pol', p) for any other action p (Controller and
+buckets). Parallel composition is a union of leaves, and sequential
+composition restricts the second FDD to the packets produced by each action of
+the first. The result is flattened into a prioritized Classifier.
+
+  from pyretic.lib.fdd import fdd_compile
+  classifier = fdd_compile(policy)
+"""
+
 from pyretic.core.language import *
-from pyretic.lib.path import *
-
-#########################################
-#####             Tests             #####
-#########################################
-
-def pred_trans_test():
-    pred = match(switch = 2)
-    fdd = FDDTranslator.translate(pred, 1)
-    FDDTranslator.assign_path(fdd, ({},set()))
-    print fdd
-    
-    pred = ~match(switch = 2)
-    fdd = FDDTranslator.translate(pred, 2)
-    FDDTranslator.assign_path(fdd, ({},set()))
-    print fdd
-
-    pred = match(switch = 2) | (~match(inport = 3) & match(outport = 2))
-    fdd = FDDTranslator.translate(pred, 3)
-    FDDTranslator.assign_path(fdd, ({},set()))
-    print fdd
-    
-    return 
-    pred = match(switch = 2, inport = 3) | (~match(switch = 3, outport = 4)) | match(inport = 5)
-    fdd = FDDTranslator.translate(pred, 4)
-    FDDTranslator.assign_path(fdd, ({},set()))
-    print fdd
-
-def merge_test():   
-    base = match(switch = 2, inport = 3) | (~match(switch = 3, outport = 4)) | match(inport = 5)
-    base_fdd = FDDTranslator.translate(base, 4)
-    print base_fdd
-    
-    pred = match(srcip = "10.0.0.1")
-    fdd = FDDTranslator.translate(pred, 3)
-    print fdd
-
-    res = FDDTranslator.merge(fdd, base_fdd, True)
-    FDDTranslator.assign_path(res, ({},set()))
-    print res
-if __name__ == "__main__":
-    pred_trans_test()
+from pyretic.core.classifier import Classifier, Rule
+from pyretic.lib.path import FDDTranslator, Leaf
+from ipaddr import IPv4Network
+
+ID_ACTION = ('mod', frozenset())
+
+def _overrides(pol, base, method):
+    """ Whether the class of `pol` redefines `method` of class `base`. """
+    return (getattr(type(pol), method).im_func is not
+            getattr(base, method).im_func)
+
+def _action_key(act):
+    while isinstance(act, DerivedPolicy):
+        act = act.policy
+    if act == identity:
+        return ID_ACTION
+    elif isinstance(act, modify):
+        return ('mod', frozenset(act.map.items()))
+    else:
+        return ('pol', act)
+
+def _key_action(key):
+    (typ, act) = key
+    if key == ID_ACTION:
+        return identity
+    elif typ == 'mod':
+        return modify(**dict(act))
+    else:
+        return act
+
+def _test_holds(test, val):
+    """ Whether the test (field, value) holds on packets with the field set to
+    `val` by a modify. """
+    (f, v) = test
+    if isinstance(v, IPv4Network):
+        try:
+            return IPv4Network(str(val)) in v
+        except ValueError:
+            return False
+    return v == val
+
+
+class FDDCompiler(object):
+    """ Compiles policies into FDDs over FDDTranslator, memoizing the FDDs of
+    the subpolicies seen so far (policies are compared by identity). """
+    def __init__(self):
+        self.pol_cache = {}
+
+    def leaf(self, acts):
+        return FDDTranslator.get_leaf(frozenset(acts))
+
+    def compile(self, pol):
+        if id(pol) in self.pol_cache:
+            return self.pol_cache[id(pol)][1]
+        res = self.translate(pol)
+        self.pol_cache[id(pol)] = (pol, res)
+        return res
+
+    def translate(self, pol):
+        if pol == identity:
+            return self.leaf([ID_ACTION])
+        elif pol == drop:
+            return FDDTranslator.get_drop()
+        elif type(pol) == match:
+            res = self.leaf([ID_ACTION])
+            for (f, v) in sorted(pol.map.items(), key=FDDTranslator.test_key,
+                                 reverse=True):
+                res = FDDTranslator.get_node((f, v), res,
+                                             FDDTranslator.get_drop())
+            return res
+        elif type(pol) == modify:
+            return self.leaf([_action_key(pol)])
+        elif (isinstance(pol, negate) and
+              not _overrides(pol, negate, 'generate_classifier')):
+            return FDDTranslator.map_fdd(self.compile(pol.policies[0]),
+                                         self.negate_leaf, 'negate')
+        elif (isinstance(pol, parallel) and
+              not _overrides(pol, parallel, 'generate_classifier')):
+            res = self.compile(pol.policies[0])
+            for p in pol.policies[1:]:
+                res = FDDTranslator.merge(res, self.compile(p), True)
+            return res
+        elif (isinstance(pol, sequential) and
+              not _overrides(pol, sequential, 'generate_classifier')):
+            res = self.compile(pol.policies[0])
+            for p in pol.policies[1:]:
+                res = self.seq(res, self.compile(p))
+            return res
+        elif (isinstance(pol, DerivedPolicy) and
+              not _overrides(pol, DerivedPolicy, 'compile') and
+              not _overrides(pol, DerivedPolicy, 'generate_classifier')):
+            return self.compile(pol.policy)
+        else:
+            # Controller, buckets, and policies with their own compilation
+            # (e.g., query switches, or precompiled forwarding tables).
+            return self.from_classifier(pol.compile())
+
+    def negate_leaf(self, l):
+        if l.is_drop():
+            return self.leaf([ID_ACTION])
+        elif l.pred_set == frozenset([ID_ACTION]):
+            return FDDTranslator.get_drop()
+        else:
+            raise TypeError('negation of a non-filter policy')
+
+    def from_classifier(self, c):
+        """ The FDD of a classifier, built by partitioning its rules on their
+        fields, in the FDD field order. """
+        key = ('classifier', c)
+        res = FDDTranslator.cache_lookup(key)
+        if res is not None:
+            return res
+        rules = []
+        for r in c.rules:
+            m = {} if r.match == identity else r.match.map
+            acts = frozenset([_action_key(a) for a in r.actions])
+            rules.append((frozenset(m.items()), acts))
+            if not m:
+                break
+        res = self.partition(tuple(rules), {})
+        FDDTranslator.cache_store(key, res)
+        return res
+
+    def partition(self, rules, cache):
+        """ The FDD of a list of rules, as pairs of (field, value) tests and
+        actions, in decreasing priority. """
+        if rules in cache:
+            return cache[rules]
+        for (i, (m, _)) in enumerate(rules):
+            if not m:
+                rules = rules[:i+1]
+                break
+        if len(rules) == 0:
+            res = FDDTranslator.get_drop()
+        elif len(rules[0][0]) == 0:
+            res = self.leaf(rules[0][1])
+        else:
+            f = min([g for (m, _) in rules for (g, _) in m],
+                    key=FDDTranslator.field_key)
+            tests = {}
+            tail = []
+            for (m, acts) in rules:
+                if not f in dict(m):
+                    tail.append((m, acts))
+                else:
+                    tests[dict(m)[f]] = None
+            for v in tests:
+                sub = []
+                for (m, acts) in rules:
+                    d = dict(m)
+                    if not f in d:
+                        sub.append((m, acts))
+                    elif self.covers(d[f], v):
+                        del d[f]
+                        sub.append((frozenset(d.items()), acts))
+                tests[v] = self.partition(tuple(sub), cache)
+            res = FDDTranslator.chain(f, tests,
+                                      self.partition(tuple(tail), cache))
+        cache[rules] = res
+        return res
+
+    def covers(self, w, v):
+        """ Whether every packet matching value `v` matches value `w`. """
+        if isinstance(w, IPv4Network) and isinstance(v, IPv4Network):
+            return v in w
+        return w == v
+
+    def seq(self, d1, d2):
+        """ Sequential composition of FDDs `d1` and `d2`. """
+        key = ('seq', d1, d2)
+        res = FDDTranslator.cache_lookup(key)
+        if res is not None:
+            return res
+        if isinstance(d1, Leaf):
+            res = FDDTranslator.get_drop()
+            for a in d1.pred_set:
+                res = FDDTranslator.merge(res, self.seq_action(a, d2), True)
+        else:
+            c = FDDTranslator.split(d1, d1.test[0])
+            res = self.seq(c.tail, d2)
+            for v in sorted(c.tests.keys(), key=FDDTranslator.value_key,
+                            reverse=True):
+                res = self.ite((c.f, v), self.seq(c.tests[v], d2), res)
+        FDDTranslator.cache_store(key, res)
+        return res
+
+    def seq_action(self, a, d):
+        (typ, act) = a
+        if typ == 'pol':
+            return self.leaf([a])
+        mods = dict(act)
+        def compose(l):
+            acts = []
+            for (typ2, act2) in l.pred_set:
+                if typ2 == 'mod':
+                    m = mods.copy()
+                    m.update(dict(act2))
+                    acts.append(('mod', frozenset(m.items())))
+                else:
+                    acts.append((typ2, act2))
+            return self.leaf(acts)
+        return FDDTranslator.map_fdd(self.restrict(d, act, mods), compose,
+                                     ('compose', act))
+
+    def restrict(self, d, key, mods):
+        """ The FDD `d` on packets whose fields are set according to `mods`.
+        """
+        if isinstance(d, Leaf) or not mods:
+            return d
+        cache_key = ('restrict', key, d)
+        res = FDDTranslator.cache_lookup(cache_key)
+        if res is not None:
+            return res
+        (f, v) = d.test
+        if f in mods:
+            if _test_holds(d.test, mods[f]):
+                res = self.restrict(d.lchild, key, mods)
+            else:
+                res = self.restrict(d.rchild, key, mods)
+        else:
+            res = FDDTranslator.get_node(d.test,
+                                         self.restrict(d.lchild, key, mods),
+                                         self.restrict(d.rchild, key, mods))
+        FDDTranslator.cache_store(cache_key, res)
+        return res
+
+    def ite(self, test, t, e):
+        """ The FDD behaving as `t` on packets satisfying `test`, and as `e`
+        on the others. """
+        if t is e:
+            return t
+        guard = FDDTranslator.get_node(test, self.leaf([ID_ACTION]),
+                                       FDDTranslator.get_drop())
+        neg_guard = FDDTranslator.get_node(test, FDDTranslator.get_drop(),
+                                           self.leaf([ID_ACTION]))
+        def restrict_to(g, l):
+            return FDDTranslator.get_drop() if g.is_drop() else l
+        return FDDTranslator.merge(
+            FDDTranslator.apply(guard, t, restrict_to, 'guard', False),
+            FDDTranslator.apply(neg_guard, e, restrict_to, 'guard', False),
+            True)
+
+    def to_classifier(self, d):
+        """ Flatten FDD `d` into a classifier, with one rule per path. """
+        rules = []
+        for (l, (true_items, _)) in FDDTranslator.get_paths(d, {}):
+            m = match(**dict(true_items)) if true_items else identity
+            acts = set([_key_action(a) for a in l.pred_set])
+            rules.append(Rule(m, acts, [None], "fdd"))
+        # Drop rules falling through to the final drop rule are redundant.
+        while (len(rules) > 1 and not rules[-1].actions and
+               not rules[-2].actions):
+            del rules[-2]
+        return Classifier(rules)
+
+def fdd_compile(pol):
+    """ Compile policy `pol` into a Classifier, through FDDs. """
+    compiler = FDDCompiler()
+    return compiler.to_classifier(compiler.compile(pol))
@@ -28,16 +28,20 @@
 
 from pyretic.core.language import *
 from pyretic.core.language import _modify
-from pyretic.vendor.hsa.utils.wildcard import (wildcard_create_bit_repeat,
+from pyretic.vendor.hsa.utils.wildcard import (wildcard,
+                                               wildcard_create_bit_repeat,
                                                wildcard_to_str,
                                                wildcard_create_from_string)
 from pyretic.vendor.hsa.utils.wildcard_utils import set_header_field
 from ipaddr import IPv4Network
 from pyretic.vendor.hsa.headerspace.tf import TF
+from pyretic.vendor.hsa.headerspace.hs import headerspace
 from pyretic.core.network import IPAddr, IPPrefix, MAC
 import copy, logging
 import subprocess, shlex
 import json
+import os, sys, mmap, struct, hashlib
+from array import array
 
 HSL_C_FOLDER = '/home/mininet/pyretic/pyretic/lib/hassel-c'
 TFS_FOLDER = '%s/tfs/pyretic' % HSL_C_FOLDER
@@ -45,6 +49,8 @@ INVERTED_OUTFILE = "%s/data/out-inverted.json" % HSL_C_FOLDER
 GEN_BINARY = "%s/gen" % HSL_C_FOLDER
 PYRETIC_BINARY = "%s/pyretic" % HSL_C_FOLDER
 SWITCH_MULTIPLIER = 100000
+# Run reachability through the hassel-c binary instead of in-process.
+USE_HASSEL_C = False
 
 def pyr_hs_format():
     '''A header-space format which defines all the packet header fields used in
@@ -146,9 +152,11 @@ def get_ports(hsf, portids, sw_ports, mat_map, sw):
             inports = [portids[(sw,x)] for x in sw_ports[sw]]
     return inports
 
-def convert_classifier(classifier, hsf, portids, sw_ports):
+def convert_classifier(classifier, hsf, portids, sw_ports, save=True):
     """Function to convert a classifier `classifier` into a header space given by a
-    header space format dictionary `hsf`.
+    header space format dictionary `hsf`. Returns a dictionary from switches to
+    their transfer functions, which are also saved to TFS_FOLDER if `save` is
+    set.
     """
     hsalib_log = logging.getLogger('%s.convert_classifier' % __name__)
 
@@ -228,25 +236,16 @@ def convert_classifier(classifier, hsf, portids, sw_ports):
                 warn_nonexistent_port(p)
         return out_ports
 
-    def init_tfs():
-        """ Initialize one transfer function per device. """
-        tfs_map = {}
-        for sw in sw_ports.keys():
-            tfs_map[sw] = TF(hsf["length"])
-            tfs_map[sw].set_prefix_id("s%d" % sw)
-            tfs_map[sw].set_send_on_receiving_port(True)
-        return tfs_map
-
-    def save_tfs(tfs_map):
-        """ Save a dictionary of transfer functions to various files. """
-        global TFS_FOLDER
-        for (sw, tf) in tfs_map.iteritems():
-            tf.save_object_to_file('%s/s%d.tf' % (TFS_FOLDER, sw))
+    def init_tf(sw):
+        """ Initialize the transfer function of a device. """
+        tf = TF(hsf["length"])
+        tf.set_prefix_id("s%d" % sw)
+        tf.set_send_on_receiving_port(True)
+        return tf
 
-    ''' Classifier conversion core logic begins here. '''
-    tfs_map = init_tfs()
-    for sw in sw_ports.keys():
-        tf = tfs_map[sw]
+    def get_rule_specs(sw):
+        """ Arguments of the transfer function rules of switch `sw`. """
+        specs = []
         for rule in classifier.rules:
             try:
                 mat_map = {} if rule.match == identity else rule.match.map
@@ -259,27 +258,82 @@ def convert_classifier(classifier, hsf, portids, sw_ports):
                 in_ports = get_ports(hsf, portids, sw_ports, mat_map, sw)
                 (mask, rewrite, outports, rw) = get_action_wc(rule.actions)
                 out_ports = process_outports(mat_map, outports, sw, rule)
-                rule = TF.create_standard_rule(in_ports, mat_wc, out_ports,
-                                               mask, rewrite)
-                if rw:
-                    tf.add_rewrite_rule(rule)
-                else:
-                    tf.add_fwd_rule(rule)
-    save_tfs(tfs_map)
+                specs.append((in_ports, mat_wc, out_ports, mask, rewrite, rw))
+        return specs
+
+    def build_tf(sw, specs):
+        tf = init_tf(sw)
+        for (in_ports, mat_wc, out_ports, mask, rewrite, rw) in specs:
+            rule = TF.create_standard_rule(in_ports, mat_wc, out_ports,
+                                           mask, rewrite)
+            if rw:
+                tf.add_rewrite_rule(rule)
+            else:
+                tf.add_fwd_rule(rule)
+        return tf
+
+    ''' Classifier conversion core logic begins here. Transfer functions of
+    switches whose rules did not change since they were last built (or
+    exported) are reused. '''
+    tfs_map = {}
+    for sw in sw_ports.keys():
+        specs = get_rule_specs(sw)
+        digest = tf_specs_digest("s%d" % sw, specs)
+        tfs_map[sw] = get_cached_tf("s%d" % sw, digest,
+                                    lambda: build_tf(sw, specs))
+    if save:
+        save_tfs(tfs_map)
+    return tfs_map
 
-def convert_topology(edges, hsf, portids):
+def convert_topology(edges, hsf, portids, save=True):
     """ Convert a list of edges representing the topology into a topology
     transfer function. """
-    ttf = TF(hsf["length"] * 2)
-    for (s1, p1, s2, p2) in edges:
-        rule = TF.create_standard_rule([portids[(s1,p1)]], None,
-                                       [portids[(s2,p2)]], None, None)
-        ttf.add_link_rule(rule)
-        rule = TF.create_standard_rule([portids[(s2,p2)]], None,
-                                       [portids[(s1,p1)]], None, None)
-        ttf.add_link_rule(rule)
-    global TFS_FOLDER
-    ttf.save_object_to_file("%s/topology.tf" % TFS_FOLDER)
+    def build_ttf():
+        ttf = TF(hsf["length"] * 2)
+        for (s1, p1, s2, p2) in edges:
+            rule = TF.create_standard_rule([portids[(s1,p1)]], None,
+                                           [portids[(s2,p2)]], None, None)
+            ttf.add_link_rule(rule)
+            rule = TF.create_standard_rule([portids[(s2,p2)]], None,
+                                           [portids[(s1,p1)]], None, None)
+            ttf.add_link_rule(rule)
+        return ttf
+    specs = [(hsf["length"], portids[(s1,p1)], portids[(s2,p2)])
+             for (s1, p1, s2, p2) in edges]
+    ttf = get_cached_tf("topology", tf_specs_digest("topology", specs),
+                        build_ttf)
+    if save:
+        save_tfs({"topology": ttf})
+    return ttf
+
+def tf_file_name(name):
+    """ Base path (without extension) of the files of transfer function
+    `name`, which is "s<switch>" or "topology". """
+    return '%s/%s' % (TFS_FOLDER, name)
+
+def save_tfs(tfs_map):
+    """ Save a dictionary of transfer functions to binary files in TFS_FOLDER,
+    from which get_cached_tf reloads them when their rules are unchanged
+    (e.g., after a restart), and to text files read by hassel-c if
+    USE_HASSEL_C is set. Files of transfer functions unchanged since they
+    were last saved are not rewritten. Keys of `tfs_map` are switches, or
+    "topology". Without hassel-c, the files are only a cache, so failures to
+    write them are logged rather than raised. """
+    try:
+        if not os.path.isdir(TFS_FOLDER):
+            os.makedirs(TFS_FOLDER)
+        for (sw, tf) in tfs_map.iteritems():
+            name = sw if sw == "topology" else "s%d" % sw
+            base = tf_file_name(name)
+            written = save_tf_binary(tf, '%s.tfb' % base, built_tfs[name][0])
+            if USE_HASSEL_C and (written or
+                                 not os.path.exists('%s.tf' % base)):
+                tf.save_object_to_file('%s.tf' % base)
+    except (IOError, OSError) as e:
+        if USE_HASSEL_C:
+            raise
+        logging.getLogger('%s.save_tfs' % __name__).warn(
+            "Could not save transfer functions to %s: %s" % (TFS_FOLDER, e))
 
 def get_portid_map(sw_ports):
     portid_map = {}
@@ -333,21 +387,277 @@ def setup_tfs_data_from_policy(hsf, pol, sw_ports, network_links):
     setup_tfs_data_from_cls(hsf, c, sw_ports, network_links)
 
 def setup_tfs_data_from_cls(hsf, c, sw_ports, network_links):
-    """ Set up transfer functions and hassel-c data files from a given
-    classifier `c`, and topology information. """
+    """ Set up transfer functions from a given classifier `c`, and topology
+    information, and load them into the in-process reachability service. The
+    transfer functions are saved (see save_tfs); the other hassel-c data files
+    are only generated if USE_HASSEL_C is set. """
     # get a forwarding transfer function
     portids = get_portid_map(sw_ports)
-    convert_classifier(c, hsf, portids, sw_ports)
+    tfs_map = convert_classifier(c, hsf, portids, sw_ports)
 
     # get a topology transfer function
     edge_list = get_edge_list(network_links)
-    convert_topology(edge_list, hsf, portids)
+    ttf = convert_topology(edge_list, hsf, portids)
+    reachability_service.load(hsf, tfs_map, ttf)
+
+    if USE_HASSEL_C:
+        # port map, for easy reference
+        write_port_map(sw_ports, portids)
+
+        # generate the hassel-c `dat` file
+        gen_hassel_datafile()
+
+#### Binary transfer function files ####
+
+""" Transfer functions are saved in a binary format that can be memory-mapped
+and loaded without parsing, unlike the text format of TF.save_object_to_file.
+All values are little-endian. A file consists of:
+
+- a header (TFB_HEADER), with the format version and counts of the tables
+  below, and a digest of the rules the transfer function was built from;
+- a table of distinct wildcards, each packed into `nwords` 64-bit words as
+  in the vendor wildcard library's pickled form;
+- a table of rules (TFB_RULE), which refer to wildcards by index (-1 for none,
+  -2 for an empty wildcard), and to runs of the integer and string pools by
+  (offset, length);
+- a pool of 32-bit integers, holding port lists, `affected_by`
+  entries as (rule index, wildcard index, ports offset, ports length),
+  `influence_on` rule indices, and line numbers;
+- a pool of strings, holding the prefix id, rule ids and file names.
+"""
+TFB_MAGIC = 'PYTF'
+TFB_VERSION = 1
+# magic, version, flags, length, nwords, nrules, nwildcards, nints, nchars,
+# next_id, lazy_eval_bytes (offset, length), prefix_id (offset, length),
+# digest
+TFB_HEADER = struct.Struct('<4sHHIIIIIIIIIII16s')
+# action, match, mask, rewrite, inverse_match, inverse_rewrite, then (offset,
+# length) of in_ports, out_ports, affected_by, influence_on, line, id, file
+TFB_RULE = struct.Struct('<B3x5i14I')
+TFB_ACTIONS = ['fwd', 'rw', 'link']
+TFB_FLAG_SEND_ON_RECEIVING_PORT = 0x1
+TFB_FLAG_LAZY_EVAL_ACTIVE = 0x2
+TFB_WC_NONE = -1
+TFB_WC_EMPTY = -2
+
+""" Transfer functions built in this process, by name, along with the digest
+of the rules they were built from. """
+built_tfs = {}
+
+def tf_specs_digest(name, specs):
+    """ Digest of the arguments `specs` a transfer function is built from. """
+    def spec_repr(x):
+        if isinstance(x, wildcard):
+            return repr(x.__getstate__())
+        elif isinstance(x, (list, tuple)):
+            return '(%s)' % ','.join(map(spec_repr, x))
+        return repr(x)
+    return hashlib.md5('%d:%s:%s' % (TFB_VERSION, name,
+                                     spec_repr(specs))).digest()
+
+def get_cached_tf(name, digest, build):
+    """ The transfer function `name` for rules with the given digest: the one
+    last built, if its rules are the same, or else the one last saved to
+    TFS_FOLDER, if its rules are the same, or else the result of `build()`. """
+    if name in built_tfs and built_tfs[name][0] == digest:
+        return built_tfs[name][1]
+    filename = '%s.tfb' % tf_file_name(name)
+    if read_tf_binary_digest(filename) == digest:
+        tf = load_tf_binary(filename)
+    else:
+        tf = build()
+    built_tfs[name] = (digest, tf)
+    return tf
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _native_array(typecode, data):
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def _le_bytes(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+def save_tf_binary(tf, filename, digest=''):
+    """ Save transfer function `tf` to `filename` in the binary format. If the
+    file already holds a transfer function with the same (non-empty) digest,
+    it is left as is. Returns whether the file was written. """
+    if digest and read_tf_binary_digest(filename) == digest:
+        return False
+    nwords = (tf.length + 3) / 4
+    words = []
+    wc_index = {}
+    ints = array('i')
+    chars = []
+    nchars = [0]
+    def add_wc(w):
+        if w is None:
+            return TFB_WC_NONE
+        if w.pointer is None:
+            return TFB_WC_EMPTY
+        key = tuple(w.__getstate__()[1])
+        if not key in wc_index:
+            assert len(key) == nwords
+            wc_index[key] = len(wc_index)
+            words.extend(key)
+        return wc_index[key]
+    def add_ints(vals):
+        off = len(ints)
+        ints.extend(vals)
+        return (off, len(vals))
+    def add_str(val):
+        off = nchars[0]
+        chars.append(val)
+        nchars[0] += len(val)
+        return (off, len(val))
+    rule_index = dict([(id(r), i) for (i, r) in enumerate(tf.rules)])
+    rules = []
+    for r in tf.rules:
+        if not r["action"] in TFB_ACTIONS:
+            raise TypeError("cannot save %s rules in binary transfer "
+                            "functions" % r["action"])
+        affected = []
+        for (ra, h, ports) in r["affected_by"]:
+            affected.extend([rule_index[id(ra)], add_wc(h)] +
+                            list(add_ints(ports)))
+        fields = ([TFB_ACTIONS.index(r["action"])] +
+                  [add_wc(r[k]) for k in ["match", "mask", "rewrite",
+                                          "inverse_match",
+                                          "inverse_rewrite"]])
+        runs = [add_ints(r["in_ports"]), add_ints(r["out_ports"]),
+                add_ints(affected),
+                add_ints([rule_index[id(io)] for io in r["influence_on"]]),
+                add_ints(r["line"]), add_str(r["id"]), add_str(r["file"])]
+        # affected_by entries are stored as a run of 4-tuples
+        runs[2] = (runs[2][0], runs[2][1] / 4)
+        rules.append(TFB_RULE.pack(*(fields + [x for run in runs
+                                               for x in run])))
+    lazy = add_ints(tf.lazy_eval_bytes)
+    prefix = add_str(tf.prefix_id)
+    flags = ((TFB_FLAG_SEND_ON_RECEIVING_PORT if tf.send_on_receiving_port
+              else 0) |
+             (TFB_FLAG_LAZY_EVAL_ACTIVE if tf.lazy_eval_active else 0))
+    header = TFB_HEADER.pack(TFB_MAGIC, TFB_VERSION, flags, tf.length, nwords,
+                             len(rules), len(wc_index), len(ints), nchars[0],
+                             tf.next_id, lazy[0], lazy[1], prefix[0],
+                             prefix[1], digest.ljust(16, '\0'))
+    ''' Write to a temporary file first, so that readers never map a partially
+    written file. '''
+    tmp_filename = '%s.tmp' % filename
+    f = open(tmp_filename, 'wb')
+    f.write(header)
+    f.write('\0' * (_align(TFB_HEADER.size) - TFB_HEADER.size))
+    f.write(struct.pack('<%dq' % len(words), *words))
+    f.write(''.join(rules))
+    f.write(_le_bytes(ints))
+    f.write(''.join(chars))
+    f.close()
+    os.rename(tmp_filename, filename)
+    return True
+
+def read_tf_binary_digest(filename):
+    """ The digest saved in binary transfer function file `filename`, or None
+    if there is no such file of the current format version. """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    data = f.read(TFB_HEADER.size)
+    f.close()
+    if len(data) < TFB_HEADER.size:
+        return None
+    fields = TFB_HEADER.unpack(data)
+    if fields[0] != TFB_MAGIC or fields[1] != TFB_VERSION:
+        return None
+    return fields[-1]
+
+def load_tf_binary(filename):
+    """ Load a transfer function saved by save_tf_binary. """
+    f = open(filename, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        (magic, version, flags, length, nwords, nrules, nwcs, nints, nchars,
+         next_id, lazy_off, lazy_len, prefix_off, prefix_len,
+         digest) = TFB_HEADER.unpack_from(buf, 0)
+        if magic != TFB_MAGIC:
+            raise ValueError("%s is not a binary transfer function" %
+                             filename)
+        if version != TFB_VERSION:
+            raise ValueError("%s has transfer function format version %d, "
+                             "expected %d" % (filename, version, TFB_VERSION))
+        wcs_off = _align(TFB_HEADER.size)
+        rules_off = wcs_off + nwcs * nwords * 8
+        ints_off = rules_off + nrules * TFB_RULE.size
+        chars_off = ints_off + nints * 4
+        words = struct.unpack_from('<%dq' % (nwcs * nwords), buf, wcs_off)
+        ints = _native_array('i', buf[ints_off:chars_off])
+        chars = buf[chars_off:chars_off + nchars]
+        rule_fields = [TFB_RULE.unpack_from(buf, rules_off + i * TFB_RULE.size)
+                       for i in range(nrules)]
+    finally:
+        buf.close()
 
-    # port map, for easy reference
-    write_port_map(sw_ports, portids)
+    wcs = []
+    for i in range(nwcs):
+        w = wildcard(length, None)
+        w.__setstate__([length, list(words[i * nwords:(i + 1) * nwords])])
+        wcs.append(w)
+    def get_wc(i):
+        if i == TFB_WC_NONE:
+            return None
+        elif i == TFB_WC_EMPTY:
+            return wildcard(length, None)
+        return wcs[i]
+    def get_ints(off, n):
+        return ints[off:off + n].tolist()
 
-    # generate the hassel-c `dat` file
-    gen_hassel_datafile()
+    tf = TF(length)
+    tf.prefix_id = chars[prefix_off:prefix_off + prefix_len]
+    tf.next_id = next_id
+    tf.send_on_receiving_port = bool(flags & TFB_FLAG_SEND_ON_RECEIVING_PORT)
+    tf.lazy_eval_active = bool(flags & TFB_FLAG_LAZY_EVAL_ACTIVE)
+    tf.lazy_eval_bytes = get_ints(lazy_off, lazy_len)
+    for fields in rule_fields:
+        (act, mat, mask, rewrite, inv_mat, inv_rewrite) = fields[:6]
+        (in_off, in_n, out_off, out_n, aff_off, aff_n, inf_off, inf_n,
+         line_off, line_n, id_off, id_n, file_off, file_n) = fields[6:]
+        tf.rules.append({"action": TFB_ACTIONS[act],
+                         "match": get_wc(mat),
+                         "mask": get_wc(mask),
+                         "rewrite": get_wc(rewrite),
+                         "inverse_match": get_wc(inv_mat),
+                         "inverse_rewrite": get_wc(inv_rewrite),
+                         "in_ports": get_ints(in_off, in_n),
+                         "out_ports": get_ints(out_off, out_n),
+                         "affected_by": get_ints(aff_off, aff_n * 4),
+                         "influence_on": get_ints(inf_off, inf_n),
+                         "line": get_ints(line_off, line_n),
+                         "id": chars[id_off:id_off + id_n],
+                         "file": chars[file_off:file_off + file_n]})
+    ''' Resolve rule and wildcard references, and set up the lookup tables
+    that TF._set_fast_lookup_pointers would. '''
+    for rule in tf.rules:
+        aff = rule["affected_by"]
+        rule["affected_by"] = [(tf.rules[aff[i]], get_wc(aff[i+1]),
+                                get_ints(aff[i+2], aff[i+3]))
+                               for i in range(0, len(aff), 4)]
+        rule["influence_on"] = [tf.rules[i] for i in rule["influence_on"]]
+        for p in rule["in_ports"]:
+            tf.inport_to_rule.setdefault(str(p), []).append(rule)
+        for p in rule["out_ports"]:
+            tf.outport_to_rule.setdefault(str(p), []).append(rule)
+        tf.id_to_rule[rule["id"]] = rule
+    return tf
 
 #### Running header space analysis ####
 
@@ -361,16 +671,12 @@ def gen_hassel_datafile():
         print e.returncode
         print e.output
 
-def reachability_inport_outheader(hsf, portids, sw_ports, insw, inport,
-                                  outmatch, no_vlan=False):
-    """Function that runs reachability from a given inport to a given output header
-    space, represented by the `match` in outmatch.
-    """
+def get_outheader(hsf, portids, sw_ports, outmatch):
+    """ The output ports and the output header wildcard of the output header
+    space represented by the `match` in outmatch. """
     from pyretic.core.language import _match
-    in_port = portids[(insw,inport)]
     outmat_map = dict(_match(**outmatch.map).map)
     outmat_wc = get_match_wc(hsf, outmat_map)
-    outports = []
     if 'switch' in outmat_map:
         outports_lst = get_ports(hsf, portids, sw_ports, outmat_map,
                                  outmat_map['switch'])
@@ -378,10 +684,24 @@ def reachability_inport_outheader(hsf, portids, sw_ports, insw, inport,
         outports_lst = reduce(lambda acc, sw: acc +
                               get_ports(hsf, portids, sw_ports, outmat_map, sw),
                               sw_ports.keys(), [])
-    outports_str = reduce(lambda acc, x: acc + ' ' + str(x), outports_lst, '')
-    inmat_wc = get_match_wc(hsf, {})
+    return (outports_lst, outmat_wc)
+
+def get_inheader(hsf, no_vlan=False):
+    """ The input header wildcard: all packets, or only untagged packets if
+    `no_vlan` is set. """
     if no_vlan:
-        inmat_wc = get_match_wc(hsf, {'vlan_id': 0, 'vlan_pcp': 0})
+        return get_match_wc(hsf, {'vlan_id': 0, 'vlan_pcp': 0})
+    return get_match_wc(hsf, {})
+
+def reachability_inport_outheader(hsf, portids, sw_ports, insw, inport,
+                                  outmatch, no_vlan=False):
+    """Function that runs reachability from a given inport to a given output header
+    space, represented by the `match` in outmatch.
+    """
+    in_port = portids[(insw,inport)]
+    (outports_lst, outmat_wc) = get_outheader(hsf, portids, sw_ports, outmatch)
+    outports_str = reduce(lambda acc, x: acc + ' ' + str(x), outports_lst, '')
+    inmat_wc = get_inheader(hsf, no_vlan)
     ih_str = '-ih %s' % wildcard_to_str(inmat_wc) if no_vlan else ''
     reachability_cmd = "%s %s -oh %s %d %s" % (PYRETIC_BINARY,
                                                ih_str,
@@ -552,7 +872,162 @@ def get_reachable_inheaders(hsf, portids, sw_ports, insw, inport, outmatch,
     :type outmatch: match
     :rtype: Filter
     """
-    reachability_inport_outheader(hsf, portids, sw_ports, insw, inport,
-                                  outmatch, no_vlan)
-    hslines = extract_inversion_results()
-    return get_filter_hs(hsf, hslines)
+    if USE_HASSEL_C:
+        reachability_inport_outheader(hsf, portids, sw_ports, insw, inport,
+                                      outmatch, no_vlan)
+        hslines = extract_inversion_results()
+        return get_filter_hs(hsf, hslines)
+    return get_reachable_inheaders_batch(hsf, portids, sw_ports,
+                                         [(insw, inport, outmatch)],
+                                         no_vlan)[0]
+
+def get_reachable_inheaders_batch(hsf, portids, sw_ports, queries,
+                                  no_vlan=False):
+    """ Batched version of get_reachable_inheaders, answering a list of
+    `queries` of the form (insw, inport, outmatch) in one go. Returns the list
+    of Filters for the queries, in order. """
+    if USE_HASSEL_C:
+        return [get_reachable_inheaders(hsf, portids, sw_ports, insw, inport,
+                                        outmatch, no_vlan)
+                for (insw, inport, outmatch) in queries]
+    return reachability_service.query_batch(hsf, portids, sw_ports, queries,
+                                            no_vlan)
+
+#### In-process reachability ####
+
+def hs_to_json(hs):
+    """ Convert a headerspace object into the list of {'elem', 'diff'}
+    dictionaries that hassel-c writes out, so that get_filter_hs may be used
+    on it. """
+    res = []
+    for (elem, diffs) in zip(hs.hs_list, hs.hs_diff):
+        entry = {'elem': wildcard_to_str(elem)}
+        if diffs:
+            entry['diff'] = [{'elem': wildcard_to_str(d)} for d in diffs]
+        res.append(entry)
+    return res
+
+class HSAReachability(object):
+    """ Header space reachability over switch and topology transfer functions
+    held in memory, so that many (inport, output header) queries can be
+    answered without reloading transfer functions or starting hassel-c.
+
+    For each input port, headers are propagated through the network once
+    (`propagate`), and every (headerspace, port) they reach is recorded along
+    with the transfer function rules applied on the way. A query then only
+    needs to invert the rules of the reached headerspaces which intersect its
+    output header space. Both the propagations and the query results are
+    cached until the transfer functions are reloaded, which bumps `version`.
+    """
+    def __init__(self):
+        self.log = logging.getLogger('%s.HSAReachability' % __name__)
+        self.hsf = None
+        self.switch_tfs = {}
+        self.topo_tf = None
+        self.version = 0
+        self.reached_cache = {}
+        self.result_cache = {}
+
+    def load(self, hsf, switch_tfs, topo_tf):
+        """ Replace the transfer functions in use. """
+        self.hsf = hsf
+        self.switch_tfs = switch_tfs
+        self.topo_tf = topo_tf
+        self.version += 1
+        self.reached_cache = {}
+        self.result_cache = {}
+
+    def propagate(self, in_port, no_vlan):
+        """ Return the list of (hs, port) reached from network-wide port
+        `in_port`, both on switch output ports and on the ports at the other
+        end of links. Like hassel-c, headers are never sent back out of the
+        port they were received on, and propagation stops at ports already
+        visited. """
+        key = (in_port, no_vlan)
+        if key in self.reached_cache:
+            return self.reached_cache[key]
+        in_hs = headerspace(self.hsf["length"])
+        in_hs.add_hs(get_inheader(self.hsf, no_vlan))
+        reached = []
+        queue = [(in_hs, in_port, (in_port,))]
+        while queue:
+            (hs, port, visited) = queue.pop()
+            sw_tf = self.switch_tfs.get(port / SWITCH_MULTIPLIER)
+            if not sw_tf:
+                continue
+            for (out_hs, out_ports) in sw_tf.T(hs, port):
+                for out_port in out_ports:
+                    if out_port == port:
+                        continue
+                    reached.append((out_hs, out_port))
+                    for (link_hs, link_ports) in self.topo_tf.T(out_hs,
+                                                                out_port):
+                        for next_port in link_ports:
+                            if next_port in visited:
+                                continue
+                            reached.append((link_hs, next_port))
+                            queue.append((link_hs, next_port,
+                                          visited + (next_port,)))
+        self.reached_cache[key] = reached
+        return reached
+
+    def invert(self, hs, port, out_wc, in_wc):
+        """ Input headers which reach (headerspace `hs`, `port`) in the output
+        header `out_wc`, by inverting the rules applied to `hs` in reverse. """
+        out_hs = hs.copy_intersect(out_wc)
+        out_hs.applied_rules = []
+        curr = [out_hs]
+        for (tf, rule_id, in_port) in reversed(hs.applied_rules):
+            prev = []
+            for h in curr:
+                for (inv_hs, inv_ports) in tf.T_inv_rule(rule_id, h, port):
+                    if in_port in inv_ports:
+                        inv_hs.applied_rules = []
+                        prev.append(inv_hs)
+            (curr, port) = (prev, in_port)
+        res = []
+        for h in curr:
+            h.intersect(in_wc)
+            h.clean_up()
+            if not h.is_empty():
+                res.append(h)
+        return res
+
+    def query(self, hsf, portids, sw_ports, insw, inport, outmatch,
+              no_vlan=False):
+        """ Filter of the headers entering at (insw, inport) which reach
+        `outmatch`. All points where propagated headers intersect the output
+        header space contribute, not only the first one on each path. """
+        key = (self.version, insw, inport, outmatch, no_vlan)
+        if key in self.result_cache:
+            return self.result_cache[key]
+        (outports, out_wc) = get_outheader(hsf, portids, sw_ports, outmatch)
+        outports = set(outports)
+        in_wc = get_inheader(hsf, no_vlan)
+        hsres = []
+        seen = set()
+        for (hs, port) in self.propagate(portids[(insw,inport)], no_vlan):
+            if not port in outports:
+                continue
+            for inv_hs in self.invert(hs, port, out_wc, in_wc):
+                for entry in hs_to_json(inv_hs):
+                    entry_key = json.dumps(entry, sort_keys=True)
+                    if not entry_key in seen:
+                        seen.add(entry_key)
+                        hsres.append(entry)
+        res = get_filter_hs(hsf, hsres)
+        self.result_cache[key] = res
+        return res
+
+    def query_batch(self, hsf, portids, sw_ports, queries, no_vlan=False):
+        """ Answer a list of (insw, inport, outmatch) queries. Queries from
+        the same input port share one propagation through the network. """
+        if self.topo_tf is None:
+            raise RuntimeError("No transfer functions loaded for reachability")
+        self.log.debug("Answering %d reachability queries (version %d)" % (
+            len(queries), self.version))
+        return [self.query(hsf, portids, sw_ports, insw, inport, outmatch,
+                           no_vlan)
+                for (insw, inport, outmatch) in queries]
+
+reachability_service = HSAReachability()
@@ -0,0 +1,407 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+# In-process construction of DFAs for a list of regular expressions, through   #
+# Thompson NFAs and subset construction over symbol classes. This produces the #
+# same automata that ragel generated for the path query compiler, without the  #
+# external process.                                                            #
+################################################################################
+from pyretic.lib.re import *
+
+### Parsing the (ragel-syntax) string form of regular expressions.
+#
+# The grammar is the one produced by re_string_repr and gen_re_string:
+#   expr   := term (('|' | '&') term)*
+#   term   := factor ('.' factor)*
+#   factor := '!' factor | base '*'*
+#   base   := '(' expr ')' | integer | '^any' | 'epsilon'
+
+def tokenize_re_string(s):
+    toks = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c.isspace():
+            i += 1
+        elif c in '()|&.*!':
+            toks.append(c)
+            i += 1
+        elif s.startswith('^any', i):
+            toks.append('^any')
+            i += 4
+        elif s.startswith('epsilon', i):
+            toks.append('epsilon')
+            i += 7
+        elif c.isdigit():
+            j = i
+            while j < len(s) and s[j].isdigit():
+                j += 1
+            toks.append(int(s[i:j]))
+            i = j
+        else:
+            raise ValueError("Unexpected character %s in regular expression"
+                             " %s" % (c, s))
+    return toks
+
+def parse_re_string(s):
+    """ Parse the string form of a regular expression into a re_deriv. """
+    toks = tokenize_re_string(s)
+    pos = [0]
+
+    def peek():
+        return toks[pos[0]] if pos[0] < len(toks) else None
+
+    def take(tok=None):
+        t = peek()
+        if tok is not None and t != tok:
+            raise ValueError("Expected %s at token %d of %s" %
+                             (tok, pos[0], s))
+        pos[0] += 1
+        return t
+
+    def expr():
+        r = term()
+        while peek() in ['|', '&']:
+            if take() == '|':
+                r = r | term()
+            else:
+                r = r & term()
+        return r
+
+    def term():
+        r = factor()
+        while peek() == '.':
+            take()
+            r = r ^ factor()
+        return r
+
+    def factor():
+        if peek() == '!':
+            take()
+            return ~factor()
+        r = base()
+        while peek() == '*':
+            take()
+            r = +r
+        return r
+
+    def base():
+        t = take()
+        if t == '(':
+            r = expr()
+            take(')')
+            return r
+        elif t == '^any':
+            return re_empty()
+        elif t == 'epsilon':
+            return re_epsilon()
+        elif isinstance(t, int):
+            return re_symbol(t)
+        else:
+            raise ValueError("Unexpected token %s in %s" % (str(t), s))
+
+    r = expr()
+    if peek() is not None:
+        raise ValueError("Trailing tokens in regular expression %s" % s)
+    return r
+
+### Symbol classes
+
+def get_charset(r):
+    """ If `r` matches exactly a set of single symbols, return that set as a
+    frozenset, else None. """
+    if isinstance(r, re_symbol):
+        return frozenset([r.char])
+    elif isinstance(r, re_alter):
+        chars = set()
+        for x in r.re_list:
+            cs = get_charset(x)
+            if cs is None:
+                return None
+            chars |= cs
+        return frozenset(chars)
+    return None
+
+def get_symbol_classes(re_list, alphabet):
+    """ Partition `alphabet` (plus any symbols occuring in `re_list`) into
+    classes of symbols which no expression in `re_list` can tell apart, i.e.,
+    symbols which occur in exactly the same character sets. Returns a pair
+    (sym_to_class, class_to_syms). """
+    charsets = []
+    def collect(r):
+        cs = get_charset(r)
+        if cs is not None:
+            charsets.append(cs)
+        elif isinstance(r, re_concat):
+            collect(r.re1)
+            collect(r.re2)
+        elif isinstance(r, re_star) or isinstance(r, re_negate):
+            collect(r.re)
+        elif isinstance(r, re_combinator):
+            for x in r.re_list:
+                collect(x)
+    for r in re_list:
+        collect(r)
+
+    occurrences = {}
+    for s in alphabet:
+        occurrences[s] = []
+    for (i, cs) in enumerate(charsets):
+        for s in cs:
+            occurrences.setdefault(s, []).append(i)
+
+    sym_to_class = {}
+    class_to_syms = []
+    sig_to_class = {}
+    for s in sorted(occurrences.keys()):
+        sig = tuple(occurrences[s])
+        if not sig in sig_to_class:
+            sig_to_class[sig] = len(class_to_syms)
+            class_to_syms.append([])
+        k = sig_to_class[sig]
+        sym_to_class[s] = k
+        class_to_syms[k].append(s)
+    return (sym_to_class, class_to_syms)
+
+### NFAs and subset construction
+
+class re_nfa(object):
+    """ A Thompson NFA whose transitions are labeled by symbol classes. """
+    def __init__(self, sym_to_class, num_classes):
+        self.sym_to_class = sym_to_class
+        self.num_classes = num_classes
+        self.eps = []
+        self.trans = []
+        self.closures = {}
+
+    def new_state(self):
+        self.eps.append(set())
+        self.trans.append({})
+        return len(self.eps) - 1
+
+    def add_eps(self, q, d):
+        self.eps[q].add(d)
+
+    def add_trans(self, q, k, d):
+        self.trans[q].setdefault(k, set()).add(d)
+
+    def add_fragment(self, r):
+        """ Add the states for expression `r`, returning its (start, end)
+        states. """
+        s = self.new_state()
+        e = self.new_state()
+        cs = get_charset(r)
+        if cs is not None:
+            for k in set([self.sym_to_class[c] for c in cs]):
+                self.add_trans(s, k, e)
+        elif isinstance(r, re_epsilon):
+            self.add_eps(s, e)
+        elif isinstance(r, re_empty):
+            pass
+        elif isinstance(r, re_concat):
+            (s1, e1) = self.add_fragment(r.re1)
+            (s2, e2) = self.add_fragment(r.re2)
+            self.add_eps(s, s1)
+            self.add_eps(e1, s2)
+            self.add_eps(e2, e)
+        elif isinstance(r, re_alter):
+            for x in r.re_list:
+                (s1, e1) = self.add_fragment(x)
+                self.add_eps(s, s1)
+                self.add_eps(e1, e)
+        elif isinstance(r, re_star):
+            (s1, e1) = self.add_fragment(r.re)
+            self.add_eps(s, s1)
+            self.add_eps(s, e)
+            self.add_eps(e1, s1)
+            self.add_eps(e1, e)
+        elif isinstance(r, re_inters) or isinstance(r, re_negate):
+            ''' Intersection and negation have no Thompson construction: build
+            a complete DFA for them and embed it. '''
+            if isinstance(r, re_negate):
+                (trans, acc) = self.sub_dfa(r.re)
+                acc = [not a for a in acc]
+            else:
+                (trans, acc) = self.sub_dfa(r.re_list[0])
+                for x in r.re_list[1:]:
+                    (trans, acc) = self.product(trans, acc, *self.sub_dfa(x))
+            states = [self.new_state() for q in trans]
+            for (q, row) in enumerate(trans):
+                for (k, d) in enumerate(row):
+                    self.add_trans(states[q], k, states[d])
+                if acc[q]:
+                    self.add_eps(states[q], e)
+            self.add_eps(s, states[0])
+        else:
+            raise TypeError("Unknown regular expression type %s" % type(r))
+        return (s, e)
+
+    def sub_dfa(self, r):
+        """ Complete DFA for `r` in a fresh NFA, as a (transitions,
+        accepting) pair of lists indexed by state, with state 0 initial. """
+        sub = re_nfa(self.sym_to_class, self.num_classes)
+        (s, e) = sub.add_fragment(r)
+        (subsets, trans) = sub.subset_construction(s, complete=True)
+        return (trans, [e in q for q in subsets])
+
+    def product(self, trans1, acc1, trans2, acc2):
+        """ Product (intersection) of two complete DFAs. """
+        index = {(0, 0): 0}
+        pairs = [(0, 0)]
+        trans = []
+        i = 0
+        while i < len(pairs):
+            (q1, q2) = pairs[i]
+            row = []
+            for k in range(self.num_classes):
+                d = (trans1[q1][k], trans2[q2][k])
+                if not d in index:
+                    index[d] = len(pairs)
+                    pairs.append(d)
+                row.append(index[d])
+            trans.append(row)
+            i += 1
+        return (trans, [acc1[q1] and acc2[q2] for (q1, q2) in pairs])
+
+    def closure(self, q):
+        """ Epsilon closure of a single NFA state. """
+        if not q in self.closures:
+            res = set([q])
+            stack = [q]
+            while stack:
+                x = stack.pop()
+                for d in self.eps[x]:
+                    if not d in res:
+                        res.add(d)
+                        stack.append(d)
+            self.closures[q] = frozenset(res)
+        return self.closures[q]
+
+    def subset_closure(self, qs):
+        res = set()
+        for q in qs:
+            res |= self.closure(q)
+        return frozenset(res)
+
+    def subset_construction(self, start, complete=False):
+        """ Determinize the NFA from state `start`. Returns the list of DFA
+        states (frozensets of NFA states, initial state first) and the
+        transitions. If `complete` is set, transitions are a list of rows with
+        one destination index per symbol class, and the empty (dead) subset is
+        included as a state. Otherwise they are a list of {class: index}
+        dictionaries, and transitions to the empty subset are omitted. """
+        q0 = self.subset_closure([start])
+        index = {q0: 0}
+        subsets = [q0]
+        trans = []
+        i = 0
+        while i < len(subsets):
+            moves = {}
+            for q in subsets[i]:
+                for (k, ds) in self.trans[q].iteritems():
+                    moves.setdefault(k, set()).update(ds)
+            row = [] if complete else {}
+            for k in range(self.num_classes):
+                if k in moves:
+                    d = self.subset_closure(moves[k])
+                elif complete:
+                    d = frozenset()
+                else:
+                    continue
+                if not d in index:
+                    index[d] = len(subsets)
+                    subsets.append(d)
+                if complete:
+                    row.append(index[d])
+                else:
+                    row[k] = index[d]
+            trans.append(row)
+            i += 1
+        return (subsets, trans)
+
+def regexes_to_subset_dfa(re_list, alphabet=[]):
+    """ Build a DFA for the union of the expressions in `re_list`, where
+    accepting states record the ordinals of the expressions they accept.
+
+    Returns (state_num, final_states, edges, edge_ordinals) in the format of
+    the ragel-generated DFAs used by the path query compiler: the initial
+    state is None, the other states are numbered from 1 with accepting states
+    last, state number `state_num` is reserved for the dead state, `edges` is
+    a list of (src, symbol, dst) triples (edges to the dead state and from
+    states which cannot reach an accepting state are left out), and
+    `edge_ordinals` maps each edge to the list of expressions accepted on
+    entering its destination.
+    """
+    (sym_to_class, class_to_syms) = get_symbol_classes(re_list, alphabet)
+    nfa = re_nfa(sym_to_class, len(class_to_syms))
+    start = nfa.new_state()
+    finals = {}
+    for (i, r) in enumerate(re_list):
+        (s, e) = nfa.add_fragment(r)
+        nfa.add_eps(start, s)
+        finals[e] = i
+    (subsets, trans) = nfa.subset_construction(start)
+    ords = [sorted(set([finals[q] for q in qs if q in finals]))
+            for qs in subsets]
+
+    ''' Drop states which can not reach an accepting state. '''
+    preds = [set() for q in subsets]
+    for (q, row) in enumerate(trans):
+        for d in row.values():
+            preds[d].add(q)
+    live = set([q for q in range(len(subsets)) if ords[q]])
+    stack = list(live)
+    while stack:
+        q = stack.pop()
+        for p in preds[q]:
+            if not p in live:
+                live.add(p)
+                stack.append(p)
+    live.add(0)
+
+    ''' Number states the way ragel does. '''
+    others = [q for q in range(1, len(subsets)) if q in live]
+    ordered = ([q for q in others if not ords[q]] +
+               [q for q in others if ords[q]])
+    num = {0: None}
+    for (i, q) in enumerate(ordered):
+        num[q] = i + 1
+    state_num = len(ordered) + 1
+    final_states = [num[q] for q in range(len(subsets))
+                    if q in live and ords[q]]
+
+    edges = []
+    edge_ordinals = {}
+    for q in [0] + ordered:
+        for (k, d) in sorted(trans[q].items()):
+            if not d in live:
+                continue
+            for sym in class_to_syms[k]:
+                edge = (num[q], sym, num[d])
+                edges.append(edge)
+                edge_ordinals[edge] = ords[d]
+    return (state_num, final_states, edges, edge_ordinals)
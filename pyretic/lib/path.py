@@ -36,6 +36,7 @@ from pyretic.lib.query import counts, packets
 from pyretic.core.runtime import virtual_field, virtual_virtual_field
 
 from pyretic.lib.re import *
+from pyretic.lib.nfa import parse_re_string, regexes_to_subset_dfa
 
 import subprocess
 import pyretic.vendor
@@ -48,10 +49,16 @@ from pyretic.core import util
 import pickle
 from pyretic.evaluations.stat import Stat
 from netaddr import IPNetwork, cidr_merge
+from ipaddr import IPv4Network
 import time
 import logging
 import sys
+import weakref
 from collections import Counter
+import multiprocessing
+import math
+import cPickle
+from cStringIO import StringIO
 
 TOKEN_START_VALUE = 0 # start with printable ASCII for visual inspection ;)
 TOKEN_END_VALUE = 0xFFFFFFFF 
@@ -73,6 +80,22 @@ QS_MAX_PROCESSES = 6
 par_frenetics_started=False
 # Maximum number of states allowed
 NUM_PATH_TAGS=32000
+# Per-switch rule budget of each query stage's tables, for stage packing
+STAGE_RULE_LIMIT = 2000
+# Header bits (VLAN pcp and id) carrying the path tags of all stages together
+MAX_TAG_BITS = 15
+
+# Fields which query predicates usually pin to one value; existing leaf-level
+# predicates are indexed by them to skip overlap checks on disjoint ones.
+INDEX_FIELDS = ['switch', 'port']
+OVERLAP_CACHE_SIZE = 1000000
+# Order of fields tested in predicate FDDs, from the root. Fields not listed
+# here are tested after these, by name.
+FDD_FIELD_ORDER = ['switch', 'port', 'inport', 'outport', 'vlan_id',
+                   'vlan_pcp', 'ethtype', 'srcmac', 'dstmac', 'protocol',
+                   'tos', 'srcip', 'dstip', 'srcport', 'dstport']
+FDD_FIELD_RANK = {f: i for (i, f) in enumerate(FDD_FIELD_ORDER)}
+FDD_CACHE_SIZE = 1000000
 # virtual stage identifier for virtual virtual headers. An unreasonably high
 # number that can never be a "stage" for virtual header fields that actually
 # live in the data plane.
@@ -162,6 +185,53 @@ class classifier_utils(object):
 
         return (is_equal, is_superset, is_subset, intersects, new_and_not_pred, not_new_and_pred)
 
+    overlap_cache = {}
+
+    @classmethod
+    def get_overlap_mode_cached(cls, pred, pred_neg, new_pred, new_pred_neg):
+        """ get_overlap_mode, memoized on (pred, new_pred) across
+        compilations. Only use this for predicates without dynamic
+        sub-policies, whose meaning can not change under the cache. """
+        key = (pred, new_pred)
+        if key in cls.overlap_cache:
+            return cls.overlap_cache[key]
+        res = cls.get_overlap_mode(pred, pred_neg, new_pred, new_pred_neg)
+        if len(cls.overlap_cache) >= OVERLAP_CACHE_SIZE:
+            cls.overlap_cache = {}
+        cls.overlap_cache[key] = res
+        return res
+
+    @classmethod
+    def get_exact_value(cls, p, field):
+        """ Return v if every packet matched by filter p has p[field] == v,
+        and None if there is no such value (or it can't be determined
+        syntactically).
+
+        :param p: filter
+        :type p: Filter
+        """
+        if isinstance(p, match):
+            return p.map.get(field, None)
+        elif isinstance(p, intersection):
+            for x in p.policies:
+                v = cls.get_exact_value(x, field)
+                if v is not None:
+                    return v
+            return None
+        elif isinstance(p, union):
+            vals = [cls.get_exact_value(x, field) for x in p.policies]
+            if vals and vals[0] is not None and vals.count(vals[0]) == len(vals):
+                return vals[0]
+            return None
+        else:
+            return None
+
+    @classmethod
+    def get_index_key(cls, p):
+        """ Key of filter p in indexes of predicates by their exact fields
+        (INDEX_FIELDS). None stands for "any value". """
+        return tuple([cls.get_exact_value(p, f) for f in INDEX_FIELDS])
+
     @classmethod
     def get_dropped_packets(cls, p):
         """For an arbitrary policy p, return the set of packets (as a filter
@@ -180,26 +250,80 @@ class classifier_utils(object):
                 matched_packets += rule.match
         return ~matched_packets
 
+class leaf_pred_index(object):
+    """ Index of leaf-level predicates by their exact values of INDEX_FIELDS
+    (see classifier_utils.get_index_key), as nested dictionaries with one
+    level per field. Predicates whose value of a field isn't known are kept
+    under None at that level.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, pred):
+        d = self.root
+        key = classifier_utils.get_index_key(pred)
+        for v in key[:-1]:
+            d = d.setdefault(v, {})
+        d.setdefault(key[-1], set()).add(pred)
+
+    def remove(self, pred):
+        key = classifier_utils.get_index_key(pred)
+        path = [self.root]
+        for v in key[:-1]:
+            path.append(path[-1][v])
+        path[-1][key[-1]].discard(pred)
+        for (d, v) in reversed(zip(path, key)):
+            if d[v]:
+                break
+            del d[v]
+
+    def candidates(self, pred):
+        """ All indexed predicates which are not disjoint from `pred` by
+        their exact field values. """
+        res = []
+        def collect(d, key):
+            if key[0] is None:
+                vals = d.keys()
+            else:
+                vals = [v for v in [key[0], None] if v in d]
+            for v in vals:
+                if len(key) == 1:
+                    res.extend(d[v])
+                else:
+                    collect(d[v], key[1:])
+        collect(self.root, classifier_utils.get_index_key(pred))
+        return res
+
 #########################################
 #####             FDD               #####
 #########################################
 
 class FDD(object):
+    """ A forwarding decision diagram over header tests, with sets of
+    predicate ids (or, for policies, actions; see pyretic.lib.fdd) at the
+    leaves. FDDs are hash-consed: there is only ever one Node or Leaf object
+    for a given structure (see FDDTranslator.get_node and
+    FDDTranslator.get_leaf), so FDDs can be compared and hashed by
+    identity. Tests on a Node are ordered by FDDTranslator.test_key, so that
+    tests on the same field appear as a chain along false (right) branches,
+    most specific IP prefixes first, and never under a true (left) branch of
+    a test on that field.
+    """
+    __slots__ = ['__weakref__']
 
     def level_repr(self, acc, shift):
         raise NotImplementedError
 
     def get_leaves(self):
-        raise NotImplementedError
+        return [leaf for (leaf, path) in FDDTranslator.get_paths(self, {})]
 
     def __str__(self):
         lrepr = self.level_repr([], '')
         return '\n'.join(lrepr) + "\n\n-------------------\n"
 
-    def __hash__(self):
-        return hash(str(self))
-
 class Node(FDD):
+    __slots__ = ['test', 'lchild', 'rchild']
+
     def __init__(self, test, lchild, rchild):
         assert isinstance(test, tuple) and len(test) == 2
         assert issubclass(lchild.__class__, FDD)
@@ -215,271 +339,352 @@ class Node(FDD):
         acc = (self.rchild.level_repr(acc, shift + '\t')) 
         return acc
 
-    def get_leaves(self):
-        res = self.lchild.get_leaves()
-        res += self.rchild.get_leaves()
-        return res
-
-    def __eq__(self, other):
-        return (type(self) == type(other) and
-                self.test == other.test and
-                self.lchild == other.lchild and
-                self.rchild == other.rchild)
-
     def __repr__(self):
         return self.test.__repr__()
 
 class Leaf(FDD):
+    __slots__ = ['pred_set']
 
-    def __init__(self, pred_set = frozenset(), path = ([], set())):
+    def __init__(self, pred_set = frozenset()):
         super(Leaf, self).__init__()
         self.pred_set = pred_set
-        self.path = path
-        self.symbol = None
     
     def level_repr(self, acc, shift):
         acc.append(shift + self.__repr__())
         return acc
 
-    def get_leaves(self):
-        return [self]
-
     def is_drop(self):
         return len(self.pred_set) == 0
 
     def __add__(self, other):
-        
-        new_pred_set = self.pred_set | other.pred_set
-        #new_path = self.path | other.path
-        res = Leaf(new_pred_set)
-        #print 'adding'
-        #print self.__repr__()
-        #print other.__repr__()
-        #print res.__repr__()
-        #print '-------' 
-        return res
+        return FDDTranslator.get_leaf(self.pred_set | other.pred_set)
 
     def __rshift__(self, other):
-        new_pred_set = self.pred_set & other.pred_set
-        #new_path = self.path | other.path
-        return Leaf(new_pred_set)
+        return FDDTranslator.get_leaf(self.pred_set & other.pred_set)
 
     def neg(self, pred):
         assert len(self.pred_set) < 2
         if len(self.pred_set) == 0:
-            return Leaf(set([pred])) 
-        else:
-            return Leaf()
-
-    def get_pred(self, neg_cache):
-        (true_dict, false_set) = self.path
-        if len(true_dict) == 0:
-            true_match = identity
+            return FDDTranslator.get_leaf(frozenset([pred]))
         else:
-            true_match = match(**dict(true_dict))
-        false_match = None
-        for (f, v) in false_set:
-            if f in true_dict:
-                continue
-            pred = neg_cache[(f,v)]
-            if false_match is None:
-                false_match = pred
-            else:
-                false_match &= pred
-        if false_match == None:
-            false_match = identity
-        return true_match & false_match
-
-    def __eq__(self, other):
-        res = (isinstance(other, Leaf) and self.pred_set == other.pred_set)
-        return res 
-
-    def __hash__(self):
-        return hash(self.pred_set)
+            return FDDTranslator.get_drop()
 
     def __repr__(self):
-
         res = '{'
         res += ','.join([str(x) for x in self.pred_set])
         res += '}'
-        #res += '{'
-        #res += ','.join([str(x) for x in self.path])
-        #res += "}"
         return res
 
+class fdd_chain(object):
+    """ The tests on field `f` at the top of an FDD: a dictionary `tests` from
+    the value tested to the branch taken if the test holds, and the FDD `tail`
+    reached when none of them holds. A packet takes the branch of the first
+    test it satisfies, in the order of FDDTranslator.value_key. """
+    def __init__(self, f, tests, tail):
+        self.f = f
+        self.tests = tests
+        self.tail = tail
+        self.prefix_index = None
+
+    def lookup(self, v):
+        """ The branch taken by packets whose first satisfied test, in a chain
+        that also contains the tests here, is on value `v`. """
+        if v in self.tests:
+            return self.tests[v]
+        if not isinstance(v, IPv4Network) or not self.tests:
+            return self.tail
+        # The branch of the most specific prefix in the chain containing v.
+        if self.prefix_index is None:
+            self.prefix_index = {}
+            for (q, child) in self.tests.iteritems():
+                if isinstance(q, IPv4Network):
+                    plen_index = self.prefix_index.setdefault(q.prefixlen, {})
+                    plen_index[int(q.network)] = child
+        net = int(v.network)
+        for plen in sorted(self.prefix_index.keys(), reverse=True):
+            if plen > v.prefixlen:
+                continue
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            child = self.prefix_index[plen].get(net & mask)
+            if child is not None:
+                return child
+        return self.tail
+
 class FDDTranslator(object):
-   
+    """ Construction of and operations over hash-consed FDDs.
+
+    Nodes and leaves are interned in (weak) unique tables. `merge` and `neg`
+    (built on `apply` and `map_fdd`) are memoized on the identities of their
+    operands in `apply_cache`, which is cleared whenever it grows beyond
+    FDD_CACHE_SIZE entries. Predicates
+    are first translated into boolean FDDs (with the TRUE leaf labeled None),
+    which are shared between all predicates containing the same `match`es
+    (also cached), and then relabeled with the id of the predicate.
+    """
+    node_table = weakref.WeakValueDictionary()
+    leaf_table = weakref.WeakValueDictionary()
+    apply_cache = {}
+    cache_hits = 0
+    cache_misses = 0
+
     @classmethod
-    def refine(cls, d, fmap):
-        if isinstance(d, Node):
-            (f, v) = d.test
-            if f in fmap:
-                if fmap[f] == v:
-                    return cls.refine(d.lchild, fmap)
-                else:
-                    return cls.refine(d.rchild, fmap)
-            else:
-                return d
-        else:
-            return d
+    def clear_caches(cls):
+        cls.apply_cache = {}
+        cls.cache_hits = 0
+        cls.cache_misses = 0
 
     @classmethod
-    def fmap_digest(cls, fmap, t):
-        (f, v) = t
-        if f in fmap:
-            return (True, f, fmap[f])
-        else:
-            return (False, f, None)
+    def get_num_nodes(cls):
+        """ Number of distinct FDD nodes and leaves currently alive. """
+        return len(cls.node_table) + len(cls.leaf_table)
+
+    @classmethod
+    def get_cache_hit_rate(cls):
+        total = cls.cache_hits + cls.cache_misses
+        return float(cls.cache_hits) / total if total > 0 else 0.0
+
+    @classmethod
+    def test_key(cls, test):
+        (f, v) = test
+        return (FDD_FIELD_RANK.get(f, len(FDD_FIELD_ORDER)), f,
+                cls.value_key(v))
+
+    @classmethod
+    def value_key(cls, v):
+        """ Order of tests on the same field. Longer IP prefixes come first, so
+        that the first test satisfied in a chain is the longest prefix match.
+        """
+        if isinstance(v, IPv4Network):
+            return (-v.prefixlen, int(v.network))
+        return (0, v)
 
     @classmethod
-    def revert_fmap(cls, fmap, digest):
-        (changed, f, v) = digest
-        if changed:
-            fmap[f] = v
+    def field_key(cls, f):
+        return (FDD_FIELD_RANK.get(f, len(FDD_FIELD_ORDER)), f)
+
+    @classmethod
+    def get_node(cls, test, lchild, rchild):
+        if lchild is rchild:
+            return lchild
+        key = (test, lchild, rchild)
+        node = cls.node_table.get(key)
+        if node is None:
+            node = Node(test, lchild, rchild)
+            cls.node_table[key] = node
+        return node
+
+    @classmethod
+    def get_leaf(cls, pred_set):
+        leaf = cls.leaf_table.get(pred_set)
+        if leaf is None:
+            leaf = Leaf(pred_set)
+            cls.leaf_table[pred_set] = leaf
+        return leaf
+
+    @classmethod
+    def cache_lookup(cls, key):
+        res = cls.apply_cache.get(key)
+        if res is None:
+            cls.cache_misses += 1
         else:
-            del fmap[f]
-        return fmap
-
-    @classmethod
-    def merge(cls, d1, d2, fmap, union):
-        d1 = cls.refine(d1, fmap)
-        d2 = cls.refine(d2, fmap)
-        if isinstance(d1, Node):
-            t1 = d1.test
-            if isinstance(d2, Node):
-                t2 = d2.test
-                if t1 == t2:
-                    digest = cls.fmap_digest(fmap, t1)
-                    (f, v) = t1
-                    fmap[f] = v
-                    lchild = cls.merge(d1.lchild, d2.lchild, fmap, union)
-                    fmap = cls.revert_fmap(fmap, digest)
-                    rchild = cls.merge(d1.rchild, d2.rchild, fmap, union)
-                    test = t1
-                else:
-                    if t1 > t2:
-                        d1, d2 = d2, d1
-                        t1, t2 = t2, t1
-                    
-                    (f1, v1) = t1
-                    (f2, v2) = t2
-                    digest = cls.fmap_digest(fmap, t1)
-                    fmap[f1] = v1
-                    if f1 == f2 and v1 != v2:
-                        lchild = cls.merge(d1.lchild, d2.rchild, fmap, union)
-                        fmap = cls.revert_fmap(fmap, digest)
-                        rchild = cls.merge(d1.rchild, d2, fmap, union)
-                        test = t1
-                    else:
-                        lchild = cls.merge(d1.lchild, d2, fmap, union)
-                        fmap = cls.revert_fmap(fmap, digest)
-                        rchild = cls.merge(d1.rchild, d2, fmap, union)
-                        test = t1
-                         
-            elif isinstance(d2, Leaf):
-                lchild = cls.merge(d1.lchild, d2, fmap, union)
-                rchild = cls.merge(d1.rchild, d2, fmap, union)
-                test = t1
-            else:
-                raise TypeError
-        elif isinstance(d1, Leaf):
-            if isinstance(d2, Node):
-                lchild = cls.merge(d2.lchild, d1, fmap, union)
-                rchild = cls.merge(d2.rchild, d1, fmap, union)
-                test = d2.test
-
-            elif isinstance(d2, Leaf):
-                if union:
-                    return d1 + d2
-                else:
-                    return d1 >> d2
-            else:
-                raise TypeError
-        else: 
-            raise TypeError
-        if rchild == lchild:
-            res = lchild
+            cls.cache_hits += 1
+        return res
+
+    @classmethod
+    def cache_store(cls, key, res):
+        if len(cls.apply_cache) >= FDD_CACHE_SIZE:
+            cls.apply_cache = {}
+        cls.apply_cache[key] = res
+
+    @classmethod
+    def split(cls, d, f):
+        """ Split `d` into the chain of tests on field `f` at its top. """
+        tests = {}
+        while isinstance(d, Node) and d.test[0] == f:
+            tests[d.test[1]] = d.lchild
+            d = d.rchild
+        return fdd_chain(f, tests, d)
+
+    @classmethod
+    def chain(cls, f, tests, tail):
+        """ Inverse of `split`: the FDD for a chain of tests on field `f`,
+        given as a dictionary from values to true branches. """
+        res = tail
+        for v in sorted(tests.keys(), key=cls.value_key, reverse=True):
+            res = cls.get_node((f, v), tests[v], res)
+        return res
+
+    @classmethod
+    def map_fdd(cls, d, leaf_fun, key):
+        """ Apply `leaf_fun` to every leaf of `d`. `key` identifies leaf_fun
+        for memoization. """
+        if isinstance(d, Leaf):
+            return leaf_fun(d)
+        cache_key = ('map', key, d)
+        res = cls.cache_lookup(cache_key)
+        if res is None:
+            c = cls.split(d, d.test[0])
+            tests = {}
+            for (v, child) in c.tests.iteritems():
+                tests[v] = cls.map_fdd(child, leaf_fun, key)
+            res = cls.chain(c.f, tests, cls.map_fdd(c.tail, leaf_fun, key))
+            cls.cache_store(cache_key, res)
+        return res
+
+    @classmethod
+    def apply(cls, d1, d2, leaf_fun, key, commutative=True):
+        """ Combine `d1` and `d2` pointwise: the result maps each packet to
+        leaf_fun(l1, l2), where l1 and l2 are the leaves `d1` and `d2` map it
+        to. `key` identifies leaf_fun for memoization. """
+        if commutative and id(d1) > id(d2):
+            d1, d2 = d2, d1
+        cache_key = (key, d1, d2)
+        res = cls.cache_lookup(cache_key)
+        if res is not None:
+            return res
+
+        if isinstance(d1, Leaf) and isinstance(d2, Leaf):
+            res = leaf_fun(d1, d2)
         else:
-            res = Node(test, lchild, rchild)
+            fields = [d.test[0] for d in [d1, d2] if isinstance(d, Node)]
+            f = min(fields, key=cls.field_key)
+            c1 = cls.split(d1, f)
+            c2 = cls.split(d2, f)
+            tests = {}
+            for v in set(c1.tests.keys()) | set(c2.tests.keys()):
+                tests[v] = cls.apply(c1.lookup(v), c2.lookup(v), leaf_fun,
+                                     key, commutative)
+            tail = cls.apply(c1.tail, c2.tail, leaf_fun, key, commutative)
+            res = cls.chain(f, tests, tail)
+        cls.cache_store(cache_key, res)
         return res
+
     @classmethod
-    def neg(cls, d, pred):
-        if isinstance(d, Node):
-            lchild = cls.neg(d.lchild, pred)
-            rchild = cls.neg(d.rchild, pred)
-            return Node(d.test, lchild, rchild)
-                    
-        elif isinstance(d, Leaf):
-            return d.neg(pred)
+    def merge(cls, d1, d2, union):
+        if union:
+            for (d, other) in [(d1, d2), (d2, d1)]:
+                if isinstance(d, Leaf) and d.is_drop():
+                    return other
+            return cls.apply(d1, d2, Leaf.__add__, 'union')
         else:
-            raise TypeError
+            for d in [d1, d2]:
+                if isinstance(d, Leaf) and d.is_drop():
+                    return d
+            return cls.apply(d1, d2, Leaf.__rshift__, 'inters')
 
+    @classmethod
+    def neg(cls, d, pred):
+        return cls.map_fdd(d, lambda l: l.neg(pred), ('neg', pred))
 
     @classmethod
-    def get_id(cls, pred, path = ([], set())):
-        return Leaf(frozenset([pred]), path)
+    def relabel(cls, d, pred):
+        """ Replace the TRUE leaf of boolean FDD `d` by the leaf of `pred`. """
+        def relabel_leaf(l):
+            return l if l.is_drop() else cls.get_id(pred)
+        return cls.map_fdd(d, relabel_leaf, ('relabel', pred))
 
     @classmethod
-    def get_drop(cls, path = ([], set())):
-        return Leaf(frozenset(), path)
+    def get_id(cls, pred):
+        return cls.get_leaf(frozenset([pred]))
 
-    @classmethod 
-    def translate(cls, pol, pred):
+    @classmethod
+    def get_drop(cls):
+        return cls.get_leaf(frozenset())
+
+    @classmethod
+    def translate_bool(cls, pol):
         if pol == identity:
-            return cls.get_id(pred)            
+            return cls.get_id(None)
         if pol == drop:
             return cls.get_drop()
 
         typ = type(pol)
         if issubclass(typ, DynamicFilter):
-            return cls.translate(pol.policy, pred)
+            return cls.translate_bool(pol.policy)
         if typ == match:
-            fmap = pol.map.items()
-            (f, v) = fmap[0]
-            res = Node((f, v), cls.get_id(pred), cls.get_drop())
-
-            for (f, v) in fmap[1:]:
-                new_match = Node((f, v), cls.get_id(pred), cls.get_drop())
-                res = cls.merge(res, new_match, {}, False)
+            key = ('match', pol)
+            res = cls.cache_lookup(key)
+            if res is None:
+                res = cls.get_id(None)
+                for (f, v) in sorted(pol.map.items(), key=cls.test_key,
+                                     reverse=True):
+                    res = cls.get_node((f, v), res, cls.get_drop())
+                cls.cache_store(key, res)
             return res
 
         elif typ == negate:
-            inner_pol = cls.translate(pol.policies[0], pred)
-            return cls.neg(inner_pol, pred)
+            inner_pol = cls.translate_bool(pol.policies[0])
+            return cls.neg(inner_pol, None)
        
         elif issubclass(typ, union):
-            res = cls.translate(pol.policies[0], pred)            
+            res = cls.translate_bool(pol.policies[0])
             for p in pol.policies[1:]:
-                p_fdd = cls.translate(p, pred)
-                res = cls.merge(res, p_fdd, {}, True)
+                res = cls.merge(res, cls.translate_bool(p), True)
             return res
         
         if issubclass(typ, intersection):
-            res = cls.translate(pol.policies[0], pred)
+            res = cls.translate_bool(pol.policies[0])
             for p in pol.policies[1:]:
-                p_fdd = cls.translate(p, pred)
-                res = cls.merge(res, p_fdd, {}, False)
+                res = cls.merge(res, cls.translate_bool(p), False)
             return res
         raise TypeError
 
+    @classmethod 
+    def translate(cls, pol, pred):
+        return cls.relabel(cls.translate_bool(pol), pred)
+
     @classmethod
-    def assign_path(cls, fdd, path, neg_cache):
-        if isinstance(fdd, Node):
-            (true_dict, false_set) = path
-            (f, v) = fdd.test
-            assert not f in true_dict
-            true_dict[f] = v
-            cls.assign_path(fdd.lchild, path, neg_cache)
-            del true_dict[f]
-            new_false = false_set | {(f, v)}
-            if not (f,v) in neg_cache:
-                neg_cache[(f,v)] = ~match(**{f:v})
-            cls.assign_path(fdd.rchild, (true_dict, new_false), neg_cache)
-        elif isinstance(fdd, Leaf):
-            (true_dict, false_set) = path
-            fdd.path = (true_dict.items(), false_set)
+    def get_paths(cls, fdd, neg_cache):
+        """ List of (leaf, path) for all paths of `fdd`, where path is a pair
+        of the tests that are true (as a list of (field, value)) and the set of
+        tests that are false along it. """
+        res = []
+        def visit(d, true_dict, false_set):
+            if isinstance(d, Node):
+                f = d.test[0]
+                assert not f in true_dict
+                c = cls.split(d, f)
+                prev = []
+                for v in sorted(c.tests.keys(), key=cls.value_key):
+                    true_dict[f] = v
+                    # Of the tests before v, only (more specific) prefixes
+                    # within v can hold for packets satisfying v.
+                    subsumed = set([(f, w) for w in prev
+                                    if isinstance(v, IPv4Network) and w in v])
+                    visit(c.tests[v], true_dict, false_set | subsumed)
+                    del true_dict[f]
+                    if not (f,v) in neg_cache:
+                        neg_cache[(f,v)] = ~match(**{f:v})
+                    prev.append(v)
+                visit(c.tail, true_dict,
+                      false_set | set([(f, v) for v in c.tests]))
+            elif isinstance(d, Leaf):
+                res.append((d, (true_dict.items(), false_set)))
+            else:
+                raise TypeError
+        visit(fdd, {}, frozenset())
+        return res
+
+    @classmethod
+    def get_path_pred(cls, path, neg_cache):
+        (true_items, false_set) = path
+        true_dict = dict(true_items)
+        if len(true_dict) == 0:
+            true_match = identity
         else:
-            raise TypeError
+            true_match = match(**true_dict)
+        false_match = None
+        for (f, v) in false_set:
+            if f in true_dict and not isinstance(v, IPv4Network):
+                continue
+            pred = neg_cache[(f,v)]
+            if false_match is None:
+                false_match = pred
+            else:
+                false_match &= pred
+        if false_match == None:
+            false_match = identity
+        return true_match & false_match
 
 
 class fdd_re_tree_gen(object):
@@ -493,10 +698,11 @@ class fdd_re_tree_gen(object):
         self.neg_cache = {}
 
         self.pred_to_atoms = {}
-        self.pred_to_leafs = {}
+        self.pred_to_symbols = {}
         self.symbol_to_leaf = {}
         self.symbol_to_pred = {}
         self.leaf_list = []
+        self.pred_fdds = []
         self.base = None
         self.dyn_preds = []
 
@@ -506,10 +712,11 @@ class fdd_re_tree_gen(object):
         self.neg_cache = {}
 
         self.pred_to_atoms = {}
-        self.pred_to_leafs = {}
+        self.pred_to_symbols = {}
         self.symbol_to_leaf = {}
         self.symbol_to_pred = {}
         self.leaf_list = []
+        self.pred_fdds = []
         self.base = None
         self.dyn_preds = []
 
@@ -517,7 +724,7 @@ class fdd_re_tree_gen(object):
     def global_sym_list(cls):
         res = []
         for cg in cls.in_cg_list + cls.out_cg_list:
-            res.extend([l.token for l in cg.leaf_list])
+            res.extend(cg.symbol_to_pred.keys())
         return res
 
     @classmethod
@@ -565,50 +772,60 @@ class fdd_re_tree_gen(object):
         
         self.pred_to_atoms[pred] = [at]
         self.num_to_pred[self.next] = pred
-        pred_fdd = FDDTranslator.translate(pred, self.next)
+        self.pred_fdds.append(FDDTranslator.translate(pred, self.next))
         self.next += 1
-        #FDDTranslator.assign_path(pred_fdd, set())
-        if self.base == None:
-            self.base = pred_fdd
-        else:
-            self.base = FDDTranslator.merge(pred_fdd, self.base, {}, True)
 
     def prep_re_tree(self):
-        FDDTranslator.assign_path(self.base, ({}, set()), self.neg_cache)
-        self.leaf_list = self.base.get_leaves()
-        for leaf in self.leaf_list:
+        """ Union the FDDs of all predicates, pairwise in rounds so that large
+        diagrams are merged only O(log n) times, and give each path to a
+        non-drop leaf its own symbol. """
+        fdds = self.pred_fdds
+        if not fdds:
+            return
+        while len(fdds) > 1:
+            merged = []
+            for i in range(0, len(fdds) - 1, 2):
+                merged.append(FDDTranslator.merge(fdds[i], fdds[i+1], True))
+            if len(fdds) % 2 == 1:
+                merged.append(fdds[-1])
+            fdds = merged
+        self.base = fdds[0]
+
+        paths = FDDTranslator.get_paths(self.base, self.neg_cache)
+        self.leaf_list = [leaf for (leaf, path) in paths]
+        for (leaf, path) in paths:
             if leaf.is_drop():
                 continue
             sym = self.__new_symbol__()
-            leaf.symbol = sym
             self.symbol_to_leaf[sym] = leaf
-            self.symbol_to_pred[sym] = leaf.get_pred(self.neg_cache)
+            self.symbol_to_pred[sym] = FDDTranslator.get_path_pred(
+                path, self.neg_cache)
             for pred_id in leaf.pred_set:
                 pred = self.num_to_pred[pred_id]
-                if not pred in self.pred_to_leafs:
-                    self.pred_to_leafs[pred] = []
-                self.pred_to_leafs[pred].append(leaf)
+                if not pred in self.pred_to_symbols:
+                    self.pred_to_symbols[pred] = []
+                self.pred_to_symbols[pred].append(sym)
     
     def get_re_tree(self, pred, at):
         assert isinstance(at, abstract_atom)
         assert isinstance(pred, Filter)
          
-        if not pred in self.pred_to_leafs:
+        if not pred in self.pred_to_symbols:
             return re_empty()
         
         re_tree = re_empty()
-        for leaf in self.pred_to_leafs[pred]:
-            re_tree |= re_symbol(leaf.symbol, metadata=at)
+        for sym in self.pred_to_symbols[pred]:
+            re_tree |= re_symbol(sym, metadata=at)
         return re_tree
  
     def get_re_string(self, pred, at):
         assert isinstance(at, abstract_atom)
         assert isinstance(pred, Filter)
          
-        if not pred in self.pred_to_leafs:
+        if not pred in self.pred_to_symbols:
             return "^any"
         
-        syms = [str(leaf.symbol) for leaf in self.pred_to_leafs[pred]]
+        syms = [str(sym) for sym in self.pred_to_symbols[pred]]
         return '(' + string.join(syms, ')|(') + ')'
 
     def get_leaf_preds(self):
@@ -635,8 +852,8 @@ class fdd_re_tree_gen(object):
     def __new_symbol__(self):
         """ Returns a new token/symbol for a leaf-level predicate. """
         self.__new_token__()
-        sym_list = re_tree_gen.global_sym_list()
-        while re_tree_gen.token in sym_list:
+        cg_list = fdd_re_tree_gen.in_cg_list + fdd_re_tree_gen.out_cg_list
+        while any([re_tree_gen.token in cg.symbol_to_pred for cg in cg_list]):
             self.__new_token__()
 
         return re_tree_gen.token
@@ -663,6 +880,7 @@ class re_tree_gen(object):
     token = TOKEN_START_VALUE
     in_cg_list = []
     out_cg_list = []
+    pred_index_enabled = True
 
     def __init__(self, switch_cnt = None, 
                     cache_enabled = False, partition_enabled = False):
@@ -683,6 +901,8 @@ class re_tree_gen(object):
         self.pred_to_neg = {}
         self.dyn_preds      = []
         self.cache = {}
+        self.pred_index = leaf_pred_index()
+        self.dyn_leaf_preds = set()
     
     @classmethod
     def global_sym_list(cls):
@@ -739,18 +959,21 @@ class re_tree_gen(object):
         return output
 
     
-    def __add_pred__(self, pred, symbol, atoms, pred_neg, partition=None):
+    def __add_pred__(self, pred, symbol, atoms, pred_neg, partition=None,
+                     dynamic=False):
         """ Add a new predicate to the global state. """
         if self.simple:
             pred_to_sym = self.pred_to_symbol
             pred_to_atoms = self.pred_to_atoms
             pred_to_neg = self.pred_to_neg
             sym_to_pred = self.symbol_to_pred
+            pred_index = self.pred_index
         else:
             pred_to_sym = self.pred_to_symbol[partition]
             pred_to_atoms = self.pred_to_atoms[partition]
             pred_to_neg = self.pred_to_neg[partition]
             sym_to_pred = self.part_symbol_to_pred[partition]
+            pred_index = self.pred_index[partition]
 
         assert not pred in pred_to_sym
         assert not pred in pred_to_atoms
@@ -761,6 +984,10 @@ class re_tree_gen(object):
         pred_to_atoms[pred] = atoms
         pred_to_neg[pred] = pred_neg
 
+        pred_index.add(pred)
+        if dynamic:
+            self.dyn_leaf_preds.add(pred)
+
         if not self.simple:
             self.symbol_to_pred[symbol] = pred
     
@@ -780,11 +1007,13 @@ class re_tree_gen(object):
             pred_atoms = self.pred_to_atoms
             pred_neg = self.pred_to_neg
             sym_pred = self.symbol_to_pred
+            pred_index = self.pred_index
         else:
             pred_sym = self.pred_to_symbol[partition]
             pred_atoms = self.pred_to_atoms[partition]
             pred_neg = self.pred_to_neg[partition]
             sym_pred = self.part_symbol_to_pred[partition]
+            pred_index = self.pred_index[partition]
 
         symbol = pred_sym[pred]
 
@@ -793,6 +1022,9 @@ class re_tree_gen(object):
         del pred_atoms[pred]
         del pred_neg[pred]
 
+        pred_index.remove(pred)
+        self.dyn_leaf_preds.discard(pred)
+
         if not self.simple:
             del self.symbol_to_pred[symbol]
 
@@ -804,8 +1036,8 @@ class re_tree_gen(object):
     def __new_symbol__(self):
         """ Returns a new token/symbol for a leaf-level predicate. """
         self.__new_token__()
-        sym_list = re_tree_gen.global_sym_list()
-        while re_tree_gen.token in sym_list:
+        cg_list = re_tree_gen.in_cg_list + re_tree_gen.out_cg_list
+        while any([re_tree_gen.token in cg.symbol_to_pred for cg in cg_list]):
             self.__new_token__()
 
         return re_tree_gen.token
@@ -939,10 +1171,12 @@ class re_tree_gen(object):
             pred_to_symbol = self.pred_to_symbol
             pred_to_atoms = self.pred_to_atoms
             pred_to_neg = self.pred_to_neg
+            pred_index = self.pred_index
         else:
             pred_to_symbol = self.pred_to_symbol[partition]
             pred_to_atoms = self.pred_to_atoms[partition]
             pred_to_neg = self.pred_to_neg[partition]
+            pred_index = self.pred_index[partition]
 
         ne_inters   = classifier_utils.has_nonempty_intersection
         is_not_drop = classifier_utils.is_not_drop
@@ -951,9 +1185,9 @@ class re_tree_gen(object):
         del_pred = self.__del_pred__
         replace_pred = self.__replace_pred__
         ovlap = classifier_utils.get_overlap_mode
+        ovlap_cached = classifier_utils.get_overlap_mode_cached
 
         re_tree = re_empty()
-        pred_list = pred_to_symbol.keys()
 
         """ Record dynamic predicates separately for update purposes."""
         dyn_pols = path_policy_utils.get_dyn_pols(new_pred)
@@ -962,6 +1196,15 @@ class re_tree_gen(object):
             explicitly to set up recompilation routines in the runtime."""
             self.__add_dyn_preds__(dyn_pols, at.policy)
         new_pred_neg = ~new_pred
+        dynamic = len(dyn_pols) > 0
+
+        """ Only existing predicates which may intersect new_pred need to be
+        looked at. Parts of new_pred keep its exact field values, so the
+        candidates stay valid as new_pred shrinks below. """
+        if self.pred_index_enabled:
+            pred_list = pred_index.candidates(new_pred)
+        else:
+            pred_list = pred_to_symbol.keys()
 
         """ For each case of overlap between new and existing predicates, do
         actions that will only retain and keep track of non-overlapping
@@ -971,7 +1214,11 @@ class re_tree_gen(object):
             pred_atoms = pred_to_atoms[pred]
             pred_symbol = pred_to_symbol[pred]
             pred_neg = pred_to_neg[pred]
-            (is_equal,is_superset,is_subset,intersects, new_and_not_pred, not_new_and_pred) = ovlap(pred, pred_neg, new_pred, new_pred_neg)
+            pred_dynamic = pred in self.dyn_leaf_preds
+            if dynamic or pred_dynamic:
+                (is_equal,is_superset,is_subset,intersects, new_and_not_pred, not_new_and_pred) = ovlap(pred, pred_neg, new_pred, new_pred_neg)
+            else:
+                (is_equal,is_superset,is_subset,intersects, new_and_not_pred, not_new_and_pred) = ovlap_cached(pred, pred_neg, new_pred, new_pred_neg)
             if not is_not_drop(new_pred):
                 """ i.e., new_pred empty """
                 re_tree |= re_empty()
@@ -983,8 +1230,10 @@ class re_tree_gen(object):
             elif is_superset:
                 inter = pred & new_pred_neg
                 inter_neg = ~inter
-                add_pred(pred & new_pred_neg, new_sym(), pred_atoms, inter_neg, partition)
-                add_pred(new_pred, new_sym(), pred_atoms + [at], new_pred_neg, partition)
+                add_pred(pred & new_pred_neg, new_sym(), pred_atoms, inter_neg,
+                         partition, dynamic or pred_dynamic)
+                add_pred(new_pred, new_sym(), pred_atoms + [at], new_pred_neg,
+                         partition, dynamic or pred_dynamic)
                 replace_pred(pred, [inter, new_pred], partition)
                 del_pred(pred, partition)
                 added_sym = pred_to_symbol[new_pred]
@@ -994,6 +1243,7 @@ class re_tree_gen(object):
                 new_pred = new_pred & pred_neg
                 #new_pred_not_drop = new_and_not_pred
                 new_pred_neg = ~new_pred
+                dynamic = dynamic or pred_dynamic
                 pred_atoms.append(at)
                 re_tree |= re_symbol(pred_symbol, metadata=at)
             elif intersects:
@@ -1001,8 +1251,10 @@ class re_tree_gen(object):
                 inter_neg = ~inter
                 inter_p = pred & new_pred
                 inter_p_neg = ~inter_p
-                add_pred(inter, new_sym(), pred_atoms, inter_neg, partition)
-                add_pred(inter_p, new_sym(), pred_atoms + [at], inter_p_neg, partition)
+                add_pred(inter, new_sym(), pred_atoms, inter_neg, partition,
+                         dynamic or pred_dynamic)
+                add_pred(inter_p, new_sym(), pred_atoms + [at], inter_p_neg,
+                         partition, dynamic or pred_dynamic)
                 replace_pred(pred, [inter, inter_p], partition)
                 del_pred(pred, partition)
                 added_sym = pred_to_symbol[inter_p]
@@ -1010,13 +1262,15 @@ class re_tree_gen(object):
                 new_pred = new_pred & pred_neg
                 #new_pred_not_drop = new_and_not_pred
                 new_pred_neg = ~new_pred
+                dynamic = dynamic or pred_dynamic
             else:
                 pass
         if is_not_drop(new_pred):
             """ The new predicate should be added if some part of it doesn't
             intersect any existing predicate, i.e., new_pred is not drop.
             """
-            add_pred(new_pred, new_sym(), [at], new_pred_neg, partition)
+            add_pred(new_pred, new_sym(), [at], new_pred_neg, partition,
+                     dynamic)
             added_sym = pred_to_symbol[new_pred]
             re_tree |= re_symbol(added_sym, metadata=at)
         
@@ -1030,6 +1284,8 @@ class re_tree_gen(object):
         self.pred_to_neg = {}
         self.dyn_preds = []
         self.cache = {}
+        self.pred_index = leaf_pred_index()
+        self.dyn_leaf_preds = set()
         
         if not self.simple:
             self.part_symbol_to_pred = {}
@@ -1038,6 +1294,7 @@ class re_tree_gen(object):
                self.pred_to_atoms[i] = {}
                self.part_symbol_to_pred[i] = {}
                self.pred_to_neg[i] = {}
+               self.pred_index[i] = leaf_pred_index()
 
 
     def get_symlist(self):
@@ -1232,6 +1489,21 @@ class dynamic_path_policy(path_policy):
 
 class path_policy_utils(object):
     """ Utilities to manipulate path policy ASTs. """
+    @classmethod
+    def get_primitive_pathpols(cls, path_pol):
+        """ The set of path policies in `path_pol` which are not unions or
+        dynamic path policies, i.e., the individual queries. """
+        def collect_primitive_pathpols(acc, p, in_cg=None, out_cg=None):
+            if isinstance(p, path_policy_union) or isinstance(
+                    p, dynamic_path_policy):
+                return acc
+            elif isinstance(p, path_policy):
+                return acc | set([p])
+            else:
+                raise TypeError("Expecting type path_policy")
+        return cls.path_policy_ast_fold(path_pol, collect_primitive_pathpols,
+                                        set([]))
+
     @classmethod
     def path_policy_ast_fold(cls, ast, fold_f, acc, in_cg=None, out_cg=None):
         """ Fold the AST with a function fold_f, which also takes a default
@@ -1777,6 +2049,15 @@ class path_inters(path_combinator):
 #############################################################################
 
 class QuerySwitch(Policy):
+    """ Dispatch on the value of field `tag`: packets whose `tag` is a key of
+    `policy_dic` are processed by its policy, all others (and those dropped by
+    that policy) by the set of policies `default`.
+
+    Matches on each (tag, value) are shared by all QuerySwitches through
+    `tag_matches`. For evaluation, the tag is decoded from the packet once,
+    and looked up in a dictionary built from the (translated) tag matches; it
+    is rebuilt when the bits of the tag's virtual field change. """
+    tag_matches = {}
 
     def __init__(self, tag, policy_dic, default):
         #TODO (mina): add type checks
@@ -1784,27 +2065,139 @@ class QuerySwitch(Policy):
         self.tag = tag
         self.policy_dic = policy_dic
         self.default = default
+        self.dispatch = None
+        self.compiled_tags = {}
+
+    @classmethod
+    def get_tag_match(cls, tag, tag_value):
+        """ The match on `tag` having `tag_value`, rebuilt when its translation
+        to header fields changes (see get_tag_signature). """
+        key = (tag, tag_value)
+        sig = cls.get_tag_signature(tag)
+        (old_sig, m) = cls.tag_matches.get(key, (None, None))
+        if m is None or old_sig != sig:
+            m = match(**{tag: tag_value})
+            cls.tag_matches[key] = (sig, m)
+        return m
+
+    @classmethod
+    def get_tag_signature(cls, tag):
+        """ What the translation of a match on `tag` to header fields depends
+        on: the fields sharing the virtual field stage of `tag`, and the bit
+        allocation of the stages. None if `tag` is not a virtual field. """
+        from pyretic.core.runtime import abstract_virtual_field as avf
+        vcls = avf.get_class(tag)
+        if vcls is None:
+            return None
+        stage = vcls.fields[tag].stage
+        return (vcls, tuple(sorted(vcls.stages[stage], key=lambda f: f.name)),
+                vcls.stage_offset_nbits.get(stage), len(vcls.stages))
+
+    def get_dispatch(self):
+        """ The dictionary used by `eval` to find the tag value of a packet,
+        as (kind, key, table). `kind` is
+
+        - 'vlan': `table` maps the VLAN bits of the tag's stage (mask `key`)
+          to tag values;
+        - 'field': `table` maps values of the (exactly matched) field `key` to
+          tag values;
+        - 'scan': `table` is the list of (tag value, match) to try in turn.
+        """
+        from pyretic.core.language import _match, tagging_headers
+        sig = (self.get_tag_signature(self.tag), len(self.policy_dic))
+        if self.dispatch is not None and self.dispatch[0] == sig:
+            return self.dispatch[1]
+        tag_maps = [(v, _match(**{self.tag: v}).map) for v in self.policy_dic]
+        vlan_keys = set(['vlan_id', 'vlan_pcp', 'vlan_offset', 'vlan_nbits',
+                         'vlan_total_stages'])
+        masks = set([(m['vlan_offset'], m['vlan_nbits'],
+                      m['vlan_total_stages'])
+                     for (_, m) in tag_maps if set(m.keys()) == vlan_keys])
+        fields = set([(m.keys()[0] if len(m) == 1 else None)
+                      for (_, m) in tag_maps])
+        res = None
+        if len(masks) == 1 and all([len(m) == len(vlan_keys)
+                                    for (_, m) in tag_maps]):
+            (offset, nbits, total_stages) = list(masks)[0]
+            mask = ((1 << nbits) - 1) << offset
+            table = {}
+            for (v, m) in tag_maps:
+                vlan_16bit = m['vlan_id'] | (m['vlan_pcp'] << 12)
+                table.setdefault(vlan_16bit & mask, v)
+            res = ('vlan', (mask, total_stages), table)
+        elif (len(fields) == 1 and
+              not list(fields)[0] in [None, 'srcip', 'dstip'] + tagging_headers
+              and all([m.values()[0] is not None for (_, m) in tag_maps])):
+            table = {}
+            for (v, m) in tag_maps:
+                table.setdefault(m.values()[0], v)
+            res = ('field', list(fields)[0], table)
+        else:
+            res = ('scan', None, [(v, _match(**m)) for (v, m) in tag_maps])
+        self.dispatch = (sig, res)
+        return res
+
+    def get_tag_value(self, pkt):
+        """ The key of `policy_dic` matching `pkt`, or `self` if none does. """
+        (kind, key, table) = self.get_dispatch()
+        try:
+            if kind == 'vlan':
+                (mask, total_stages) = key
+                pkt['vlan_pcp']
+                if ('vlan_total_stages' in pkt.available_fields() and
+                    pkt['vlan_total_stages'] != total_stages):
+                    return self
+                return table.get(pkt['vlan_id'] & mask, self)
+            elif kind == 'field':
+                return table.get(pkt[key], self)
+        except KeyError:
+            return self
+        for (tag_value, m) in table:
+            if m.eval(pkt):
+                return tag_value
+        return self
 
     def eval(self, pkt):
-        from pyretic.core.language import _match
         def eval_defaults(pkt):
             res = set()
             for act in self.default:
                 res |= act.eval(pkt)
             return res
 
-        for tag_value in self.policy_dic:
-            match_pol = match(**{self.tag:tag_value})
-            res = match_pol.eval(pkt)
-            if res:
-                pol_res = self.policy_dic[tag_value].eval(pkt)
-                if not pol_res:
-                    pol_res = eval_defaults(pkt)
-                
-                return pol_res
-        
-        return eval_defaults(pkt)
-    
+        tag_value = self.get_tag_value(pkt)
+        if tag_value is self:
+            return eval_defaults(pkt)
+        pol_res = self.policy_dic[tag_value].eval(pkt)
+        if not pol_res:
+            pol_res = eval_defaults(pkt)
+        return pol_res
+
+    @classmethod
+    def specialize_rules(cls, tag, tag_value, p_rules, comp_defaults,
+                         new_matches=None):
+        """ Specialize the rules of the policy for `tag_value` to packets
+        carrying that value of `tag`. `new_matches`, if given, are the
+        specialized matches of `p_rules`, e.g., from an earlier compilation.
+        """
+        if new_matches is None:
+            tag_match = cls.get_tag_match(tag, tag_value)
+            new_matches = []
+            for r in p_rules:
+                new_match = r.match.intersect(tag_match)
+                new_matches.append(new_match.compile().rules[0].match)
+        final_rules = []
+        for (r, new_match) in zip(p_rules, new_matches):
+            if new_match == drop:
+                raise TypeError
+            new_r = copy.copy(r)
+            new_r.match = new_match
+            if not new_r.actions:
+                new_r.actions = comp_defaults
+            new_r.parents = [r]
+            new_r.op = "switch"
+            final_rules.append(new_r)
+        return (final_rules, new_matches)
+
     def compile(self):
         from pyretic.core.classifier import Rule, Classifier
         def resolve_virtual_fields(act):
@@ -1824,20 +2217,22 @@ class QuerySwitch(Policy):
         
         comp_defaults = set(map(resolve_virtual_fields, self.default))
         final_rules = []
+        sig = self.get_tag_signature(self.tag)
+        compiled_tags = {}
         for tag_value in self.policy_dic:
-            p_rules = self.policy_dic[tag_value].compile().rules
-            for r in p_rules:
-                new_match = r.match.intersect(match(**{self.tag : tag_value}))
-                new_match = new_match.compile().rules[0].match
-                if new_match == drop:
-                    raise TypeError
-                new_r = copy.copy(r)
-                new_r.match = new_match
-                if not new_r.actions:
-                    new_r.actions = comp_defaults
-                new_r.parents = [r]
-                new_r.op = "switch"
-                final_rules.append(new_r)
+            p_class = self.policy_dic[tag_value].compile()
+            # The specialized matches can be reused as long as the tag policy
+            # still compiles to the same classifier.
+            (old_class, old_sig, new_matches) = self.compiled_tags.get(
+                tag_value, (None, None, None))
+            if not (old_class is p_class and old_sig == sig):
+                new_matches = None
+            (tag_rules, new_matches) = self.specialize_rules(
+                self.tag, tag_value, p_class.rules, comp_defaults,
+                new_matches)
+            compiled_tags[tag_value] = (p_class, sig, new_matches)
+            final_rules += tag_rules
+        self.compiled_tags = compiled_tags
 
         final_rules.append(Rule(identity, comp_defaults, [self], "switch"))
         c = Classifier(final_rules)
@@ -1872,18 +2267,8 @@ class QuerySwitch(Policy):
             p_rules = p_class[0].rules
             tot_time += float(p_class[1])
             t_s = time.time()
-            for r in p_rules:
-                new_match = r.match.intersect(match(**{self.tag : tag_value}))
-                new_match = new_match.compile().rules[0].match
-                if new_match == drop:
-                    raise TypeError
-                new_r = copy.copy(r)
-                new_r.match = new_match
-                if not new_r.actions:
-                    new_r.actions = comp_defaults
-                new_r.parents = [r]
-                new_r.op = "switch"
-                final_rules.append(new_r)
+            final_rules += self.specialize_rules(self.tag, tag_value, p_rules,
+                                                 comp_defaults)[0]
 
         final_rules.append(Rule(identity, comp_defaults, [self], "switch"))
         c = Classifier(final_rules)
@@ -1927,19 +2312,9 @@ class QuerySwitch(Policy):
             p_rules = p_class[0].rules
             netkat_time = float(p_class[1])
             t_s = time.time()
-            final_rules = []
-            for r in p_rules:
-                new_match = r.match.intersect(match(**{tag_field : tag_value}))
-                new_match = new_match.compile().rules[0].match
-                if new_match == drop:
-                    raise TypeError
-                new_r = copy.copy(r)
-                new_r.match = new_match
-                if not new_r.actions:
-                    new_r.actions = comp_defaults
-                new_r.parents = [r]
-                new_r.op = "switch"
-                final_rules.append(new_r)
+            final_rules = QuerySwitch.specialize_rules(tag_field, tag_value,
+                                                       p_rules,
+                                                       comp_defaults)[0]
             other_time = time.time() - t_s
             return (tag_value, final_rules, netkat_time, other_time)
 
@@ -1956,25 +2331,15 @@ class QuerySwitch(Policy):
             """ Compile a set of tag -> policy policies from the
             QuerySwitch. This is the core compilation logic in QuerySwitch. """
             for (tag_value, tag_policy) in tag_policy_set:
-                final_rules = []
                 p_class = tag_policy.netkat_compile(switch_cnt=switch_cnt,
                                                     multistage=multistage,
                                                     server_port=frenetic_port)
                 t_s = time.time()
                 p_rules = p_class[0].rules
                 netkat_time = float(p_class[1])
-                for r in p_rules:
-                    new_match = r.match.intersect(match(**{tag_field : tag_value}))
-                    new_match = new_match.compile().rules[0].match
-                    if new_match == drop:
-                        raise TypeError
-                    new_r = copy.copy(r)
-                    new_r.match = new_match
-                    if not new_r.actions:
-                        new_r.actions = comp_defaults
-                    new_r.parents = [r]
-                    new_r.op = "switch"
-                    final_rules.append(new_r)
+                final_rules = QuerySwitch.specialize_rules(tag_field, tag_value,
+                                                           p_rules,
+                                                           comp_defaults)[0]
                 other_time = time.time() - t_s
                 outq.put((tag_value, final_rules, netkat_time, other_time))
             return 0
@@ -2253,6 +2618,17 @@ class path_grouping(object):
         else:
             return acc
 
+    @classmethod
+    def groupby_collect_ordered(cls, acc, ast):
+        """ Like groupby_collect, but into a list in the order of the path,
+        which doesn't depend on the ids of the grouping atoms. """
+        assert isinstance(ast, path)
+        if (isinstance(ast, in_out_group) and
+            not any([a is ast for a in acc])):
+            return acc + [ast]
+        else:
+            return acc
+
     @classmethod
     def map_substitute_groupby(cls, vals):
         def actual_mapper(ast):
@@ -2287,23 +2663,23 @@ class path_grouping(object):
         lists, where each internal list is the list of values of fields in
         `flist` in the same order as `flist`.
         """
+        return list(cls.iter_flist_vlist_combos(flist, fvlist))
+
+    @classmethod
+    def iter_flist_vlist_combos(cls, flist, fvlist):
+        """ Generator version of `flist_vlist_combos`, which never holds more
+        than one combination at a time. """
         if len(flist) == 0:
-            return [[]]
+            yield []
+        elif not fvlist[flist[0]]:
+            # Sometimes, the value list for a field may be empty.
+            yield [None]
         else:
-            res = []
-            if not fvlist[flist[0]]:
-                # Sometimes, the value list for a field may be empty.
-                return [[None]]
             # From here on, fvlist[...] has a nonempty list of values for header
             # flist[0].
             for first_val in fvlist[flist[0]]:
-                tail_vals = cls.flist_vlist_combos(flist[1:], fvlist)
-                if tail_vals:
-                    for tail_val in tail_vals:
-                        res.append([first_val] + tail_val)
-                else:
-                    res.append([first_val])
-            return res
+                for tail_val in cls.iter_flist_vlist_combos(flist[1:], fvlist):
+                    yield [first_val] + tail_val
 
     @classmethod
     def gen_groupby_substitutes(cls, gatom, fvlist):
@@ -2335,20 +2711,29 @@ class path_grouping(object):
             { field1: value1, field2: value2, ...}
             (corresponding to each groupby field substitution).
         """
+        return list(cls.iter_gatom_to_ioatom_combos(galist, fvlist))
+
+    @classmethod
+    def iter_gatom_to_ioatom_combos(cls, galist, fvlist):
+        """ Generator version of `gatom_to_ioatom_combos`. Only the
+        substitutes of each grouping atom are computed up front (their number
+        is the sum, not the product, of the numbers of substitutes), and the
+        combinations of substitutes share the same in_out_atom objects, and
+        hence their predicate partitions during compilation. Combinations are
+        generated in the order of `galist`, if it is a list. """
         assert list_isinstance(galist, in_out_group)
         ga_subst_map = {id(gatom): cls.gen_groupby_substitutes(gatom, fvlist)
                         for gatom in galist}
         empty_subs = reduce(lambda acc, v: acc or (False if v else True),
                             ga_subst_map.values(), False)
         if empty_subs:
-            return []
-        id_sorted_gatoms = sorted(map(id, galist))
-        combos = cls.flist_vlist_combos(id_sorted_gatoms,
-                                        ga_subst_map)
-        res = []
-        for atom_combo in combos:
-            res.append({f:v for (f,v) in zip(id_sorted_gatoms, atom_combo)})
-        return res
+            return
+        if isinstance(galist, list):
+            gatom_ids = map(id, galist)
+        else:
+            gatom_ids = sorted(map(id, galist))
+        for atom_combo in cls.iter_flist_vlist_combos(gatom_ids, ga_subst_map):
+            yield {f:v for (f,v) in zip(gatom_ids, atom_combo)}
 
     @classmethod
     def aggwrap(cls, funlist, agg):
@@ -2377,23 +2762,26 @@ class path_grouping(object):
         return eff_fvlist
 
     @classmethod
-    def specialize_query(cls, p, mapper, mapping={}):
+    def specialize_query(cls, p, mapper, mapping={}, bucket=None):
         """Return a "basic" version of a groupby query, where groupby atoms are
         replaced by the in/out atoms with the same predicates. Given a mapper to
         replace the instance of the grouping atom by an atom of choice, return a
-        query that looks identical to the original query. """
+        query that looks identical to the original query. `bucket`, if given,
+        is the bucket of an earlier specialization with the same mapping. """
         ppu = path_policy_utils
         new_query = ppu.path_ast_map(p, mapper)
-        p_cbs = p.get_bucket().callbacks
-        p_bucket = type(p.get_bucket())()
-        mapping = dict([(i, x[1]) for i, x in mapping.items()])
-        p_bucket.register_callback(cls.aggwrap(p_cbs, mapping))
-        new_query.set_bucket(p_bucket)
+        if bucket is None:
+            p_cbs = p.get_bucket().callbacks
+            bucket = type(p.get_bucket())()
+            mapping = dict([(i, x[1]) for i, x in mapping.items()])
+            bucket.register_callback(cls.aggwrap(p_cbs, mapping))
+        new_query.set_bucket(bucket)
         new_query.set_measure_loc(p.get_measure_loc())
+        new_query.groupby_origin = p
         return new_query
 
     @classmethod
-    def expand_groupby(cls, path_pol, fvlist={}):
+    def expand_groupby(cls, path_pol, fvlist={}, max_queries=None):
         """ Statically substitute groupby atoms in queries by query predicates
         that have 'complete' values, e.g.,:
 
@@ -2407,47 +2795,246 @@ class path_grouping(object):
         grouping atoms, as it's too expensive to pre-compute all destination
         IPs, etc. Instead, applications should use a sampling bucket to collect
         per-header-aggregate statistics.
+
+        If `max_queries` is set, expansions into more queries than that are
+        refused with a RuntimeError, rather than exhausting memory.
+        """
+        res_ppols = list(cls.iter_expand_groupby(path_pol, fvlist,
+                                                 max_queries))
+        assert len(res_ppols) > 0
+        if len(res_ppols) > 1:
+            return path_policy_union(res_ppols)
+        else:
+            return res_ppols[0]
+
+    @classmethod
+    def iter_expand_groupby(cls, path_pol, fvlist={}, max_queries=None):
+        """ Generator version of `expand_groupby`, which yields the expanded
+        queries one at a time, so that they may be consumed (e.g., by
+        pack_queries_stagelimited) as they are produced. The specializations of
+        a groupby query are numbered in the order they are generated
+        (`groupby_index`), so that stages may hold them as groupby_slices.
         """
         ppu = path_policy_utils
-        ppols_list = []
-        def collect_primitive_pathpols(acc, p, in_cg=None, out_cg=None):
-            if isinstance(p, path_policy_union) or isinstance(
-                    p, dynamic_path_policy):
-                return acc
-            elif isinstance(p, path_policy):
-                return acc | set([p])
-            else:
-                raise TypeError("Expecting type path_policy")
         assert isinstance(path_pol, path_policy), "cannot expand groupby from non-path-policies"
-        ppols_list = ppu.path_policy_ast_fold(
-            path_pol, collect_primitive_pathpols, set([]))
-        res_ppols = []
+        ppols_list = ppu.get_primitive_pathpols(path_pol)
+        num_queries = 0
         for p in ppols_list:
             gatm_list = ppu.path_ast_fold(p.path, cls.groupby_collect, set())
             if not gatm_list:
-                res_ppols.append(p)
-                continue
-            # From here on, deal with queries p that have groupby atoms.
-            fvlist = cls.get_eff_fvlist(p, fvlist)
-            gid_to_atoms = cls.gatom_to_ioatom_combos(gatm_list, fvlist)
-            if not gid_to_atoms:
-                mapper = cls.atom_substitute_groupby()
-                res_ppols.append(cls.specialize_query(p, mapper, {}))
-                continue
-            # From here on, deal with queries p that have a nonzero expansion.
-            for mapping in gid_to_atoms:
-                mapper = cls.map_substitute_groupby(mapping)
-                res_ppols.append(cls.specialize_query(p, mapper, mapping))
-        assert len(res_ppols) > 0
-        if len(res_ppols) > 1:
-            return path_policy_union(res_ppols)
+                specs = [None]
+            else:
+                # From here on, deal with queries p that have groupby atoms.
+                eff_fvlist = cls.get_eff_fvlist(p, fvlist)
+                specs = cls.iter_specializations(p, eff_fvlist)
+            for (index, spec) in enumerate(specs):
+                num_queries += 1
+                if max_queries is not None and num_queries > max_queries:
+                    raise RuntimeError("groupby expansion exceeds %d queries" %
+                                       max_queries)
+                if spec is None:
+                    yield p
+                    continue
+                (mapper, mapping) = spec
+                q = cls.specialize_query(p, mapper, mapping)
+                q.groupby_index = index
+                q.groupby_fvlist = eff_fvlist
+                yield q
+
+    @classmethod
+    def iter_specializations(cls, p, eff_fvlist):
+        """ Generate the (mapper, mapping) pairs that specialize_query
+        expands groupby query `p` with, given its effective field value list
+        (see get_eff_fvlist). The order of the pairs only depends on `p`'s
+        path and `eff_fvlist`, so it is the same in every process. """
+        ppu = path_policy_utils
+        gatm_list = ppu.path_ast_fold(p.path, cls.groupby_collect_ordered, [])
+        expanded = False
+        for mapping in cls.iter_gatom_to_ioatom_combos(gatm_list, eff_fvlist):
+            # p has a nonzero expansion.
+            expanded = True
+            yield (cls.map_substitute_groupby(mapping), mapping)
+        if not expanded:
+            yield (cls.atom_substitute_groupby(), {})
+
+class groupby_slice(object):
+    """ The specializations `start` to `stop` (excluded) of groupby query
+    `groupby_origin`, as numbered by path_grouping.iter_expand_groupby with
+    the effective field value list `fvlist`. Stages hold slices in place of
+    the specialized queries (see stage_append), whose paths are only built
+    again when the stage is compiled (see iter_stage_queries). The buckets of
+    the specializations are kept, so that query results keep going to the
+    same buckets across compilations. """
+    def __init__(self, origin, fvlist, start, buckets):
+        self.groupby_origin = origin
+        self.fvlist = fvlist
+        self.start = start
+        self.stop = start + len(buckets)
+        self.buckets = buckets
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __repr__(self):
+        return "groupby_slice(%d:%d of %s)" % (self.start, self.stop,
+                                               repr(self.groupby_origin))
+
+def stage_append(stage, q):
+    """ Append query `q` to the list of queries `stage`, replacing the
+    specializations of groupby queries by groupby_slices. A specialization
+    following the last slice of the stage extends that slice. Returns
+    `stage`. """
+    if isinstance(q, groupby_slice):
+        s = q
+    elif getattr(q, 'groupby_index', None) is not None:
+        s = groupby_slice(q.groupby_origin, q.groupby_fvlist, q.groupby_index,
+                          [q.get_bucket()])
+    else:
+        stage.append(q)
+        return stage
+    last = stage[-1] if stage else None
+    if (isinstance(last, groupby_slice) and
+        last.groupby_origin is s.groupby_origin and
+        last.fvlist is s.fvlist and last.stop == s.start):
+        last.buckets = last.buckets + s.buckets
+        last.stop = s.stop
+    else:
+        stage.append(s)
+    return stage
+
+def iter_stage_queries(stage):
+    """ Generate the queries of `stage`, a list of queries and
+    groupby_slices, specializing the slices again. The specializations of
+    each groupby query are enumerated once for all its slices in the
+    stage. """
+    slices = {}
+    origins = []
+    for q in stage:
+        if isinstance(q, groupby_slice):
+            key = (id(q.groupby_origin), id(q.fvlist))
+            if not key in slices:
+                slices[key] = []
+                origins.append(key)
+            slices[key].append(q)
         else:
-            return res_ppols[0]
+            yield q
+    for key in origins:
+        pending = sorted(slices[key], key=lambda s: s.start)
+        (p, fvlist) = (pending[0].groupby_origin, pending[0].fvlist)
+        specs = path_grouping.iter_specializations(p, fvlist)
+        for (index, (mapper, mapping)) in enumerate(specs):
+            while pending and index >= pending[0].stop:
+                pending.pop(0)
+            if not pending:
+                break
+            s = pending[0]
+            if index >= s.start:
+                bucket = s.buckets[index - s.start]
+                yield path_grouping.specialize_query(p, mapper, mapping,
+                                                     bucket)
+
+class StageTransferError(Exception):
+    """ A stage's inputs or results couldn't be transferred between the
+    processes compiling stages in parallel. """
+    pass
+
+def collect_stage_refs(obj):
+    """ List the singleton policies (e.g., identity and drop) and the policies
+    and path policies reachable from `obj`, through containers and the
+    attributes of other policies and path policies. These are passed by
+    reference to the workers compiling a stage, and map back to the parent's
+    own objects in the stage results (see dump_stage_data). Groupby slices
+    are passed by reference as well, along with their buckets. """
+    refs = []
+    seen = set()
+    stack = [obj] + util.SingletonMetaclass._instances.values()
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        if isinstance(o, (Policy, path_policy, groupby_slice)):
+            refs.append(o)
+            stack.extend(o.__dict__.values())
+        elif isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return refs
+
+def dump_stage_data(data, refs):
+    """ Serialize `data`, referring to the objects in `refs` by their index
+    in the list instead of copying them. """
+    f = StringIO()
+    # protocol 2 would create objects through their classes' __new__, which
+    # some policy combinators override to simplify their arguments.
+    pickler = cPickle.Pickler(f, 1)
+    index = dict([(id(o), i) for (i, o) in enumerate(refs)])
+    def persistent_id(obj):
+        i = index.get(id(obj))
+        return None if i is None else str(i)
+    pickler.persistent_id = persistent_id
+    try:
+        pickler.dump(data)
+    except (cPickle.PicklingError, TypeError, RuntimeError) as e:
+        raise StageTransferError(repr(e))
+    return f.getvalue()
+
+def load_stage_data(data, refs):
+    """ Inverse of `dump_stage_data`. """
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = lambda pid: refs[int(pid)]
+    return unpickler.load()
+
+def compile_stage_worker(job):
+    """ Compile a stage in a forked worker process. `job` is the position of
+    the stage's references in pathcomp.parallel_refs, along with the stage
+    index, queries and keyword arguments serialized by `dump_stage_data`. The
+    stage result is returned in the same way, with everything else the
+    compilation changed: the stage's character generators, the virtual fields
+    it registered and the state of the path policies it was given. """
+    (job_index, data) = job
+    refs = pathcomp.parallel_refs[job_index]
+    (stage_index, stage, stage_kwargs) = load_stage_data(data, refs)
+    vf_classes = [(False, virtual_field), (True, virtual_virtual_field)]
+    old_fields = [set(vcls.fields.keys()) for (_, vcls) in vf_classes]
+    (res, in_cg, out_cg) = pathcomp.compile_stage_queries(stage_index, stage,
+                                                          stage_kwargs)
+    vfields = []
+    for ((is_virtual, vcls), old) in zip(vf_classes, old_fields):
+        for name in set(vcls.fields.keys()) - old:
+            vf = vcls.fields[name]
+            vfields.append((is_virtual, name, vf.values, vf.type, vf.stage))
+    # dynamic predicate objects are of a nested class, which can't be pickled
+    dyn_preds = []
+    for cg in [in_cg, out_cg]:
+        dyn_preds.append([(d.pred, d.pol) for d in cg.dyn_preds])
+        cg.dyn_preds = []
+    states = [(i, r.__dict__) for (i, r) in enumerate(refs)
+              if isinstance(r, (path_policy, groupby_slice))]
+    return dump_stage_data((res, (in_cg, out_cg), dyn_preds, vfields, states),
+                           refs)
 
 class pathcomp(object):
     """ Functionality related to actual compilation of path queries. """
     log = logging.getLogger('%s.pathcomp' % __name__)
     log.setLevel(logging.ERROR)
+    stage_workers = 1
+    cost_pack_enabled = False
+    stage_rule_limit = STAGE_RULE_LIMIT
+    max_queries = None
+    parallel_refs = None
+    # Downstream queries of each stage, as last compiled by compile_downstream
+    # or update_downstream, and the arguments they were compiled with.
+    ds_stages = None
+    ds_stage_kwargs = None
+    ds_numstages = 1
+    # Character generators of each compiled stage.
+    stage_cgs = {}
+    # The upstream query stage as last compiled by compile_upstream, with the
+    # key it was compiled for (see get_upstream_stage).
+    us_stage = None
 
     @classmethod
     def __num_set_tag__(cls, num, vfield):
@@ -2565,11 +3152,22 @@ class pathcomp(object):
     @classmethod
     def init(cls, numvals, switch_cnt = None, cache_enabled = False,
              edge_contraction_enabled = False, partition_enabled = False,
-             use_fdd = False, write_log = None):
+             use_fdd = False, write_log = None, dfa_min_enabled = True,
+             stage_workers = 1, cost_pack_enabled = False,
+             stage_rule_limit = STAGE_RULE_LIMIT, max_queries = None):
         
         """ Initialize path-related structures, namely:
         - a new virtual field for path tag;
         - in and out character generators.
+        `stage_workers` bounds the number of processes compiling query stages
+        concurrently. Stages are compiled serially by default, as forking
+        workers from a multithreaded controller isn't safe in general.
+        `cost_pack_enabled` packs queries into stages with the cost model of
+        stage_cost (see pack_queries_cost), within `stage_rule_limit` rules per
+        switch in each stage.
+        `max_queries`, if set, bounds the number of queries that the groupby
+        queries of the runtime's path policy may expand into (see
+        path_grouping.iter_expand_groupby).
         """
         global rt_write_log
         cls.swich_cnt = switch_cnt
@@ -2577,6 +3175,11 @@ class pathcomp(object):
         cls.partition_enabled = partition_enabled
         cls.edge_contraction_enabled = edge_contraction_enabled
         cls.use_fdd = use_fdd 
+        cls.dfa_min_enabled = dfa_min_enabled
+        cls.stage_workers = stage_workers
+        cls.cost_pack_enabled = cost_pack_enabled
+        cls.stage_rule_limit = stage_rule_limit
+        cls.max_queries = max_queries
         if write_log:
             rt_write_log = write_log
 
@@ -2589,11 +3192,18 @@ class pathcomp(object):
 
     @classmethod
     def get_directional_pathpol(cls, path_pol, dirn):
+            """ The queries of `path_pol` measured at `dirn`, including those
+            of its dynamic path policies. """
             is_dir_q = lambda pp: (pp.path.measure_loc == dirn)
             if isinstance(path_pol, path_policy_union):
-                query_list = filter(is_dir_q, path_pol.path_policies)
+                query_list = path_pol.path_policies
             else:
-                query_list = [path_pol] if is_dir_q(path_pol) else []
+                query_list = [path_pol]
+            if any([isinstance(pp, (path_policy_union, dynamic_path_policy))
+                    for pp in query_list]):
+                query_list = list(
+                    path_policy_utils.get_primitive_pathpols(path_pol))
+            query_list = filter(is_dir_q, query_list)
             if len(query_list) > 1:
                 return path_policy_union(query_list)
             elif len(query_list) == 1:
@@ -2613,29 +3223,19 @@ class pathcomp(object):
                                      setup_tfs_data_from_cls,
                                      get_portid_map,
                                      get_hsa_edge_ports,
-                                     get_reachable_inheaders)
+                                     get_reachable_inheaders_batch)
         sw_ports = {k:v for (k,v) in switch_ports}
         hs_format = pyr_hs_format()
         edge_pol = get_hsa_edge_policy(sw_ports, network_links)
 
-        if cls.use_fdd:
-            in_cg = __fdd_in_re_tree_gen__()
-            out_cg = __fdd_out_re_tree_gen__()
-        else:
-            in_cg = __in_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
-                                    cls.partition_enabled)
-            out_cg = __out_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
-                                     cls.partition_enabled)
-
         ''' Downstream compilation to get full policy to test. '''
-        (comp_res, acc_pols) = cls.compile_stage(path_pol, in_cg, out_cg,
-                                                 max_states=max_states,
-                                                 disjoint_enabled=disjoint_enabled,
-                                                 default_enabled=default_enabled,
-                                                 integrate_enabled=True,
-                                                 ragel_enabled=ragel_enabled,
-                                                 match_enabled=match_enabled,
-                                                 stage=VIRT_STAGE)
+        (comp_res, acc_pols) = cls.get_upstream_stage(path_pol,
+                                                      max_states=max_states,
+                                                      disjoint_enabled=disjoint_enabled,
+                                                      default_enabled=default_enabled,
+                                                      integrate_enabled=True,
+                                                      ragel_enabled=ragel_enabled,
+                                                      match_enabled=match_enabled)
         (in_table_pol, out_table_pol) = comp_res
         vvfield = 'path_tag_%s' % str(VIRT_STAGE)
         vin_tagging = ((edge_pol >> modify(**{vvfield:None})) + ~edge_pol)
@@ -2662,34 +3262,84 @@ class pathcomp(object):
 
         ''' Run reachability and construct upstream measurement policy. '''
         up_capture = drop
-        reach_filter = get_reachable_inheaders
         from pyretic.core.language import parallel
+        queries = []
+        query_pols = []
         for (sw,ports) in edge_ports.iteritems():
             for p in ports:
                 for (accstate, pol_list) in acc_pols.iteritems():
-                    res_filter = reach_filter(hs_format, portids, sw_ports,
-                                              sw, p,
-                                              match(**{vvfield:accstate}),
-                                              no_vlan=True)
-                    res_filter = res_filter & match(switch=sw,port=p)
-                    if up_capture == drop:
-                        up_capture = res_filter >> parallel(pol_list)
-                    else:
-                        up_capture += (res_filter >> parallel(pol_list))
+                    queries.append((sw, p, match(**{vvfield:accstate})))
+                    query_pols.append(pol_list)
+        ''' All reachability queries are answered in one batch. '''
+        res_filters = get_reachable_inheaders_batch(hs_format, portids,
+                                                    sw_ports, queries,
+                                                    no_vlan=True)
+        for ((sw, p, _), res_filter, pol_list) in zip(queries, res_filters,
+                                                      query_pols):
+            res_filter = res_filter & match(switch=sw,port=p)
+            if up_capture == drop:
+                up_capture = res_filter >> parallel(pol_list)
+            else:
+                up_capture += (res_filter >> parallel(pol_list))
 
         return up_capture
 
+    @classmethod
+    def get_upstream_stage(cls, path_pol, **stage_kwargs):
+        """ Compile the upstream queries `path_pol` as a query stage. Only
+        reachability in the network depends on the topology, not the stage
+        itself: the last stage compiled is reused as long as the queries (by
+        identity), the policies of the dynamic predicates in them, and
+        `stage_kwargs` are unchanged. """
+        prims = path_policy_utils.get_primitive_pathpols(path_pol)
+        def get_key(cgs):
+            dyn_preds = reduce(lambda acc, cg: acc + cg.dyn_preds, cgs, [])
+            return (frozenset(map(id, prims)),
+                    frozenset([(id(d.pred), id(d.pred.policy))
+                               for d in dyn_preds]),
+                    tuple(sorted(stage_kwargs.items())))
+        if cls.us_stage is not None:
+            (key, _, res, cgs) = cls.us_stage
+            if key == get_key(cgs):
+                return res
+            for cg in cgs:
+                for cg_list in [cg.in_cg_list, cg.out_cg_list]:
+                    if cg in cg_list:
+                        cg_list.remove(cg)
+        vvfield = 'path_tag_%s' % str(VIRT_STAGE)
+        virtual_virtual_field.remove(vvfield)
+        (in_cg, out_cg) = cls.new_stage_cgs()
+        res = cls.compile_stage(path_pol, in_cg, out_cg, stage=VIRT_STAGE,
+                                **stage_kwargs)
+        # Hold on to the queries and predicate policies, so that the ids in the
+        # key are not reused by other objects.
+        refs = (prims, [d.pred.policy for cg in (in_cg, out_cg)
+                        for d in cg.dyn_preds])
+        cls.us_stage = (get_key((in_cg, out_cg)), refs, res, (in_cg, out_cg))
+        return res
+
     @classmethod
     def compile_downstream(cls, path_pol, max_states=NUM_PATH_TAGS,
                            disjoint_enabled=False, default_enabled=False,
                            integrate_enabled=False, ragel_enabled=False,
                            match_enabled=False, preddecomp_enabled=False):
+        """ Pack the downstream queries of `path_pol` into stages and compile
+        them. `path_pol` may also be an iterable of queries, e.g.,
+        path_grouping.iter_expand_groupby, which is consumed in a single pass
+        while packing. """
         def stage_pack_helper(query_list, path_pol, numstages):
             if not isinstance(path_pol, path_empty):
                 # TODO(ngsrinivas): check whether rule-limit-driven or
                 # stage-limit-driven functions do better.
                 # i.e., pack_queries(query_list, 2000) versus the one below.
-                stages = pack_queries_stagelimited(query_list, numstages)
+                if cls.cost_pack_enabled:
+                    stages = pack_queries_cost(query_list, numstages,
+                                               cls.stage_rule_limit,
+                                               max_states)
+                else:
+                    stages = pack_queries_stagelimited(query_list, numstages)
+                if stages.keys() == [0] and not stages[0]:
+                    stages = {0: [path_empty()]}
             else:
                 stages = {0: [path_pol]}
             return stages
@@ -2702,8 +3352,10 @@ class pathcomp(object):
 
         if isinstance(path_pol, path_policy_union):
             query_list = path_pol.path_policies
-        else:
+        elif isinstance(path_pol, path_policy):
             query_list = [path_pol]
+        else:
+            query_list = path_pol
 
         if preddecomp_enabled:
             numstages = MAX_STAGES
@@ -2714,32 +3366,16 @@ class pathcomp(object):
         in_res = []
         out_res = []
         cls.log.debug("Stages: %d" % len(stages))
-        for (stage_index, stage) in stages.items():
-            if cls.use_fdd:
-                in_cg = __fdd_in_re_tree_gen__()
-                out_cg = __fdd_out_re_tree_gen__()
-            else:
-                in_cg = __in_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
-                                        cls.partition_enabled)
-                out_cg = __out_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
-                                         cls.partition_enabled)
-
-            if len(stage) == 1:
-                stage_path_pol = stage[0]
-            else:
-                stage_path_pol = path_policy_union(stage)
-            res = cls.compile_stage(stage_path_pol, in_cg, out_cg,
-                                    max_states=max_states,
-                                    disjoint_enabled=disjoint_enabled,
-                                    default_enabled=default_enabled,
-                                    integrate_enabled=integrate_enabled,
-                                    ragel_enabled=ragel_enabled,
-                                    match_enabled=match_enabled,
-                                    stage=stage_index)
-            (compile_res, _) = res
-            sep_index = len(compile_res) / 2
-            in_part = compile_res[:sep_index]
-            out_part = compile_res[sep_index:]
+        stage_kwargs = {'max_states': max_states,
+                        'disjoint_enabled': disjoint_enabled,
+                        'default_enabled': default_enabled,
+                        'integrate_enabled': integrate_enabled,
+                        'ragel_enabled': ragel_enabled,
+                        'match_enabled': match_enabled}
+        cls.retire_stage_cgs(cls.stage_cgs.keys())
+        results = cls.compile_stages(sorted(stages.items()), stage_kwargs)
+        for res in results:
+            (in_part, out_part) = cls.split_stage_result(res)
             """ If the "integrate" option is enabled, in_res looks like:
             [in_table1, in_table2, ..., in_tableN] for N query matching stages.
 
@@ -2749,11 +3385,223 @@ class pathcomp(object):
 
             Respectively for out_res.
             """
-            in_res.append(in_part if len(in_part) != 1 else in_part[0])
-            out_res.append(out_part if len(out_part) != 1 else out_part[0])
+            in_res.append(in_part)
+            out_res.append(out_part)
+        cls.ds_stages = stages
+        cls.ds_stage_kwargs = stage_kwargs
+        cls.ds_numstages = numstages
        
         return (in_res, out_res)
+
+    @classmethod
+    def split_stage_result(cls, res):
+        """ The in and out parts of a stage compilation result. """
+        (compile_res, _) = res
+        sep_index = len(compile_res) / 2
+        in_part = compile_res[:sep_index]
+        out_part = compile_res[sep_index:]
+        return (in_part if len(in_part) != 1 else in_part[0],
+                out_part if len(out_part) != 1 else out_part[0])
+
+    @classmethod
+    def update_downstream(cls, path_pol):
+        """ Incrementally update the stages last compiled by
+        compile_downstream (or by this function) to the downstream queries of
+        `path_pol`, an unexpanded path policy. Queries are compared by
+        identity: the expansions of queries no longer in `path_pol` are
+        removed from their stages, and those of new queries are placed into
+        existing stages where their estimated cost fits (see place_cost), or
+        into new stages. Only stages whose queries changed are recompiled,
+        along with stages whose path tag bits moved as a result.
+
+        Returns a dictionary from the index of each recompiled stage to its
+        (in part, out part) as in compile_downstream, or to None if the stage
+        has no queries left; or None if the stages must be compiled afresh
+        by compile_downstream.
+        """
+        if cls.ds_stages is None:
+            return None
+        origin = lambda q: getattr(q, 'groupby_origin', None) or q
+        is_ds = lambda q: (q.path.measure_loc == path.MEASURE_LOC_DOWNSTREAM
+                           and not isinstance(q, path_empty))
+        old = {}
+        for qs in cls.ds_stages.values():
+            for q in qs:
+                if not isinstance(q, path_empty):
+                    old[id(origin(q))] = origin(q)
+        prims = filter(is_ds, path_policy_utils.get_primitive_pathpols(
+            path_pol))
+        new_ids = set(map(id, prims))
+        if not old or not new_ids:
+            return None
+        removed = set(old.keys()) - new_ids
+        added = [p for p in prims if not id(p) in old]
+        if not removed and not added:
+            return {}
+
+        stages = {}
+        dirty = set()
+        for (i, qs) in cls.ds_stages.iteritems():
+            stages[i] = [q for q in qs if isinstance(q, path_empty) or
+                         not id(origin(q)) in removed]
+            if len(stages[i]) != len(qs):
+                dirty.add(i)
+        costs = {}
+        for (i, qs) in stages.iteritems():
+            qs = [q for q in qs if not isinstance(q, path_empty)]
+            if qs:
+                costs[i] = reduce(lambda acc, c: acc.join(c),
+                                  [stage_cost.of_query(q)
+                                   for q in iter_stage_queries(qs)])
+        max_states = cls.ds_stage_kwargs['max_states']
+        for p in added:
+            for q in path_grouping.iter_expand_groupby(p):
+                (i, costs[i]) = place_cost(costs, stage_cost.of_query(q),
+                                           cls.stage_rule_limit, max_states,
+                                           cls.ds_numstages)
+                stage_append(stages.setdefault(i, []), q)
+                dirty.add(i)
+        emptied = set([i for i in dirty if not stages[i]])
+        if len(emptied) == len(stages):
+            return None
+        for i in emptied:
+            del stages[i]
+
+        old_bits = copy.copy(virtual_field.stage_offset_nbits)
+        cls.retire_stage_cgs(dirty)
+        for i in dirty:
+            virtual_field.remove('path_tag_%d' % i)
+        pending = sorted(dirty - emptied)
+        res = dict([(i, None) for i in emptied])
+        while True:
+            results = cls.compile_stages([(i, stages[i]) for i in pending],
+                                         cls.ds_stage_kwargs)
+            for (i, r) in zip(pending, results):
+                res[i] = cls.split_stage_result(r)
+            # Tag matches and modifications encode the offsets of stage bits:
+            # recompile the stages whose bits moved.
+            new_bits = virtual_field.stage_offset_nbits
+            pending = sorted([i for i in stages if not i in res and
+                              new_bits.get(i) != old_bits.get(i)])
+            if not pending:
+                break
+            for i in pending:
+                virtual_field.remove('path_tag_%d' % i)
+            cls.retire_stage_cgs(pending)
+        cls.ds_stages = stages
+        return res
+
+    @classmethod
+    def retire_stage_cgs(cls, stage_indices):
+        """ Drop the character generators of stages in `stage_indices` from the
+        global lists of character generators, e.g., before the stages are
+        compiled again. """
+        for i in list(stage_indices):
+            for cg in cls.stage_cgs.pop(i, ()):
+                for cg_list in [cg.in_cg_list, cg.out_cg_list]:
+                    if cg in cg_list:
+                        cg_list.remove(cg)
     
+    @classmethod
+    def new_stage_cgs(cls):
+        """ Fresh in and out character generators for a query stage. """
+        if cls.use_fdd:
+            in_cg = __fdd_in_re_tree_gen__()
+            out_cg = __fdd_out_re_tree_gen__()
+        else:
+            in_cg = __in_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
+                                       cls.partition_enabled)
+            out_cg = __out_re_tree_gen__(cls.swich_cnt, cls.cache_enabled,
+                                         cls.partition_enabled)
+        return (in_cg, out_cg)
+
+    @classmethod
+    def compile_stage_queries(cls, stage_index, stage, stage_kwargs):
+        """ Compile the list of queries `stage` in stage `stage_index`, with
+        its own character generators. """
+        (in_cg, out_cg) = cls.new_stage_cgs()
+        stage = list(iter_stage_queries(stage))
+        if len(stage) == 1:
+            stage_path_pol = stage[0]
+        else:
+            stage_path_pol = path_policy_union(stage)
+        res = cls.compile_stage(stage_path_pol, in_cg, out_cg,
+                                stage=stage_index, **stage_kwargs)
+        return (res, in_cg, out_cg)
+
+    @classmethod
+    def compile_stages(cls, stage_list, stage_kwargs):
+        """ Compile the stages in `stage_list`, a list of (stage index, query
+        list) pairs, and return their results in the same order. Stages are
+        independent, and are compiled concurrently by up to `stage_workers`
+        forked worker processes when that is more than one. Statistics are only
+        collected in process, and FDD nodes are only unique within a process,
+        so stages are compiled serially while Stat is monitoring or FDDs are
+        used. Failures to start the workers or to transfer stages to and from
+        them fall back to serial compilation; errors compiling a stage are
+        raised. """
+        workers = min(cls.stage_workers or 1, len(stage_list))
+        if workers > 1 and not Stat.monitoring and not cls.use_fdd:
+            try:
+                return cls.compile_stages_parallel(stage_list, stage_kwargs,
+                                                   workers)
+            except (StageTransferError, OSError) as e:
+                cls.log.warning("Parallel stage compilation failed (%s); "
+                                "compiling stages serially" % repr(e))
+        results = []
+        for (i, stage) in stage_list:
+            (res, in_cg, out_cg) = cls.compile_stage_queries(i, stage,
+                                                             stage_kwargs)
+            cls.stage_cgs[i] = (in_cg, out_cg)
+            results.append(res)
+        return results
+
+    @classmethod
+    def compile_stages_parallel(cls, stage_list, stage_kwargs, workers):
+        """ Compile stages in a pool of `workers` forked processes. Each stage
+        is handed to a worker serialized by `dump_stage_data`, with the
+        policies and path policies it refers to passed by reference through
+        `parallel_refs`. Once all the workers are done, their character
+        generators, virtual fields and path policy state are merged here in
+        stage order. """
+        stage_refs = []
+        jobs = []
+        for (k, (i, stage)) in enumerate(stage_list):
+            refs = collect_stage_refs(stage)
+            stage_refs.append(refs)
+            jobs.append((k, dump_stage_data((i, stage, stage_kwargs), refs)))
+        cls.parallel_refs = stage_refs
+        try:
+            pool = multiprocessing.Pool(workers)
+            try:
+                outs = pool.map(compile_stage_worker, jobs)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            cls.parallel_refs = None
+        loaded = [load_stage_data(out, refs)
+                  for (out, refs) in zip(outs, stage_refs)]
+        results = []
+        for ((i, _), refs, out) in zip(stage_list, stage_refs, loaded):
+            (res, cgs, dyn_preds, vfields, states) = out
+            for (j, state) in states:
+                refs[j].__dict__.update(state)
+            for (is_virtual, name, values, typ, stage) in vfields:
+                vcls = virtual_virtual_field if is_virtual else virtual_field
+                vcls(name, values, type=typ, stage=stage)
+            for (cg, cg_dyn_preds) in zip(cgs, dyn_preds):
+                cg.dyn_preds = [cg.dyn_pred_obj(pred, pol)
+                                for (pred, pol) in cg_dyn_preds]
+            re_tree_gen.in_cg_list.append(cgs[0])
+            re_tree_gen.out_cg_list.append(cgs[1])
+            cls.stage_cgs[i] = cgs
+            results.append(res)
+        return results
+
     @classmethod
     @Stat.elapsed_time
     def compile_stage(cls, path_pol, in_cg, out_cg, max_states=NUM_PATH_TAGS,
@@ -2791,6 +3639,9 @@ class pathcomp(object):
             t_s = time.time()
             partition_fdd(ast_fold, path_pol, prep_fdd, in_cg, out_cg)
             cls.log.debug('predicate partitioning: %f' % (time.time() - t_s))
+            cls.log.debug('fdd nodes: %d, apply cache hit rate: %f' %
+                          (FDDTranslator.get_num_nodes(),
+                           FDDTranslator.get_cache_hit_rate()))
             (re_list, pol_list) =  ast_fold(path_pol, cls.__get_re_strings__, ([], []), in_cg, out_cg)
 
         else: 
@@ -2860,7 +3711,8 @@ class pathcomp(object):
 
     @classmethod
     @Stat.collects([('dfa', [], True), ('dfa_utils', [], True), 
-                    ('pred_in_list', [], True), ('pred_out_list', [], True)])
+                    ('pred_in_list', [], True), ('pred_out_list', [], True),
+                    ('dfa_min', [], True)])
     def compile_core(cls, re_list, pol_list, in_cg, out_cg, max_states,
                      disjoint_enabled, default_enabled,
                      integrate_enabled, ragel_enabled, use_fdd, stage):
@@ -2895,6 +3747,16 @@ class pathcomp(object):
             regexes_to_dfa_fun = du.regexes_to_dfa
 
         dfa = regexes_to_dfa_fun(re_list)
+        if cls.dfa_min_enabled:
+            (dfa, sizes) = du.minimize(dfa)
+            if not ragel_enabled:
+                ragel_dfa_utils.init(in_cg, out_cg,
+                                     cls.edge_contraction_enabled)
+                du = ragel_dfa_utils
+            cls.log.debug('dfa minimization: states %d -> %d, '
+                          'edges %d -> %d' % (sizes[0], sizes[2],
+                                              sizes[1], sizes[3]))
+            Stat.collect_stat('dfa_min', sizes)
         assert du.get_num_states(dfa) <= max_states
 
         ''' Initialize virtual field for this stage to hold tag values. '''
@@ -3165,6 +4027,154 @@ class common_dfa_utils(object):
     def get_num_states(cls, dfa):
         raise NotImplementedError
 
+    @classmethod
+    def get_edge_symbol(cls, dfa, edge):
+        raise NotImplementedError
+
+    @classmethod
+    def minimize(cls, dfa):
+        """ Minimize `dfa` with Hopcroft's partition refinement, and return a
+        pair (min_dfa, (states_before, edges_before, states_after,
+        edges_after)). The result is always a ragel_dfa (to be accessed with
+        ragel_dfa_utils), with the start state numbered None, the dead state
+        numbered state_num, and all other states numbered from 1.
+
+        Accepting-expression ordinals are treated as outputs on the edges,
+        so two states are merged only if they produce the same ordinals on
+        every symbol, have equivalent successors, and are entered with the
+        same set of ordinals (this keeps the map from accepting states to
+        query policies intact). Transitions which are missing from the DFA go
+        to the dead state.
+        """
+        edges = cls.get_edges(dfa)
+        delta = {}
+        output = {}
+        entering = {}
+        accepting = set()
+        syms = set()
+        dead = None
+        dead_seen = False
+        for edge in edges:
+            (src, src_num, dst, dst_num, _, _) = cls.get_edge_attributes(dfa,
+                                                                         edge)
+            sym = cls.get_edge_symbol(dfa, edge)
+            syms.add(sym)
+            delta.setdefault(src_num, {})[sym] = dst_num
+            ords = ()
+            if cls.is_accepting(dfa, dst):
+                ords = tuple(sorted(cls.get_accepting_exps(dfa, edge, dst)))
+                accepting.add(dst_num)
+                entering.setdefault(dst_num, set()).update(ords)
+            output[(src_num, sym)] = ords
+            for (q, q_num) in [(src, src_num), (dst, dst_num)]:
+                if not dead_seen and cls.is_dead(dfa, q):
+                    (dead, dead_seen) = (q_num, True)
+        all_states = set(delta.keys())
+        for t in delta.values():
+            all_states |= set(t.values())
+        if not dead_seen:
+            dead = max([q for q in all_states if q is not None] + [0]) + 1
+        all_states |= set([None, dead])
+        if dead is None:
+            # The start state is dead; nothing to minimize.
+            return (dfa, (len(all_states), len(edges),
+                          len(all_states), len(edges)))
+
+        def step(q, a):
+            return delta.get(q, {}).get(a, dead)
+
+        sym_list = sorted(syms)
+        ''' Only keep states reachable from the start state. '''
+        states = set([None, dead])
+        frontier = [None]
+        while frontier:
+            q = frontier.pop()
+            for a in sym_list:
+                d = step(q, a)
+                if not d in states:
+                    states.add(d)
+                    frontier.append(d)
+        state_list = sorted(states)
+
+        inv = {}
+        for q in state_list:
+            for a in sym_list:
+                inv.setdefault((a, step(q, a)), []).append(q)
+
+        ''' Initial partition: acceptance, entering ordinals and the ordinals
+        output on each outgoing symbol. '''
+        blocks = {}
+        block_of = {}
+        key_to_block = {}
+        for q in state_list:
+            key = (q in accepting, frozenset(entering.get(q, [])),
+                   tuple([output.get((q, a), ()) for a in sym_list]))
+            if not key in key_to_block:
+                key_to_block[key] = len(blocks)
+                blocks[len(blocks)] = set()
+            b = key_to_block[key]
+            blocks[b].add(q)
+            block_of[q] = b
+
+        ''' Hopcroft refinement. '''
+        work = sorted(blocks.keys())
+        in_work = set(work)
+        while work:
+            b = work.pop()
+            in_work.discard(b)
+            splitter = list(blocks[b])
+            for a in sym_list:
+                touched = {}
+                for d in splitter:
+                    for p in inv.get((a, d), []):
+                        touched.setdefault(block_of[p], set()).add(p)
+                for y in sorted(touched.keys()):
+                    ys = touched[y]
+                    if len(ys) == len(blocks[y]):
+                        continue
+                    rest = blocks[y] - ys
+                    n = len(blocks)
+                    blocks[y] = ys
+                    blocks[n] = rest
+                    for q in rest:
+                        block_of[q] = n
+                    if y in in_work:
+                        work.append(n)
+                        in_work.add(n)
+                    else:
+                        smaller = y if len(ys) <= len(rest) else n
+                        work.append(smaller)
+                        in_work.add(smaller)
+
+        if block_of[None] == block_of[dead]:
+            return (dfa, (len(all_states), len(edges),
+                          len(all_states), len(edges)))
+
+        ''' Number the new states, and pick a representative for each. '''
+        others = sorted([min(qs) for (b, qs) in blocks.items()
+                         if not b in [block_of[None], block_of[dead]]])
+        state_num = len(others) + 1
+        new_num = {block_of[None]: None, block_of[dead]: state_num}
+        reps = [None, dead]
+        for (i, q) in enumerate(others):
+            new_num[block_of[q]] = i + 1
+            reps.append(q)
+
+        new_edges = []
+        edge_ordinals = {}
+        for q in reps:
+            for a in sorted(delta.get(q, {}).keys()):
+                new_edge = (new_num[block_of[q]], a,
+                            new_num[block_of[delta[q][a]]])
+                new_edges.append(new_edge)
+                edge_ordinals[new_edge] = list(output[(q, a)])
+        final_states = sorted(set([new_num[block_of[q]] for q in accepting
+                                   if q in states]))
+        min_dfa = ragel_dfa(state_num, final_states, None, new_edges,
+                            edge_ordinals)
+        return (min_dfa, (len(all_states), len(edges), len(blocks),
+                          len(new_edges)))
+
 
 class dfa_utils(common_dfa_utils):
     """ Utilities to generate DFAs and access various properties. """
@@ -3208,6 +4218,10 @@ class dfa_utils(common_dfa_utils):
         assert isinstance(tt_entry, tuple) and len(tt_entry) == 3
         return tt_entry[2]
 
+    @classmethod
+    def get_edge_symbol(cls, d, tt_entry):
+        return cls.get_edge_label(tt_entry)
+
     @classmethod
     def get_edge_atoms(cls, d, tt_entry):
         q = cls.get_edge_src(d, tt_entry)
@@ -3375,32 +4389,6 @@ class ragel_dfa_utils(common_dfa_utils):
         cls.in_cg = in_cg
         cls.out_cg = out_cg
 
-    @classmethod
-    def get_accepting_states(cls, data):
-        acc_seen = False
-        res = []
-        for line in data.splitlines():
-            if 'node' in line and 'doublecircle' in line:
-                acc_seen = True
-            elif acc_seen:
-                if 'node' in line:
-                    break
-                else:
-                    res.append(cls.get_state(line.strip()[:-1]))
-
-        if res:
-            """ If the input RE is not dead """
-            state_num = max(res) + 1
-        else:
-            state_num = 1
-        return (res, state_num)
-    
-    @classmethod
-    def get_state(cls, q):
-        if q == '1':
-            return None
-        return int(q) - 1
-
     @classmethod
     def is_accepting(cls, dfa, q):
         return q in dfa.final_states
@@ -3416,53 +4404,16 @@ class ragel_dfa_utils(common_dfa_utils):
 
     
     @classmethod
-    def get_extended_edges_contracted(cls, output):
-        res = []
-        edge_ordinals = {}
+    def contract_edges(cls, edges, edge_ordinals):
+        """ Replace parallel edges between two states which together cover
+        exactly the symbols of the `identity` in (resp. out) predicate by a
+        single 'IN_ID' (resp. 'OUT_ID') edge. """
         dfa_dict = {}
-        for line in output.splitlines():
-            if not '->' in line or 'IN' in line or 'main' in line:
-                continue
-            
-            line = line.strip()
-
-            label = line[line.index('=') + 3: line.index(']') - 2]
-            
-            dst = line[line.index('->') + 3 : line.index('[') - 1]
-            src = line[:line.index('->') - 1]
-            dst = cls.get_state(dst)
-            src = cls.get_state(src)
-            
+        for edge in edges:
+            (src, _, dst) = edge
             if not (src, dst) in dfa_dict:
                 dfa_dict[(src, dst)] = []
-
-            parts = [s.strip() for s in label.split('/')]
-            exp_list = []
-            if len(parts) > 1:
-                for exp_num in [s.strip() for s in parts[1].split(',')]:
-                    try:
-                        exp_num = int(exp_num[1:])
-                        exp_list.append(exp_num)
-                    except:
-                        pass
-
-            syms = [s.strip().replace('"','') for s in parts[0].split(',')]
-            for s in syms:
-                if '..' in s:
-                    index = s.index('..')
-                    start = int(s[:index])
-                    end = int(s[index + 2:])
-                    for i in range(start, end + 1):
-                        edge = (src, i, dst)
-                        dfa_dict[(src,dst)].append( edge)
-                        res.append(edge)
-                        edge_ordinals[edge] = exp_list
-                else:
-                    edge = (src, int(s), dst)
-                    dfa_dict[(src, dst)].append(edge)
-                    res.append(edge)
-                    edge_ordinals[edge] = exp_list
-
+            dfa_dict[(src, dst)].append(edge)
 
         def create_id_list(re_tree):
             if isinstance(re_tree, re_symbol):
@@ -3476,15 +4427,15 @@ class ragel_dfa_utils(common_dfa_utils):
             else:
                 raise TypeError
         def check_ordinals(edge_list):
-            edge_ords = [edge_ordinals[e] for e in dfa_list]
+            edge_ords = [edge_ordinals[e] for e in edge_list]
             for i in range(len(edge_ords) - 1):
                 if edge_ords[i] != edge_ords[i + 1]:
                     return False
             return True
 
-
-        in_cache = cls.in_cg.cache
-        out_cache = cls.out_cg.cache
+        res = edges
+        in_cache = getattr(cls.in_cg, 'cache', {})
+        out_cache = getattr(cls.out_cg, 'cache', {})
         in_in = identity in in_cache
         in_out = identity in out_cache
         if in_in or in_out:
@@ -3511,7 +4462,6 @@ class ragel_dfa_utils(common_dfa_utils):
 
                                 res.append(new_edge)
                                 edge_ordinals[new_edge] = new_ord
-                                dfa_dict[(src, dst)] = [identity]
                                 continue
 
                         elif edge_syms == in_id:
@@ -3523,61 +4473,19 @@ class ragel_dfa_utils(common_dfa_utils):
 
                                 res.append(new_edge)
                                 edge_ordinals[new_edge] = new_ord
-                                dfa_dict[(src, dst)] = [identity]
                                 continue
                             
                     res.extend(dfa_list)
         return (res, edge_ordinals)
 
-    
-    @classmethod
-    def get_extended_edges(cls, output):
-        res = []
-        edge_ordinals = {}
-       
-        for line in output.splitlines():
-            if not '->' in line or 'IN' in line or 'main' in line:
-                continue
-            
-            line = line.strip()
-
-            label = line[line.index('=') + 3: line.index(']') - 2]
-            
-            dst = line[line.index('->') + 3 : line.index('[') - 1]
-            src = line[:line.index('->') - 1]
-            dst = cls.get_state(dst)
-            src = cls.get_state(src)
-
-            parts = [s.strip() for s in label.split('/')]
-            exp_list = []
-            if len(parts) > 1:
-                for exp_num in [s.strip() for s in parts[1].split(',')]:
-                    try:
-                        exp_num = int(exp_num[1:])
-                        exp_list.append(exp_num)
-                    except:
-                        pass
-
-            syms = [s.strip().replace('"','') for s in parts[0].split(',')]
-            for s in syms:
-                if '..' in s:
-                    index = s.index('..')
-                    start = int(s[:index])
-                    end = int(s[index + 2:])
-                    for i in range(start, end + 1):
-                        edge = (src, i, dst)
-                        res.append( edge)
-                        edge_ordinals[edge] = exp_list
-                else:
-                    edge = (src, int(s), dst)
-                    res.append(edge)
-                    edge_ordinals[edge] = exp_list
-        return (res, edge_ordinals)
-
     @classmethod
     def get_edges(cls, dfa):
         return dfa.edges
 
+    @classmethod
+    def get_edge_symbol(cls, dfa, edge):
+        return edge[1]
+
     @classmethod
     def get_edge_attributes(cls, dfa, edge, in_list=None, out_list=None):
         assert len(edge) == 3
@@ -3631,19 +4539,6 @@ class ragel_dfa_utils(common_dfa_utils):
     def get_dead_state(cls, dfa):
         return cls.get_num_states(dfa)
 
-    @classmethod
-    def regex_to_ragel_format(cls, re_list, use_fdd):
-        res = '%%{\n\tmachine pyretic;\n\talphtype unsigned int;\n'
-        for i in range(len(re_list)):
-            res += '\taction _%d {}\n' % i
-        
-        re_list_str = '\tmain := '
-        for i,q in re_list:
-            q_str = q if use_fdd else q.re_string_repr()
-            re_list_str += '((' + q_str + (') @_%d)|' %i)
-        res += re_list_str[:-1] + ';}%%\n%% write data;'
-        return res
-
     @classmethod
     def add_dead_edges(cls, edges, state_num):
         """ Ragel doesn't add edges to dead states by default. Add those
@@ -3691,62 +4586,24 @@ class ragel_dfa_utils(common_dfa_utils):
     @classmethod
     @Stat.elapsed_time
     def regexes_to_dfa(cls, re_list, use_fdd=False):
-        import cProfile, pstats, StringIO
-        import time
-        global rt_write_log
-        profile_enabled = True
-        lex_gen_time = 0.0
-        lex_write_time = 0.0
-        ragel_time = 0.0
-        graph_read_time = 0.0
-        dfa_attr_gen_time = 0.0
-        leaf_gen_time = 0.0
-        dfa_gen_time = 0.0
-        if profile_enabled:
-            pr = cProfile.Profile()
-            pr.enable()
-        t_s = time.time()
-        re_list = zip(range(len(re_list)), re_list)
-        lex_input = cls.regex_to_ragel_format(re_list, use_fdd)
-        lex_gen_time = time.time() - t_s
-
+        """ Build the DFA for a list of regular expressions (strings, if
+        `use_fdd` is set), in process. See nfa.regexes_to_subset_dfa. """
         t_s = time.time()
-        lex_input_file = '/tmp/pyretic-regexes.txt'
-        f = open(lex_input_file, 'w')
-        f.write(lex_input)
-        f.close()
-        lex_write_time = time.time() - t_s
-        try:
-            g = open('/tmp/graph.dot', 'w')
-            t_s = time.time()
-            subprocess.call(['ragel', '-V', lex_input_file], stdout=g)
-            g.close()
-            ragel_time = time.time() - t_s
-            t_s = time.time()
-            g = open('/tmp/graph.dot')
-            output = g.read()
-            g.close()
-            graph_read_time = time.time() - t_s
-        except subprocess.CalledProcessError as e:
-            
-            print "Error occured while running ragel"
-            print e.message
-            print e.returncode
-            print e.cmd
-            print e.output
+        if use_fdd:
+            re_list = [parse_re_string(q) for q in re_list]
+        alphabet = (cls.in_cg.symbol_to_pred.keys() +
+                    cls.out_cg.symbol_to_pred.keys())
+        (state_num, accepting_states, edges,
+         edge_ordinal) = regexes_to_subset_dfa(re_list, alphabet)
+        subset_time = time.time() - t_s
 
         t_s = time.time()
-        (accepting_states, state_num) = cls.get_accepting_states(output)
         if cls.edge_contraction_enabled:
-            (edges, edge_ordinal) = cls.get_extended_edges_contracted(output)
-        else:
-            (edges, edge_ordinal) = cls.get_extended_edges(output)
+            (edges, edge_ordinal) = cls.contract_edges(edges, edge_ordinal)
         # Add missing edges going to dead states, if needed.
         cls.add_dead_edges(edges, state_num)
         dfa_attr_gen_time = time.time() - t_s
-       
-        #print 'dfa stat count', state_num
-        #print 'dfa edge count', len(edges)  
+
         t_s = time.time()
         leaf_preds = (cls.in_cg.get_leaf_preds() +
                       cls.out_cg.get_leaf_preds())
@@ -3754,24 +4611,12 @@ class ragel_dfa_utils(common_dfa_utils):
         dfa_utils.__dump_file__(leaf_preds, '/tmp/symbols.txt')
         leaf_gen_time = time.time() - t_s
 
-        t_s = time.time()
         dfa = ragel_dfa(state_num, accepting_states, None, edges, edge_ordinal)
-        dfa_gen_time = time.time() - t_s
-        if profile_enabled:
-            pr.disable()
-            s = StringIO.StringIO()
-            sortby = 'cumulative'
-            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            ps.print_stats()
-            rt_write_log.info(s.getvalue())
-        rt_write_log.info("Times:\n" +
-                          "lex_gen_time: %f\n" % lex_gen_time +
-                          "lex_write_time: %f\n" % lex_write_time +
-                          "ragel_time: %f\n" % ragel_time +
-                          "graph_read_time: %f\n" % graph_read_time +
-                          "dfa_attr_gen_time: %f\n" % dfa_attr_gen_time +
-                          "leaf_gen_time: %f\n" % leaf_gen_time +
-                          "dfa_gen_time: %f\n" % dfa_gen_time)
+        if rt_write_log:
+            rt_write_log.info("Times:\n" +
+                              "subset_time: %f\n" % subset_time +
+                              "dfa_attr_gen_time: %f\n" % dfa_attr_gen_time +
+                              "leaf_gen_time: %f\n" % leaf_gen_time)
         return dfa
 
 
@@ -4016,6 +4861,21 @@ def get_type(query):
     (in_dict, out_dict) = get_types_dict(query)
     return (join_list(in_dict.items()), join_list(out_dict.items()))
 
+def iter_query_types(queries):
+    """ Generate (query, type) for each query of the iterable `queries`.
+    Specializations of the same groupby query (see
+    path_grouping.specialize_query) only differ in the values of the fields
+    they match on, so they share the type of the first one. """
+    origin_types = {}
+    for q in queries:
+        origin = getattr(q, 'groupby_origin', None)
+        if origin is None:
+            yield (q, get_type(q))
+        else:
+            if not id(origin) in origin_types:
+                origin_types[id(origin)] = get_type(q)
+            yield (q, origin_types[id(origin)])
+
 def join_type(t1, t2):
     (fset1, n1) = t1
     (fset2, n2) = t2
@@ -4061,14 +4921,14 @@ def pack(type_list, limit, stagelimit=14):
                 stages[i] = new_typ
                 if not i in assgn:
                     assgn[i] = []
-                assgn[i].append(q)
+                stage_append(assgn[i], q)
                 assigned = True
                 break
         if not assigned:
             ((_, in_cnt), (_, out_cnt)) = typ 
             if in_cnt <= limit and out_cnt <= limit:
                 stages.append(typ)
-                assgn[len(stages) - 1] = [q]
+                assgn[len(stages) - 1] = stage_append([], q)
                 assert len(stages) < stagelimit
             else:
                 print q, in_cnt, out_cnt
@@ -4100,19 +4960,19 @@ def pack_stage(type_list, limit, max_stage):
                 stages[i] = new_typ
                 if not i in assgn:
                     assgn[i] = []
-                assgn[i].append(q)
+                stage_append(assgn[i], q)
                 assigned = True
                 break
         if not assigned:
             if stage_len == max_stage:
                 stages[min_stage] = min_type
-                assgn[min_stage].append(q)
+                stage_append(assgn[min_stage], q)
             else:
                 ((_, in_cnt), (_, out_cnt)) = typ 
                 if in_cnt <= limit and out_cnt <= limit:
                     stages.append(typ)
                     stage_len += 1
-                    assgn[stage_len - 1] = [q]
+                    assgn[stage_len - 1] = stage_append([], q)
                 else:
                     print q, in_cnt, out_cnt
                     raise TypeError
@@ -4130,7 +4990,7 @@ def pack_stagelimited(type_list, numstages):
         if len(stages) < numstages:
             stages.append(typ)
             ((in_fset, in_cnt), (out_fset, out_cnt)) = typ
-            assgn[len(stages) - 1] = [q]
+            assgn[len(stages) - 1] = stage_append([], q)
         else:
             for i in range(numstages):
                 new_typ = join(stages[i], typ)
@@ -4145,33 +5005,190 @@ def pack_stagelimited(type_list, numstages):
             stages[min_max_stage] = min_max_type
             if not min_max_stage in assgn:
                 assgn[min_max_stage] = []
-            assgn[min_max_stage].append(q)
+            stage_append(assgn[min_max_stage], q)
     return assgn
 
-def pack_queries(queries, limit):
-    q_list = [get_type(q) for q in queries]
-    q_list = zip(range(len(q_list)), q_list)
-    assgn = pack(q_list, limit)
-    for i in assgn:
-        res = []
-        for qi in assgn[i]:
-            res.append(queries[qi])  
-        assgn[i] = res
+def get_pinned_switches(pred):
+    """ The set of switches that packets satisfying `pred` may be at, or None
+    if `pred` does not restrict the switch. """
+    if pred == drop:
+        return set()
+    elif isinstance(pred, match):
+        if 'switch' in pred.map:
+            return set([pred.map['switch']])
+        return None
+    elif isinstance(pred, union):
+        res = set()
+        for p in pred.policies:
+            sws = get_pinned_switches(p)
+            if sws is None:
+                return None
+            res |= sws
+        return res
+    elif isinstance(pred, intersection):
+        res = None
+        for p in pred.policies:
+            sws = get_pinned_switches(p)
+            if sws is not None:
+                res = sws if res is None else (res & sws)
+        return res
+    else:
+        return None
+
+class stage_cost(object):
+    """ Estimated cost of compiling a set of queries together in one stage:
+
+    - `typ`: the header-field type of the stage (see get_type), from which the
+      number of predicate partitions in the stage's in and out tables is
+      estimated;
+    - `states`: DFA states, estimated by the number of positions (atoms) of
+      the queries' regular expressions, plus a shared start state;
+    - `sw_trans`: the number of DFA transitions (atoms) pinned to each switch,
+      and `any_trans`: those which may match at any switch.
+
+    The number of rules a switch needs for the stage is estimated as the
+    number of predicate partitions plus the transitions matching at that
+    switch.
+    """
+    def __init__(self, typ, states, sw_trans, any_trans):
+        self.typ = typ
+        self.states = states
+        self.sw_trans = sw_trans
+        self.any_trans = any_trans
+
+    @classmethod
+    def of_query(cls, query, typ=None):
+        sw_trans = Counter()
+        any_trans = [0]
+        def collect(acc, x):
+            if isinstance(x, in_out_atom):
+                sws = get_pinned_switches(x.in_pred & x.out_pred)
+                if sws is None:
+                    any_trans[0] += 1
+                else:
+                    sw_trans.update(sws)
+                return acc + 1
+            return acc
+        positions = path_policy_utils.path_ast_fold(query.path, collect, 0)
+        if typ is None:
+            typ = get_type(query)
+        return cls(typ, positions + 1, sw_trans, any_trans[0])
+
+    def join(self, other):
+        sw_trans = self.sw_trans + other.sw_trans
+        return stage_cost(join(self.typ, other.typ),
+                          self.states + other.states - 1, sw_trans,
+                          self.any_trans + other.any_trans)
+
+    def rules(self):
+        ((_, in_cnt), (_, out_cnt)) = self.typ
+        max_sw_trans = max(self.sw_trans.values()) if self.sw_trans else 0
+        return max(in_cnt, out_cnt) + max_sw_trans + self.any_trans
+
+    def tag_bits(self):
+        """ Bits of the stage's path tag, which also has a `None` value. """
+        return max(1, int(math.ceil(math.log(self.states + 1, 2))))
+
+def pack_cost(cost_list, rule_limit=STAGE_RULE_LIMIT, max_states=NUM_PATH_TAGS,
+              max_stages=MAX_STAGES, max_tag_bits=MAX_TAG_BITS):
+    """ Pack queries into stages, given `cost_list` of (q, stage_cost of q).
+    Queries are placed in decreasing order of estimated rules, each into the
+    stage it grows the least (best fit) among those that stay within
+    `rule_limit` rules per switch, `max_states` DFA states, and `max_tag_bits`
+    tag bits over all stages. A new stage is opened only when no stage fits,
+    and tag bits remain for it; otherwise, the query goes to the stage with
+    the fewest resulting rules, preferring stages within the state and tag
+    bit limits (exceeding those fails compilation, whereas extra rules only
+    cost table space).
+    """
+    order = sorted(enumerate(cost_list),
+                   key=lambda (i, (q, c)): (-c.rules(), -c.states, i))
+    stages = {}
+    members = {}
+    for (idx, (q, cost)) in order:
+        (i, stages[i]) = place_cost(stages, cost, rule_limit, max_states,
+                                    max_stages, max_tag_bits)
+        members.setdefault(i, []).append((idx, q))
+    assgn = {}
+    for (i, stage_members) in members.iteritems():
+        assgn[i] = reduce(lambda acc, (_, q): stage_append(acc, q),
+                          sorted(stage_members), [])
     return assgn
 
+def place_cost(stages, cost, rule_limit=STAGE_RULE_LIMIT,
+               max_states=NUM_PATH_TAGS, max_stages=MAX_STAGES,
+               max_tag_bits=MAX_TAG_BITS):
+    """ Choose the stage for a query of cost `cost`, as described in
+    pack_cost, given `stages`, a dictionary from stage index to the
+    stage_cost of its queries. A new stage gets the lowest unused index.
+    Return the stage index and its stage_cost with the query added. """
+    all_bits = sum([c.tag_bits() for c in stages.values()])
+    best = None
+    fallback = None
+    for (i, stage) in sorted(stages.items()):
+        new_cost = stage.join(cost)
+        new_rules = new_cost.rules()
+        tags_ok = (new_cost.states <= max_states and
+                   (all_bits - stage.tag_bits() + new_cost.tag_bits() <=
+                    max_tag_bits))
+        if (fallback is None or (tags_ok, -new_rules) >
+            (fallback[1], -fallback[2].rules())):
+            fallback = (i, tags_ok, new_cost)
+        if tags_ok and new_rules <= rule_limit:
+            growth = new_rules - stage.rules()
+            if best is None or growth < best[1]:
+                best = (i, growth, new_cost)
+    if best is None:
+        if len(stages) < max_stages and (
+                fallback is None or
+                all_bits + cost.tag_bits() <= max_tag_bits):
+            i = min(set(range(max_stages)) - set(stages.keys()))
+            return (i, cost)
+        best = fallback
+    (i, _, new_cost) = best
+    return (i, new_cost)
+
+def pack_queries(queries, limit):
+    """ Pack the iterable `queries` into stages; `queries` is consumed in a
+    single pass. """
+    return pack(iter_query_types(queries), limit)
+
 def pack_queries_stagelimited(queries, numstages):
+    """ Pack the iterable `queries` into at most `numstages` stages; `queries`
+    is consumed in a single pass, e.g., straight from
+    path_grouping.iter_expand_groupby. """
     assert numstages > 0
-    nonempty_qs = filter(lambda x: not isinstance(x, path_empty), queries)
-    empty_qs = filter(lambda x: isinstance(x, path_empty), queries)
+    empty_qs = []
+    def nonempty_qs():
+        for q in queries:
+            if isinstance(q, path_empty):
+                empty_qs.append(q)
+            else:
+                yield q
     # only do packing for non-empty queries
-    q_list = [get_type(q) for q in nonempty_qs]
-    q_list = zip(range(len(q_list)), q_list)
-    assgn = pack_stage(q_list, 2000, numstages)
-    for i in assgn:
-        res = []
-        for qi in assgn[i]:
-            res.append(nonempty_qs[qi])
-        assgn[i] = res
+    assgn = pack_stage(iter_query_types(nonempty_qs()), 2000, numstages)
+    # attach all empty queries to 0th stage
+    assgn.setdefault(0, [])
+    assgn[0] += empty_qs
+    return assgn
+
+def pack_queries_cost(queries, numstages, rule_limit=STAGE_RULE_LIMIT,
+                      max_states=NUM_PATH_TAGS):
+    """ Pack the iterable `queries` into at most `numstages` stages using the
+    cost model of stage_cost (see pack_cost). """
+    assert numstages > 0
+    empty_qs = []
+    def nonempty_qs():
+        for q in queries:
+            if isinstance(q, path_empty):
+                empty_qs.append(q)
+            else:
+                yield q
+    # keep groupby specializations as slices, not as queries, until packed
+    cost_list = [(stage_append([], q)[0], stage_cost.of_query(q, typ))
+                 for (q, typ) in iter_query_types(nonempty_qs())]
+    assgn = pack_cost(cost_list, rule_limit, max_states, numstages)
     # attach all empty queries to 0th stage
+    assgn.setdefault(0, [])
     assgn[0] += empty_qs
     return assgn
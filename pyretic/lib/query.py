@@ -26,7 +26,7 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
-from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, Query, FwdBucket, CountBucket, DynamicPolicy
+from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, Query, FwdBucket, CountBucket, CounterSeries, AdaptivePollInterval, DynamicPolicy
 import time
 import copy
 import re
@@ -101,11 +101,14 @@ class counts(DynamicPolicy):
     :type interval: some float
     :param group_by: list of grouping fields
     :type group_by: string list
+    :param adaptive: adapt the period of each grouping to its counts (see
+      AdaptivePollInterval), starting from `interval`
+    :type adaptive: boolean
     """
-    def __init__(self, interval=None, group_by=[]):
+    def __init__(self, interval=None, group_by=[], adaptive=False):
         self.set_up_policy(group_by)
         self.set_up_stats()
-        self.set_up_polling(interval)
+        self.set_up_polling(interval, adaptive)
 
     def set_up_policy(self, group_by):
         """Setup policy structure and basic callbacks."""
@@ -123,12 +126,20 @@ class counts(DynamicPolicy):
         self.reported_counts = {}
         self.queried_preds = set([])
         self.queried_preds_lock = Lock()
-
-    def set_up_polling(self,interval):
-        """Setup polling of stats from switches every `interval` seconds. If
-        interval is None, the application needs to call pull_stats directly."""
+        self.rate_subscriptions = []
+
+    def set_up_polling(self,interval,adaptive=False):
+        """Setup polling of stats from switches every `interval` seconds, or
+        at adaptive intervals per grouping. If interval is None, the
+        application needs to call pull_stats directly."""
+        self.poll_intervals = {}
+        self.next_polls = {}
         if interval:
-            self.qt = Thread(target=self.query_thread, args=(interval,))
+            if adaptive:
+                target = self.adaptive_query_thread
+            else:
+                target = self.query_thread
+            self.qt = Thread(target=target, args=(interval,))
             self.qt.daemon = True
             self.qt.start()
 
@@ -139,6 +150,31 @@ class counts(DynamicPolicy):
             self.pull_stats()
             time.sleep(interval)
 
+    def adaptive_query_thread(self, interval):
+        """Thread that pulls the stats of each grouping when due, at intervals
+        adapted to the counts of the grouping so far."""
+        time.sleep(interval)
+        while True:
+            now = time.time()
+            with self.queried_preds_lock:
+                buckets = self.bucket_dict.items()
+            due = []
+            for (pred, cb) in buckets:
+                if not pred in self.poll_intervals:
+                    self.poll_intervals[pred] = AdaptivePollInterval(interval)
+                if self.next_polls.get(pred, now) <= now:
+                    due.append(pred)
+            if due:
+                self.pull_stats(due)
+            for (pred, cb) in buckets:
+                if pred in due:
+                    poll_interval = self.poll_intervals[pred]
+                    self.next_polls[pred] = now + poll_interval.next(cb.series)
+            wait = interval
+            if self.next_polls:
+                wait = min(wait, min(self.next_polls.values()) - time.time())
+            time.sleep(max(0.0, wait))
+
     def init_countbucket(self, pkt):
         """When a packet from a previously unseen grouping arrives, set up new
         count buckets for the same.
@@ -146,6 +182,8 @@ class counts(DynamicPolicy):
         pred = self.groupby_filter.get_pred_from_pkt(pkt)
         cb = CountBucket()
         cb.register_callback(self.collect_pred(pred))
+        for args in self.rate_subscriptions:
+            self.subscribe_bucket_rate(pred, cb, *args)
         self.bucket_policies.append(pred >> cb)
         self.bucket_dict[pred] = cb
         # Send the current packet to the new countbucket
@@ -176,13 +214,41 @@ class counts(DynamicPolicy):
     def register_callback(self, fn):
         self.callbacks.append(fn)
 
-    def pull_stats(self):
-        """Pulls statistics from the switches corresponding to all groupings."""
+    def subscribe_rate(self, threshold, callback,
+                       field=CounterSeries.PACKETS, window=None):
+        """Call `callback(grouping, rate, above)` when the rate of the counts
+        of a grouping crosses `threshold`, for current and future groupings
+        (see CounterSeries.subscribe)."""
+        args = (threshold, callback, field, window)
+        self.rate_subscriptions.append(args)
+        for (pred, cb) in self.bucket_dict.items():
+            self.subscribe_bucket_rate(pred, cb, *args)
+
+    def subscribe_bucket_rate(self, pred, cb, threshold, callback, field,
+                              window):
+        def notify(rate, above):
+            callback(pred.map, rate, above)
+        cb.subscribe_rate(threshold, notify, field, window)
+
+    def get_series(self):
+        """Return the CounterSeries of the counts of each grouping."""
+        return { pred.map : cb.series for (pred, cb) in
+                 self.bucket_dict.items() }
+
+    def pull_stats(self, preds=None):
+        """Pulls statistics from the switches corresponding to all groupings,
+        or only to the groupings `preds`. In the latter case, callbacks also
+        get the last counts reported for the other groupings."""
         buckets_list = []
         with self.queried_preds_lock:
-            self.queried_preds = set(copy.deepcopy(self.bucket_dict.keys()))
-            self.reported_counts = {}
-            for pred in self.queried_preds:
+            if preds is None:
+                self.queried_preds = set(copy.deepcopy(self.bucket_dict.keys()))
+                self.reported_counts = {}
+                preds = self.queried_preds
+            else:
+                # replies still pending for other groupings are collected too
+                self.queried_preds |= set(preds)
+            for pred in set(preds):
                 buckets_list.append(self.bucket_dict[pred])
         # Calling pull_stats while holding the lock creates a potential deadlock
         for bucket in buckets_list:
@@ -194,6 +260,24 @@ class counts(DynamicPolicy):
         return "counts\n%s" % repr(self.policy)
 
 
+def poll_stats(bucket, interval, adaptive=False):
+    """Pull the stats of `bucket` (e.g., a path query's CountBucket) every
+    `interval` seconds in a daemon thread, or, if `adaptive`, at intervals
+    adapted to its counts (see AdaptivePollInterval). Returns the thread."""
+    def poll():
+        poll_interval = AdaptivePollInterval(interval)
+        while True:
+            bucket.pull_stats()
+            if adaptive:
+                time.sleep(poll_interval.next(bucket.series))
+            else:
+                time.sleep(interval)
+    t = Thread(target=poll)
+    t.daemon = True
+    t.start()
+    return t
+
+
 class AggregateFwdBucket(FwdBucket):
     """An abstract FwdBucket which calls back all registered routines every interval
     seconds (can take positive fractional values) with an aggregate value/dict.
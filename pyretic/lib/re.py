@@ -30,6 +30,7 @@
 ################################################################################
 from pyretic.evaluations.stat import Stat
 import string
+import weakref
 try:
     import pyretic.vendor
     import pydot as dot
@@ -45,6 +46,48 @@ KEY_STAR    = -5
 KEY_INTERS  = -6
 KEY_NEGATE  = -7
 
+# Hash-consing of regular expression structure.
+#
+# Every regular expression object points to a canonical `re_node` which
+# represents its structure (ignoring metadata). Nodes are interned in a unique
+# table, so two expressions are structurally equal iff they share the same
+# node. This makes equality a pointer comparison and hashing O(1), and gives
+# derivatives and nullability a place to be memoized. Metadata stays on the
+# (non-shared) expression objects themselves. The table holds nodes weakly,
+# so nodes (and their memo tables) go away with the last expression using
+# them.
+class re_node(object):
+    """ Canonical representative of the structure of a regular expression. """
+    __slots__ = ['key', 'hash', 'nullable', 'derivs', '__weakref__']
+
+    def __init__(self, key):
+        self.key = key
+        self.hash = hash(key)
+        self.nullable = None
+        self.derivs = {}
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        """ Unpickled nodes are interned again (memo tables aren't kept). """
+        return (get_re_node, self.key)
+
+re_unique_table = weakref.WeakValueDictionary()
+
+def get_re_node(*key):
+    """ Return the unique node for the structure denoted by `key`, which is a
+    tuple of a type tag followed by symbols or child nodes. """
+    node = re_unique_table.get(key)
+    if node is None:
+        node = re_node(key)
+        re_unique_table[key] = node
+    return node
+
+def get_num_re_nodes():
+    """ Number of distinct regular expression structures currently alive. """
+    return len(re_unique_table)
+
 # Data type definitions
 # These are basic elements to be used by applications to construct regular
 # expressions, with various combinators that invoke smart constructors that
@@ -78,11 +121,12 @@ class re_deriv(object):
         raise NotImplementedError
 
     def __hash__(self):
-        return hash(self.re_string_repr())
+        return self.node.hash
 
     def __eq__(self, other):
-        """ Each child class should override this method. """
-        raise NotImplementedError
+        """ Structural equality (ignoring metadata), which is identity of the
+        hash-consed nodes. Each child class must set self.node. """
+        return isinstance(other, re_deriv) and self.node is other.node
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -144,9 +188,7 @@ class re_epsilon(re_base):
     """ A regular expression that is equivalent to a zero-length string. """
     def __init__(self, metadata=None, lst=True):
         super(re_epsilon, self).__init__(metadata, lst)
-
-    def __eq__(self, other):
-        return isinstance(other, re_epsilon)
+        self.node = get_re_node('epsilon')
 
     def sort_key(self):
         return KEY_EPSILON
@@ -158,9 +200,7 @@ class re_empty(re_base):
     """ The null regular expression, which matches nothing. """
     def __init__(self, metadata=None, lst=True):
         super(re_empty, self).__init__(metadata, lst)
-
-    def __eq__(self, other):
-        return isinstance(other, re_empty)
+        self.node = get_re_node('empty')
 
     def sort_key(self):
         return KEY_EMPTY
@@ -173,10 +213,7 @@ class re_symbol(re_base):
     def __init__(self, char, metadata=None, lst=True):
         super(re_symbol, self).__init__(metadata, lst)
         self.char = char
-
-    def __eq__(self, other):
-        return (isinstance(other, re_symbol) and
-                other.char == self.char)
+        self.node = get_re_node('symbol', char)
 
     def sort_key(self):
         return self.char
@@ -228,12 +265,7 @@ class re_concat(re_combinator):
         self.re1 = re1
         self.re2 = re2
         super(re_concat, self).__init__([re1, re2])
-
-    def __eq__(self, other):
-        return (isinstance(other, re_concat) and
-                self.re1 == other.re1 and
-                self.re2 == other.re2 and
-                self.re_list == other.re_list)
+        self.node = get_re_node('concat', re1.node, re2.node)
 
     def sort_key(self):
         return KEY_CONCAT
@@ -255,10 +287,7 @@ class re_alter(re_combinator):
     """ Class for regular expressions with a topmost alternation operator. """
     def __init__(self, re_list):
         super(re_alter, self).__init__(re_list)
-
-    def __eq__(self, other):
-        return (isinstance(other, re_alter) and
-                self.re_list == other.re_list)
+        self.node = get_re_node('alter', *[r.node for r in re_list])
 
     def sort_key(self):
         return KEY_ALTER
@@ -281,11 +310,7 @@ class re_star(re_combinator):
     def __init__(self, re):
         self.re = re
         super(re_star, self).__init__([re])
-
-    def __eq__(self, other):
-        return (isinstance(other, re_star) and
-                self.re == other.re and
-                self.re_list == other.re_list)
+        self.node = get_re_node('star', re.node)
 
     def sort_key(self):
         return KEY_STAR
@@ -303,10 +328,7 @@ class re_inters(re_combinator):
     """ Class for regular expressions with a topmost intersection operator. """
     def __init__(self, re_list):
         super(re_inters, self).__init__(re_list)
-
-    def __eq__(self, other):
-        return (isinstance(other, re_inters) and
-                self.re_list == other.re_list)
+        self.node = get_re_node('inters', *[r.node for r in re_list])
 
     def sort_key(self):
         return KEY_INTERS
@@ -328,11 +350,7 @@ class re_negate(re_combinator):
     def __init__(self, re):
         self.re = re
         super(re_negate, self).__init__([re])
-
-    def __eq__(self, other):
-        return (isinstance(other, re_negate) and
-                self.re == other.re and
-                self.re_list == other.re_list)
+        self.node = get_re_node('negate', re.node)
 
     def sort_key(self):
         return KEY_NEGATE
@@ -354,38 +372,38 @@ def nullable(r):
     :param r: the regex which is tested.
     :type r: re_deriv
     """
-    def bool_to_re(b):
-        return re_epsilon() if b else re_empty()
-    def re_to_bool(r):
-        if isinstance(r, re_epsilon):
-            return True
-        elif isinstance(r, re_empty):
-            return False
-        else:
-            raise TypeError('re_to_bool expects re_epsilon or re_empty')
-    
+    return re_epsilon() if is_nullable(r) else re_empty()
+
+def is_nullable(r):
+    """ Return True if a regular expression r is nullable, else False. The
+    result is memoized on the hash-consed node of r.
+
+    :param r: the regex which is tested.
+    :type r: re_deriv
+    """
+    node = r.node
+    if node.nullable is None:
+        node.nullable = nullable_uncached(r)
+    return node.nullable
+
+def nullable_uncached(r):
     assert isinstance(r, re_deriv)
     if isinstance(r, re_epsilon):
-        return re_epsilon()
+        return True
     elif isinstance(r, re_symbol):
-        return re_empty()
+        return False
     elif isinstance(r, re_empty):
-        return re_empty()
+        return False
     elif isinstance(r, re_concat):
-        f = lambda x: re_to_bool(nullable(x))
-        return bool_to_re(f(r.re1) and f(r.re2))
+        return is_nullable(r.re1) and is_nullable(r.re2)
     elif isinstance(r, re_alter):
-        return bool_to_re(reduce(lambda acc, s: acc or re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 False))
+        return reduce(lambda acc, s: acc or is_nullable(s), r.re_list, False)
     elif isinstance(r, re_star):
-        return re_epsilon()
+        return True
     elif isinstance(r, re_inters):
-        return bool_to_re(reduce(lambda acc, s: acc and re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 True))
+        return reduce(lambda acc, s: acc and is_nullable(s), r.re_list, True)
     elif isinstance(r, re_negate):
-        return bool_to_re(not re_to_bool(nullable(r.re)))
+        return not is_nullable(r.re)
     else:
         raise TypeError('unexpected type for nullable!')
 
@@ -622,7 +640,10 @@ def foldl(fun, re_list, init):
     return reduce(fun, re_list, init)
 
 def deriv(r, a):
-    """ Derivative of a regular expression with respect to a single symbol
+    """ Derivative of a regular expression with respect to a single symbol. The
+    result is memoized on the hash-consed node of r, so it is only meaningful up
+    to structural equality: metadata on the returned expression is that of the
+    first expression differentiated. Use deriv_consumed to track metadata.
 
     :param r: regular expression
     :type r: re_deriv
@@ -631,6 +652,14 @@ def deriv(r, a):
     """
     assert isinstance(r, re_deriv)
     assert isinstance(a, re_symbol)
+    derivs = r.node.derivs
+    try:
+        return derivs[a.char]
+    except KeyError:
+        d = derivs[a.char] = deriv_uncached(r, a)
+        return d
+
+def deriv_uncached(r, a):
     asym = a.char
     if isinstance(r, re_empty):
         return re_empty()
@@ -662,9 +691,23 @@ def deriv_consumed(r, a):
     """ A version of the derivative function that also returns the list of
     `re_symbol`s that was consumed. The type of this function is
     re_deriv -> re_symbol -> (re_deriv * list re_symbol).
+
+    Since the result depends on metadata, it is memoized per expression object
+    rather than per hash-consed node.
     """
     assert isinstance(r, re_deriv)
     assert isinstance(a, re_symbol)
+    try:
+        cache = r.consumed_derivs
+    except AttributeError:
+        cache = r.consumed_derivs = {}
+    try:
+        return cache[a.char]
+    except KeyError:
+        d = cache[a.char] = deriv_consumed_uncached(r, a)
+        return d
+
+def deriv_consumed_uncached(r, a):
     asym = a.char
     if isinstance(r, re_empty):
         return (re_empty(), [])
@@ -688,7 +731,7 @@ def deriv_consumed(r, a):
         return (smart_alter(
             smart_concat(d1, r.re2),
             smart_concat(nullable(r.re1), d2)),
-                s1 + (s2 if nullable(r.re1) == re_epsilon() else []))
+                s1 + (s2 if is_nullable(r.re1) else []))
     elif isinstance(r, re_alter):
         dslist = map(lambda x: deriv_consumed(x, a), r.re_list)
         return (foldl(lambda rs, s: smart_alter(rs, s[0]),
@@ -723,7 +766,7 @@ def match_string(r, s):
     assert isinstance(r, re_deriv)
     assert isinstance(s, str)
     if len(s) == 0:
-        return True if nullable(r) == re_epsilon() else False
+        return is_nullable(r)
     else:
         a = re_symbol(s[0])
         return match_string(deriv(r, a), s[1:])
@@ -783,14 +826,14 @@ class dfa_transition_table(object):
     def contains_state(self, state):
         """ Return True if the DFA contains the argument state. """
         assert self.state_type_check_fun(state, self.state_type)
-        return state in self.re_to_transitions.keys()
+        return state in self.re_to_transitions
 
     def lookup_state_symbol(self, q, c):
         """ Lookup a transition from state `q` on symbol `c` """
         assert self.state_type_check_fun(q, self.state_type)
         assert self.symbol_type_check_fun(c, self.symbol_type)
-        if q in self.re_to_transitions.keys():
-            if c in self.re_to_transitions[q].keys():
+        if q in self.re_to_transitions:
+            if c in self.re_to_transitions[q]:
                 return self.re_to_transitions[q][c]
         return None
 
@@ -996,7 +1039,7 @@ class re_state_table(dfa_state_table):
     """ A table of RE states in the DFA """
     def __init__(self, states=None, re_to_exp=None,
                  state_type=re_deriv, state_type_check_fun=isinstance,
-                 final_state_check_fun=lambda x: nullable(x) == re_epsilon(),
+                 final_state_check_fun=is_nullable,
                  dead_state_check_fun=lambda x: x == re_empty()):
         super(re_state_table, self).__init__(states,
                                              state_type,
@@ -1278,7 +1321,7 @@ class re_vector_state_table(dfa_state_table):
         """ Class for table of states which are vectors of regular
         expressions. """
         def tuple_has_final_state(qtuple):
-            return reduce(lambda acc, x: acc or nullable(x) == re_epsilon(),
+            return reduce(lambda acc, x: acc or is_nullable(x),
                           qtuple, False)
 
         def tuple_is_dead_state(qtuple):
@@ -1305,7 +1348,7 @@ class re_vector_state_table(dfa_state_table):
         ordinal_list = []
         for index in range(0, len(q)):
             qcomp = q[index]
-            if nullable(qcomp) == re_epsilon():
+            if is_nullable(qcomp):
                 ordinal_list.append(index)
         return ordinal_list
 
@@ -0,0 +1,110 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.packet import Packet
+from pyretic.core.classifier import Classifier, Rule
+from pyretic.lib.std import *
+from pyretic.lib.fdd import fdd_compile
+
+import pytest
+
+### Compilation of policies through FDDs ###
+
+def sample_pkts():
+    pkts = []
+    for sw in [1, 2]:
+        for port in [1, 2, 3]:
+            for src in ['10.0.0.1', '10.0.1.1', '10.1.0.1', '11.0.0.1']:
+                for dst in ['10.0.0.2', '12.0.0.1']:
+                    pkts.append(Packet({'switch': sw, 'port': port,
+                                        'inport': port,
+                                        'srcip': IPAddr(src),
+                                        'dstip': IPAddr(dst)}))
+    return pkts
+
+def check_fdd_compile(pol):
+    c = fdd_compile(pol)
+    for pkt in sample_pkts():
+        assert c.eval(pkt) == pol.eval(pkt), (pkt, c)
+    return c
+
+def test_fdd_compile_primitives():
+    assert list(fdd_compile(identity).rules) == [Rule(identity, {identity})]
+    assert list(fdd_compile(drop).rules) == [Rule(identity, set())]
+    c = check_fdd_compile(match(switch=1, port=2))
+    assert list(c.rules) == [Rule(match(switch=1, port=2), {identity}),
+                       Rule(identity, set())]
+    check_fdd_compile(modify(port=2, srcip='10.0.0.9'))
+
+def test_fdd_compile_parallel():
+    check_fdd_compile((match(switch=1) >> fwd(2)) +
+                      (match(srcip='10.0.0.0/8') >> fwd(3)))
+    check_fdd_compile(match(switch=1) | ~match(port=2))
+
+def test_fdd_compile_prefixes():
+    pol = if_(match(srcip='10.0.0.0/16'), fwd(1),
+              if_(match(srcip='10.0.0.0/8'), fwd(2), drop))
+    c = check_fdd_compile(pol)
+    assert len(c.rules) == 3
+    check_fdd_compile(~(match(switch=1) | match(srcip='10.1.0.0/16')) >>
+                      fwd(1))
+
+def test_fdd_compile_sequential():
+    check_fdd_compile((match(srcip='10.0.0.0/8') >>
+                       modify(srcip='11.0.0.1')) >>
+                      if_(match(srcip='11.0.0.0/8'), fwd(3), fwd(1)))
+    check_fdd_compile((modify(port=2) + modify(port=3)) >>
+                      ((match(port=2) >> modify(dstip='1.1.1.1')) +
+                       (match(port=3) >> fwd(1))))
+    pol = identity
+    for i in range(4):
+        pol = pol >> if_(match(srcip='10.%d.0.0/16' % i), modify(tos=i),
+                         identity)
+    check_fdd_compile(pol >> (fwd(1) + (match(tos=1) >> fwd(2))))
+
+def test_fdd_compile_buckets():
+    b = CountBucket()
+    c = check_fdd_compile((match(switch=2, port=3) >> Controller) +
+                          (match(switch=2) >> modify(port=1) >>
+                           (b + (match(port=1) >> fwd(2)))))
+    assert any([b in r.actions for r in c.rules])
+    c = fdd_compile(b >> modify(port=1))
+    assert list(c.rules) == [Rule(identity, {b})]
+
+def test_fdd_compile_negation():
+    with pytest.raises(TypeError):
+        fdd_compile(~fwd(1))
+
+if __name__ == "__main__":
+    test_fdd_compile_primitives()
+    test_fdd_compile_parallel()
+    test_fdd_compile_prefixes()
+    test_fdd_compile_sequential()
+    test_fdd_compile_buckets()
+    test_fdd_compile_negation()
@@ -28,11 +28,26 @@
 
 from pyretic.lib.corelib import *
 from pyretic.lib.hsa import *
+import pyretic.lib.hsa as hsa
 from pyretic.core.runtime import virtual_field
 from pyretic.core.language import _modify
 import copy
+import os
+import shutil
+import sys
+import tempfile
 
 #### Common virtual tagging and untagging policy constructions ####
+def setup_module(module):
+    """ Keep the transfer function files saved by the tests out of the
+    hassel-c folder. """
+    module.tfs_folder = hsa.TFS_FOLDER
+    hsa.TFS_FOLDER = tempfile.mkdtemp()
+
+def teardown_module(module):
+    shutil.rmtree(hsa.TFS_FOLDER)
+    hsa.TFS_FOLDER = module.tfs_folder
+
 def sample_vtagging(sw_ports, network_links):
     """ Temporary helper equivalent of virtual_untagging() policy. """
     edge_net = get_hsa_edge_policy(sw_ports, network_links)
@@ -219,9 +234,112 @@ def hsa_path_test_5():
                   sample_out_table_policy_5(),
                   sample_outmatches_5())
 
+def test_inprocess_reachability():
+    hs_format = pyr_hs_format()
+    sw_ports = get_test_switch_port_ids()
+    net_links = get_test_network_links()
+    setup_tfs_data_from_policy(hs_format, static_fwding_chain_3_3(), sw_ports,
+                               net_links)
+    portids = get_portid_map(sw_ports)
+    ip1 = IPAddr('10.0.0.1')
+    ip2 = IPAddr('10.0.0.2')
+    ip3 = IPAddr('10.0.0.3')
+    queries = [(3, 2, match(switch=1, port=2)),
+               (3, 2, match(switch=1, port=2, dstip=ip2)),
+               (1, 2, match(switch=2, port=1, dstport=79)),
+               (2, 3, match(dstport=79))]
+    expected = [[match(dstip=ip1)],
+                [],
+                [match(dstip=ip2, dstport=79), match(dstip=ip3, dstport=79)],
+                [match(dstip=ip1), match(dstip=ip3, dstport=79)]]
+    def filters(f):
+        if f == drop:
+            return []
+        return f.policies if isinstance(f, union) else [f]
+    version = reachability_service.version
+    res = get_reachable_inheaders_batch(hs_format, portids, sw_ports, queries)
+    for (f, exp) in zip(res, expected):
+        assert sorted(map(str, filters(f))) == sorted(map(str, exp))
+    # answered from the cache, until the transfer functions change
+    (insw, inport, outmatch) = queries[0]
+    assert get_reachable_inheaders(hs_format, portids, sw_ports, insw, inport,
+                                   outmatch) is res[0]
+    setup_tfs_data_from_policy(hs_format, static_fwding_chain_3_3(), sw_ports,
+                               net_links)
+    assert reachability_service.version == version + 1
+    assert get_reachable_inheaders(hs_format, portids, sw_ports, insw, inport,
+                                   outmatch) is not res[0]
+
+def test_binary_tf_files():
+    hs_format = pyr_hs_format()
+    sw_ports = get_test_switch_port_ids()
+    net_links = get_test_network_links()
+    portids = get_portid_map(sw_ports)
+    c = static_fwding_chain_3_3().compile()
+    tfs_map = convert_classifier(c, hs_format, portids, sw_ports, save=False)
+    tfs_map['topology'] = convert_topology(get_edge_list(net_links), hs_format,
+                                           portids, save=False)
+    folder = tempfile.mkdtemp()
+    try:
+        loaded = {}
+        for (sw, tf) in tfs_map.iteritems():
+            filename = '%s/%s.tfb' % (folder, sw)
+            assert save_tf_binary(tf, filename, 'a' * 16)
+            assert not save_tf_binary(tf, filename, 'a' * 16)
+            assert read_tf_binary_digest(filename) == 'a' * 16
+            loaded[sw] = load_tf_binary(filename)
+            assert str(loaded[sw]) == str(tf)
+            for (r1, r2) in zip(tf.rules, loaded[sw].rules):
+                assert r1["id"] == r2["id"]
+                assert ([(r["id"], wildcard_to_str(h), ports)
+                         for (r, h, ports) in r1["affected_by"]] ==
+                        [(r["id"], wildcard_to_str(h), ports)
+                         for (r, h, ports) in r2["affected_by"]])
+        ttf = loaded.pop('topology')
+        reachability_service.load(hs_format, loaded, ttf)
+        res = get_reachable_inheaders(hs_format, portids, sw_ports, 3, 2,
+                                      match(switch=1, port=2))
+        assert str(res) == str(match(dstip=IPAddr('10.0.0.1')))
+    finally:
+        shutil.rmtree(folder)
+
+def test_saved_tfs_reused():
+    hs_format = pyr_hs_format()
+    sw_ports = get_test_switch_port_ids()
+    net_links = get_test_network_links()
+    setup_tfs_data_from_policy(hs_format, static_fwding_chain_3_3(), sw_ports,
+                               net_links)
+    names = ["s%d" % sw for sw in sw_ports.keys()] + ["topology"]
+    for name in names:
+        assert os.path.exists('%s.tfb' % tf_file_name(name))
+    # as after a restart, unchanged transfer functions are loaded from files
+    built_tfs.clear()
+    loaded = []
+    old_load_tf_binary = hsa.load_tf_binary
+    def load_tf_binary(filename):
+        loaded.append(filename)
+        return old_load_tf_binary(filename)
+    hsa.load_tf_binary = load_tf_binary
+    try:
+        setup_tfs_data_from_policy(hs_format, static_fwding_chain_3_3(),
+                                   sw_ports, net_links)
+    finally:
+        hsa.load_tf_binary = old_load_tf_binary
+    assert sorted(loaded) == sorted(['%s.tfb' % tf_file_name(name)
+                                     for name in names])
+    portids = get_portid_map(sw_ports)
+    res = get_reachable_inheaders(hs_format, portids, sw_ports, 3, 2,
+                                  match(switch=1, port=2))
+    assert str(res) == str(match(dstip=IPAddr('10.0.0.1')))
+
 if __name__ == "__main__":
     logging.basicConfig()
+    setup_module(sys.modules[__name__])
+    test_inprocess_reachability()
+    test_binary_tf_files()
+    test_saved_tfs_reused()
     basic_test()
     virtual_field(name="test_tag", values=range(0, 10), type="integer")
     hsa_path_test_0()
     hsa_path_test_5()
+    teardown_module(sys.modules[__name__])
@@ -0,0 +1,104 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.lib.corelib import *
+from pyretic.core.netkat import compile_to_netkat, json_to_classifier
+from pyretic.core.netkat_server import compile_json, start_local_server
+
+import json
+import socket
+import pytest
+
+vlan_info = {'vlan_offset': 0, 'vlan_nbits': 15, 'vlan_total_stages': 1}
+
+def mod_maps(acts):
+    return [dict(a.map) for a in acts if isinstance(a, modify)]
+
+def get_tables(pol):
+    (out, ctime) = compile_json(compile_to_netkat(pol))
+    assert ctime >= 0
+    return {t['switch_id']: t['tbl'] for t in json.loads(out)}
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def test_tables_per_switch():
+    pol = ((match(switch=1) >> fwd(2)) + (match(switch=2) >> fwd(3)))
+    tbls = get_tables(pol)
+    assert sorted(tbls.keys()) == [1, 2]
+    assert tbls[1][0]['action'] == [[["Output", {"type": "physical",
+                                                 "port": 2}]]]
+    assert tbls[2][0]['action'] == [[["Output", {"type": "physical",
+                                                 "port": 3}]]]
+    prios = [r['priority'] for r in tbls[1]]
+    assert prios == sorted(prios, reverse=True)
+
+def test_no_switch_wildcard_table():
+    tbls = get_tables(match(port=1) >> fwd(2))
+    assert tbls.keys() == [0]
+    assert tbls[0][0]['pattern'] == {'inPort': 1}
+
+def test_classifier_round_trip():
+    b = CountBucket()
+    mac = MAC('00:00:00:00:00:03')
+    pol = ((match(switch=1, srcip='10.0.0.0/24') >> fwd(2)) +
+           (match(switch=1, srcmac=mac) >> (b + Controller)) +
+           (match(switch=1, dstport=80) >> modify(dstmac=mac, port=4)))
+    (out, _) = compile_json(compile_to_netkat(pol))
+    c = json_to_classifier(out, {str(id(b)): b}, False, vlan_info)
+    rules = list(c.rules)
+    mac_rules = [r for r in rules if r.match.map.get('srcmac') == mac]
+    assert mac_rules
+    assert b in mac_rules[0].actions and Controller in mac_rules[0].actions
+    ip_rules = [r for r in rules if set(r.match.map.keys()) ==
+                set(['switch', 'srcip', 'ethtype'])]
+    assert ip_rules and mod_maps(ip_rules[0].actions) == [{'port': 2}]
+    mod_rules = [r for r in rules if r.match.map.get('dstport') == 80]
+    assert {'dstmac': mac, 'port': 4} in mod_maps(mod_rules[0].actions)
+    assert all(r.match.map['switch'] == 1 for r in rules)
+
+def test_http_compile():
+    port = free_port()
+    server = start_local_server(port)
+    try:
+        pol = (match(switch=1) >> fwd(2)) + (match(switch=2) >> drop)
+        (c, ctime) = pol.netkat_compile(switch_cnt=2, server_port=port,
+                                        force_compile=True)
+        assert float(ctime) >= 0
+        s1 = [r for r in c.rules if r.match.map['switch'] == 1]
+        s2 = [r for r in c.rules if r.match.map['switch'] == 2]
+        assert mod_maps(s1[0].actions) == [{'port': 2}]
+        assert len(s2[0].actions) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,104 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.lib.re import *
+from pyretic.lib.nfa import *
+
+import itertools
+import pytest
+
+a = re_symbol(1)
+b = re_symbol(2)
+c = re_symbol(3)
+symbols = [1, 2, 3]
+
+def accepted(dfa, word):
+    """ Ordinals of expressions accepting `word` in a subset-construction
+    DFA. """
+    (state_num, final_states, edges, edge_ordinals) = dfa
+    trans = dict([((s, x), (d, edge_ordinals[(s, x, d)]))
+                  for (s, x, d) in edges])
+    (q, ords) = (None, [])
+    for x in word:
+        if not (q, x) in trans:
+            return []
+        (q, ords) = trans[(q, x)]
+    return ords
+
+def deriv_accepted(re_list, word):
+    res = []
+    for (i, r) in enumerate(re_list):
+        for x in word:
+            r = deriv(r, re_symbol(x))
+        if is_nullable(r):
+            res.append(i)
+    return res
+
+def test_parse_re_string():
+    exps = [a ^ b, (a | b) ^ +c, ~(a ^ b) & +(a | c), re_empty(),
+            (a ^ re_epsilon()) | b]
+    for r in exps:
+        assert parse_re_string(r.re_string_repr()) == r
+    assert parse_re_string('((1)|(3)).((2))*') == (a | c) ^ +b
+    with pytest.raises(ValueError):
+        parse_re_string('(1).(2')
+
+def test_symbol_classes():
+    (sym_to_class, class_to_syms) = get_symbol_classes([(a | b) ^ c],
+                                                       [1, 2, 3, 4, 5])
+    assert sym_to_class[1] == sym_to_class[2]
+    assert sym_to_class[4] == sym_to_class[5]
+    assert len(set(sym_to_class.values())) == 3
+    assert sorted(class_to_syms[sym_to_class[4]]) == [4, 5]
+
+def test_subset_dfa():
+    re_list = [(a ^ b) | (a ^ c),
+               +a ^ b,
+               ~(a ^ +b) & (a ^ +(b | c))]
+    dfa = regexes_to_subset_dfa(re_list, symbols)
+    (state_num, final_states, edges, edge_ordinals) = dfa
+    # ragel numbering: start is None, accepting states come last, and the
+    # dead state is not materialized.
+    states = set([s for (s, x, d) in edges] + [d for (s, x, d) in edges])
+    assert None in states
+    assert not state_num in states
+    non_final = [q for q in states if q is not None and
+                 not q in final_states]
+    assert all([q < min(final_states) for q in non_final])
+    for n in range(1, 5):
+        for word in itertools.product(symbols, repeat=n):
+            assert accepted(dfa, word) == deriv_accepted(re_list, word)
+
+# Just in case: keep these here to run unit tests in vanilla python
+if __name__ == "__main__":
+    test_parse_re_string()
+    test_symbol_classes()
+    test_subset_dfa()
+
+    print "If this message is printed without errors before it, we're good."
+    print "Also ensure all unit tests are listed above this line in the source."
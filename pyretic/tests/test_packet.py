@@ -6,6 +6,7 @@ from ryu.lib import addrconv
 from pyretic.core.packet import *
 from pyretic.core.packet import ProtocolValidator, EthertypeValidator, Processor
 import pytest
+import struct
 
 udp_payload_srcmac="\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x01\x08\x00\x45\x00\x01\x48\x04\x46\x00\x00\x80\x11\xb4\x03\xc0\xa8\x00\x01\xc0\xa8\x00\x0a\x00\x43\x00\x44\x01\x34\xdf\xdb\x02\x01\x06\x00\x00\x00\x3d\x1e\x00\x00\x00\x00\x00\x00\x00\x00\xc0\xa8\x00\x0a\x00\x00\x00\x00\x00\x00\x00\x00\x00\x0b\x82\x01\xfc\x42\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x63\x82\x53\x63\x35\x01\x05\x3a\x04\x00\x00\x07\x08\x3b\x04\x00\x00\x0c\x4e\x33\x04\x00\x00\x0e\x10\x36\x04\xc0\xa8\x00\x01\x01\x04\xff\xff\xff\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
 udp_payload="\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x02\x08\x00\x45\x00\x01\x48\x04\x46\x00\x00\x80\x11\xb4\x03\xc0\xa8\x00\x01\xc0\xa8\x00\x0a\x00\x43\x00\x44\x01\x34\xdf\xdb\x02\x01\x06\x00\x00\x00\x3d\x1e\x00\x00\x00\x00\x00\x00\x00\x00\xc0\xa8\x00\x0a\x00\x00\x00\x00\x00\x00\x00\x00\x00\x0b\x82\x01\xfc\x42\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x63\x82\x53\x63\x35\x01\x05\x3a\x04\x00\x00\x07\x08\x3b\x04\x00\x00\x0c\x4e\x33\x04\x00\x00\x0e\x10\x36\x04\xc0\xa8\x00\x01\x01\x04\xff\xff\xff\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
@@ -157,3 +158,157 @@ def test_processor_unpacking():
     assert not vlan.vlan in pkt
     assert res == udp_payload
 
+
+def test_fast_path_parsing():
+    from pyretic.core.packet import parse_headers
+    from pyretic.core.network import IP, MAC
+    pro = Processor().compile()
+
+    def ryu_unpack(raw):
+        headers = {}
+        for (h, v) in pro.unpack(raw).items():
+            if v is None:
+                continue
+            if h in ['srcmac', 'dstmac']:
+                v = MAC(v)
+            elif h in ['srcip', 'dstip']:
+                v = IP(v)
+            headers[h] = v
+        return headers
+
+    for payload in [udp_payload, arp_payload, vlan_payload]:
+        assert parse_headers(payload) == ryu_unpack(payload)
+        assert pro.unpack_pyretic(payload) == ryu_unpack(payload)
+        # headers truncated anywhere, decoded by either parser
+        for n in range(1, 60):
+            assert pro.unpack_pyretic(payload[:n]) == ryu_unpack(payload[:n])
+
+    # other packets are left to ryu
+    loop_payload = udp_payload[:12] + "\x90\x00" + udp_payload[14:]
+    assert parse_headers(loop_payload) is None
+    assert pro.unpack_pyretic(loop_payload) == ryu_unpack(loop_payload)
+    assert parse_headers(udp_payload[:10]) is None
+
+def test_dirty_headers_repack():
+    from pyretic.core.packet import checksum, UDP_PROTO
+    from pyretic.core.network import IP, MAC
+    pro = Processor().compile()
+
+    def decode(raw):
+        headers = pro.unpack_pyretic(raw)
+        headers.update({'raw': raw, 'switch': 1, 'port': 1})
+        return Packet.from_raw(headers)
+
+    def repack(pkt):
+        return pro.repack(dict(pkt.header), pkt.dirty_headers())
+
+    def pack(pkt):
+        return pro.pack(dict(pkt.header))
+
+    def udp_checksums(raw):
+        """ The checksums of the IPv4 header and UDP datagram of raw, which
+        are zero for valid checksums. """
+        seg = raw[34:34 + struct.unpack('!H', raw[38:40])[0]]
+        pseudo = raw[26:34] + struct.pack('!BBH', 0, UDP_PROTO, len(seg))
+        return (checksum(raw[14:34]), checksum(pseudo + seg))
+
+    # forwarding leaves the raw packet untouched
+    pkt = decode(udp_payload)
+    fwd = pkt.modify(port=2, outport=3)
+    assert fwd.dirty_headers() == set()
+    assert repack(fwd) is udp_payload
+    assert pkt.modify(dstip=IP('192.168.0.12')).modify(
+        dstip=IP('192.168.0.10')).dirty_headers() == set()
+    # packets not decoded from raw packets are packed with ryu
+    assert Packet(dict(pkt.header)).dirty_headers() is None
+
+    # rewritten headers are written in place, with fixed up checksums (ryu
+    # keeps the stale UDP checksum)
+    rw = pkt.modify(dstip=IP('192.168.0.12'), dstport=8080,
+                    dstmac=MAC('00:00:00:00:00:09'), tos=4)
+    assert rw.dirty_headers() == set(['dstip', 'dstport', 'dstmac', 'tos'])
+    raw = repack(rw)
+    assert raw[:40] + raw[42:] == pack(rw)[:40] + pack(rw)[42:]
+    assert udp_checksums(udp_payload) == (0, 0)
+    assert udp_checksums(raw) == (0, 0)
+    assert decode(raw).modify(raw=udp_payload) == rw
+
+    # VLAN tags are added, rewritten and removed as with ryu
+    for (payload, mods) in [(udp_payload, {'vlan_id': 3, 'vlan_pcp': 2}),
+                            (vlan_payload, {'vlan_id': 7}),
+                            (vlan_payload, {'vlan_pcp': 5}),
+                            (vlan_payload, {'vlan_id': None,
+                                            'vlan_pcp': None})]:
+        vpkt = decode(payload).modifymany(mods)
+        assert repack(vpkt) == pack(vpkt)
+    # removing the VLAN id alone removes the whole tag (ryu rewrites the
+    # ethertype, but leaves the tag's bytes in the packet)
+    untagged = pack(decode(vlan_payload).modifymany({'vlan_id': None,
+                                                     'vlan_pcp': None}))
+    vpkt = decode(vlan_payload).modify(vlan_id=None)
+    assert repack(vpkt) == untagged
+    assert decode(repack(vpkt)).header.get('vlan_id') is None
+    assert decode(pack(vpkt)).header.get('vlan_id') is None
+
+    # changes to the raw packet itself fall back to ryu
+    new_raw = pkt.modify(raw=udp_payload_srcmac)
+    assert new_raw.dirty_headers() == set(['raw'])
+    assert repack(new_raw) == pack(new_raw)
+
+def test_address_values():
+    import pickle
+    from ipaddr import IPv4Network
+    from pyretic.core.network import IPAddr, IP, EthAddr, MAC, IPPrefix
+
+    # addresses are interned, whatever their encoding
+    ip = IP('192.168.0.1')
+    assert IP('\xc0\xa8\x00\x01') is ip
+    assert IP(ip) is ip and IP(int(ip)) is ip
+    assert IPAddr('192.168.0.1') == ip and hash(IPAddr(ip)) == hash(ip)
+    mac = MAC('00:16:CE:6E:8B:24')
+    assert MAC('\x00\x16\xce\x6e\x8b\x24') is mac
+    assert repr(mac) == '00:16:ce:6e:8b:24' and repr(ip) == '192.168.0.1'
+    assert ip != mac and mac != ip and ip != '192.168.0.1'
+    assert ip.to_bytes() == '\xc0\xa8\x00\x01'
+    assert mac.to01() == bin(int(mac))[2:].zfill(48)
+
+    # and immutable, also across pickling
+    with pytest.raises(AttributeError):
+        ip.value = 0
+    for proto in [0, 2]:
+        assert pickle.loads(pickle.dumps(ip, proto)) is ip
+        assert pickle.loads(pickle.dumps(mac, proto)) is mac
+
+    # prefix containment
+    assert ip.in_network(IPv4Network('192.168.0.0/16'))
+    assert not ip.in_network(IPv4Network('192.168.1.0/24'))
+    assert IPPrefix('192.168.0.0/24') == ip
+    assert IPPrefix('192.168.1.0/24') != ip
+
+def test_header_map_updates():
+    from pyretic.core.util import frozendict
+    fd = frozendict({'srcip': '10.0.0.1', 'port': 1, 'switch': 2})
+    h = hash(fd)
+    # derived maps carry their hash over, and agree with maps built afresh
+    for (new, ks) in [({'port': 3}, ()), ({'outport': 4}, ()),
+                      ({}, ['switch']), ({'port': 3}, ['port', 'srcip']),
+                      ({'port': 1}, ['missing']), ({}, ()),
+                      ({}, ['port', 'port']),
+                      ({'port': 3}, ['port', 'switch', 'port'])]:
+        derived = fd.update_remove(new, ks)
+        d = dict(fd.items())
+        d.update(new)
+        for k in ks:
+            d.pop(k, None)
+        assert derived == frozendict(d)
+        assert hash(derived) == hash(frozendict(d))
+    assert hash(fd) == h and fd == frozendict(srcip='10.0.0.1', port=1,
+                                              switch=2)
+    assert fd.pop('port', 'switch') == [1, 2, frozendict(srcip='10.0.0.1')]
+    assert frozendict({'a': 1}).remove(['a', 'a']) == frozendict()
+
+    # packets share their header map with the packets they are derived from
+    pkt = Packet(fd)
+    assert pkt.header is fd
+    assert pkt.modify(port=None, outport=4).header == fd.update_remove(
+        {'outport': 4}, ['port'])
@@ -30,11 +30,13 @@ from pyretic.core.language import *
 from pyretic.lib.corelib import *
 from pyretic.lib.std import *
 from pyretic.lib.path import *
-from pyretic.lib.path import __in_re_tree_gen__, __out_re_tree_gen__
+from pyretic.lib.path import (__in_re_tree_gen__, __out_re_tree_gen__, __in__,
+                              leaf_pred_index, __fdd_in_re_tree_gen__)
 
 import copy
 import pytest
 import sys
+import re
 
 ip1 = IPAddr('10.0.0.1')
 ip2 = IPAddr('10.0.0.2')
@@ -809,6 +811,454 @@ def test_hook_compilation_2():
 
 
 
+def test_dfa_minimization():
+    icg = __in_re_tree_gen__()
+    ocg = __out_re_tree_gen__()
+    icg.symbol_to_pred = {1: match(switch=1), 2: match(switch=2)}
+    ragel_dfa_utils.init(icg, ocg, False)
+    def mkdfa(ords3, ords4):
+        edges = [(None, 1, 1), (None, 2, 2), (1, 2, 3), (2, 2, 4)]
+        ordinals = {(None, 1, 1): [], (None, 2, 2): [],
+                    (1, 2, 3): ords3, (2, 2, 4): ords4}
+        return ragel_dfa(5, [3, 4], None, edges, ordinals)
+    # States 1 and 2 are equivalent, and so are 3 and 4.
+    (d, sizes) = ragel_dfa_utils.minimize(mkdfa([0], [0]))
+    assert sizes == (6, 4, 4, 3)
+    assert d.state_num == 3
+    assert d.final_states == [2]
+    assert sorted(d.edges) == [(None, 1, 1), (None, 2, 1), (1, 2, 2)]
+    assert d.edge_ordinals[(1, 2, 2)] == [0]
+    # Different accepting ordinals keep the states apart.
+    (d, sizes) = ragel_dfa_utils.minimize(mkdfa([0], [1]))
+    assert sizes == (6, 4, 6, 4)
+    assert d.state_num == 5
+
+def test_pred_index():
+    m1 = match(switch=1, port=2)
+    m2 = match(switch=1) & match(srcip=ip1)
+    m3 = match(switch=1, port=3) | match(switch=1, port=4)
+    m4 = ~match(switch=1)
+    key = cu.get_index_key
+    assert key(m1) == (1, 2)
+    assert key(m2) == (1, None)
+    assert key(m3) == (1, None)
+    assert key(m4) == (None, None)
+    index = leaf_pred_index()
+    for m in [m1, m2, m3, m4]:
+        index.add(m)
+    assert set(index.candidates(match(switch=1, port=2))) == set([m1, m2, m3,
+                                                                  m4])
+    assert set(index.candidates(match(switch=1, port=5))) == set([m2, m3, m4])
+    assert set(index.candidates(match(switch=2))) == set([m4])
+    assert set(index.candidates(match(port=3))) == set([m2, m3, m4])
+    index.remove(m2)
+    index.remove(m3)
+    assert set(index.candidates(match(switch=1, port=2))) == set([m1, m4])
+    assert not None in index.root[1]
+
+def test_indexed_partitioning():
+    preds = [match(switch=1, port=1), match(switch=1, port=2),
+             match(switch=2, port=1), match(switch=1),
+             match(srcip=ip1), match(switch=1, port=1, srcip=ip1)]
+    def partition(enabled):
+        re_tree_gen.pred_index_enabled = enabled
+        cu.__set_init_vars__(False)
+        cg = __in_re_tree_gen__()
+        cg.clear()
+        for p in preds:
+            __in__(p).gen_re_tree(cg)
+        return cg.get_predlist()
+    try:
+        indexed = partition(True)
+        plain = partition(False)
+    finally:
+        re_tree_gen.pred_index_enabled = True
+    assert len(indexed) == len(plain)
+    # leaf predicates are disjoint, and cover all the atom predicates
+    for (i, p1) in enumerate(indexed):
+        for p2 in indexed[i+1:]:
+            assert not ne_inters(p1, p2)
+    for p in preds:
+        assert not cu.is_not_drop(p & ~reduce(lambda a, x: a | x, indexed))
+
+def test_fdd_hash_consing():
+    ft = FDDTranslator
+    d1 = ft.translate(match(switch=1, port=2), 0)
+    d2 = ft.translate(match(port=2, switch=1), 0)
+    assert d1 is d2
+    assert d1.test == ('switch', 1)
+    assert d1.lchild.test == ('port', 2)
+    d3 = ft.translate(match(switch=1) & match(port=2), 0)
+    assert d3 is d1
+    d4 = ft.translate(match(switch=2) | ~match(switch=3), 1)
+    hits = ft.cache_hits
+    assert ft.merge(d1, d4, True) is ft.merge(d4, d1, True)
+    assert ft.cache_hits > hits
+    assert ft.get_num_nodes() > 0
+    assert 0 < ft.get_cache_hit_rate() <= 1
+
+def test_fdd_partitioning():
+    preds = [match(switch=1, port=1), match(switch=1, port=2),
+             match(switch=2, port=1), match(switch=1),
+             match(srcip=ip1), match(switch=1, port=1, srcip=ip1),
+             ~match(switch=1) & match(port=2),
+             match(switch=2) | match(port=3)]
+    cg = __fdd_in_re_tree_gen__()
+    for p in preds:
+        __in__(p).add_to_fdd(cg)
+    cg.prep_re_tree()
+    leaf_preds = cg.symbol_to_pred.values()
+    # leaf predicates are disjoint, and each atom predicate is exactly the
+    # union of the leaf predicates of its symbols
+    for (i, p1) in enumerate(leaf_preds):
+        for p2 in leaf_preds[i+1:]:
+            assert not ne_inters(p1, p2)
+    for p in preds:
+        u = reduce(lambda a, x: a | x,
+                   [cg.symbol_to_pred[s] for s in cg.pred_to_symbols[p]])
+        assert not cu.is_not_drop(p & ~u)
+        assert not cu.is_not_drop(u & ~p)
+
+def test_parallel_stage_compilation():
+    def stages():
+        res = []
+        for i in range(1, 4):
+            q1 = atom(match(switch=i)) ^ out_atom(match(switch=i+1))
+            q2 = (atom(match(switch=i) & DynamicFilter(match(port=1))) ^
+                  atom(match(srcip=ip1)))
+            res.append((i-1, [q1, q2]))
+        return res
+    kwargs = {'max_states': NUM_PATH_TAGS, 'disjoint_enabled': False,
+              'default_enabled': False, 'integrate_enabled': True,
+              'ragel_enabled': True, 'match_enabled': False}
+    def compile_stages(workers):
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS, stage_workers=workers)
+        stage_list = stages()
+        if workers > 1:
+            # not through compile_stages, which would fall back to serial
+            # compilation if the stages couldn't be transferred
+            res = pathcomp.compile_stages_parallel(stage_list, kwargs, workers)
+        else:
+            res = pathcomp.compile_stages(stage_list, kwargs)
+        cgs = [[(len(cg.symbol_to_pred), len(cg.dyn_preds))
+                for cg in pathcomp.stage_cgs[i]] for (i, _) in stage_list]
+        return (stage_list, res, copy.copy(virtual_field.stage_offset_nbits),
+                cgs)
+    try:
+        (_, serial, serial_bits, serial_cgs) = compile_stages(1)
+        (stage_list, parallel, parallel_bits,
+         parallel_cgs) = compile_stages(3)
+    finally:
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS)
+    assert pathcomp.stage_workers == 1
+    assert parallel_bits == serial_bits
+    # character generators of the workers are merged back
+    assert parallel_cgs == serial_cgs
+    for (i, _) in stage_list:
+        for (cg, cg_list) in zip(pathcomp.stage_cgs[i],
+                                 [re_tree_gen.in_cg_list,
+                                  re_tree_gen.out_cg_list]):
+            assert cg in cg_list
+    assert len(parallel) == len(serial) == 3
+    for ((tables1, _), (tables2, _)) in zip(serial, parallel):
+        assert len(tables1) == len(tables2)
+        for (t1, t2) in zip(tables1, tables2):
+            assert len(t1.compile().rules) == len(t2.compile().rules)
+    # piped policies of the queries come back as the very same objects
+    piped = set([id(q.piped_policy) for (_, qs) in stage_list for q in qs])
+    for (_, acc) in parallel:
+        for pols in acc.values():
+            assert set([id(p) for p in pols]) <= piped
+
+def test_runtime_stage_workers():
+    from pyretic.core.runtime import Runtime
+    def path_main(**kwargs):
+        return atom(match(switch=1)) ^ atom(match(switch=2))
+    try:
+        virtual_field.clear()
+        Runtime(None, lambda **kwargs: identity, path_main, {},
+                mode='proactive0', use_pyretic=True, offline=True,
+                stage_workers=2, write_log='/tmp/test_path_rt.log')
+        assert pathcomp.stage_workers == 2
+        assert not pathcomp.cost_pack_enabled
+        assert pathcomp.stage_rule_limit == STAGE_RULE_LIMIT
+        virtual_field.clear()
+        Runtime(None, lambda **kwargs: identity, path_main, {},
+                mode='proactive0', use_pyretic=True, offline=True,
+                cost_pack_enabled=True, stage_rule_limit=100,
+                write_log='/tmp/test_path_rt.log')
+        assert pathcomp.cost_pack_enabled
+        assert pathcomp.stage_rule_limit == 100
+    finally:
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS)
+
+def test_parallel_stage_compilation_error():
+    """ Errors compiling a stage in a worker are raised, rather than falling
+    back to compiling the stages serially. """
+    stage_list = [(i, [atom(match(switch=i)) ^ atom(match(switch=i+1))])
+                  for i in range(2)]
+    kwargs = {'max_states': NUM_PATH_TAGS}
+    calls = []
+    def compile_stage(path_pol, in_cg, out_cg, **kwargs):
+        calls.append(kwargs['stage'])
+        raise ValueError("stage %d" % kwargs['stage'])
+    old_compile_stage = pathcomp.__dict__['compile_stage']
+    pathcomp.compile_stage = staticmethod(compile_stage)
+    try:
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS, stage_workers=2)
+        with pytest.raises(ValueError):
+            pathcomp.compile_stages(stage_list, kwargs)
+    finally:
+        pathcomp.compile_stage = old_compile_stage
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS)
+    # the stages were only compiled in the workers
+    assert calls == []
+
+def test_lazy_groupby_expansion():
+    fvlist = {'switch': range(1,4), 'port': range(1,5)}
+    gt = path_grouping
+    g1 = in_out_group(match(switch=2), identity, ['switch'], ['port'])
+    g2 = in_out_group(match(port=3), match(port=1), ['switch'],
+                      ['switch','port'])
+    p = g1 ^ (in_atom(match(srcip=ip1)) ** g2) ^ g1
+    expanded = gt.expand_groupby(p, fvlist)
+    assert isinstance(expanded, path_policy_union)
+    assert len(expanded.path_policies) == len(
+        gt.gatom_to_ioatom_combos([g1, g2], fvlist))
+    # the generator yields the same queries, one at a time
+    it = gt.iter_expand_groupby(p, fvlist)
+    first = next(it)
+    assert first.groupby_origin is p
+    assert (len(list(it)) + 1) == len(expanded.path_policies)
+    with pytest.raises(RuntimeError):
+        gt.expand_groupby(p, fvlist, max_queries=10)
+    with pytest.raises(RuntimeError):
+        list(gt.iter_expand_groupby(p, fvlist, max_queries=10))
+    # packing consumes the expansion as a stream, and stages hold slices of
+    # the expansion rather than the specialized queries
+    assgn = pack_queries_stagelimited(gt.iter_expand_groupby(p, fvlist), 2)
+    packed = reduce(lambda acc, x: acc + x, assgn.values(), [])
+    assert all([isinstance(s, groupby_slice) for s in packed])
+    assert all([s.groupby_origin is p for s in packed])
+    assert sum(map(len, packed)) == len(expanded.path_policies)
+    assert len(packed) < len(expanded.path_policies)
+    # the slices specialize into the same queries, with the same buckets
+    queries = reduce(lambda acc, qs: acc + list(iter_stage_queries(qs)),
+                     assgn.values(), [])
+    buckets = reduce(lambda acc, s: acc + s.buckets, packed, [])
+    assert sorted(map(id, [q.get_bucket() for q in queries])) == sorted(
+        map(id, buckets))
+    def atom_preds(q):
+        return path_policy_utils.path_ast_fold(q.path, lambda acc, x: (
+            acc + [(repr(x.in_pred), repr(x.out_pred))]
+            if isinstance(x, in_out_atom) else acc), [])
+    assert sorted(map(atom_preds, queries)) == sorted(
+        map(atom_preds, expanded.path_policies))
+    again = reduce(lambda acc, qs: acc + list(iter_stage_queries(qs)),
+                   assgn.values(), [])
+    assert [q.get_bucket() for q in again] == [q.get_bucket()
+                                               for q in queries]
+
+def test_runtime_lazy_groupby():
+    from pyretic.core.runtime import Runtime
+    g = in_out_group(identity, identity, ['switch'], ['port'])
+    def path_main(**kwargs):
+        return g ^ atom(match(switch=2))
+    def runtime(max_queries):
+        rt = Runtime(None, lambda **kwargs: identity, path_main, {},
+                     mode='proactive0', use_pyretic=True, offline=True,
+                     max_queries=max_queries,
+                     write_log='/tmp/test_path_rt.log')
+        rt.network.topology.add_node(1, ports={1: None, 2: None})
+        rt.network.topology.add_node(2, ports={1: None, 2: None})
+        return rt
+    try:
+        virtual_field.clear()
+        rt = runtime(None)
+        rt.recompile_paths()
+        # the downstream queries are compiled straight from the expansion
+        stages = reduce(lambda acc, qs: acc + qs, pathcomp.ds_stages.values(),
+                        [])
+        assert all([isinstance(s, groupby_slice) for s in stages])
+        assert sum(map(len, stages)) == 4
+        virtual_field.clear()
+        rt = runtime(3)
+        with pytest.raises(RuntimeError):
+            rt.recompile_paths()
+    finally:
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS)
+        pathcomp.ds_stages = None
+
+def test_cost_packing():
+    q = atom(match(switch=1)) ^ out_atom(match(switch=2, srcip=ip1))
+    c = stage_cost.of_query(q)
+    assert c.states == 3
+    assert c.sw_trans == {1: 1, 2: 1} and c.any_trans == 0
+    assert stage_cost.of_query(atom(identity) ^ atom(match(srcip=ip1))
+                               ).any_trans == 2
+    qs = []
+    for i in range(1, 11):
+        qs.append(atom(match(switch=i)) ^ out_atom(match(switch=i+1)))
+        qs.append(atom(match(switch=i, srcip=ip1)) ^
+                  atom(match(switch=i, dstip=ip2)))
+    qs.append(path_empty())
+    # everything fits into one stage under the default budget
+    assgn = pack_queries_cost(qs, MAX_STAGES)
+    assert assgn.keys() == [0] and len(assgn[0]) == len(qs)
+    # a tight budget is spread over stages, each within the budget
+    assgn = pack_queries_cost(qs, MAX_STAGES, rule_limit=20)
+    assert len(assgn) > 1
+    packed = reduce(lambda acc, x: acc + x, assgn.values(), [])
+    assert sorted(map(id, packed)) == sorted(map(id, qs))
+    assert any([isinstance(x, path_empty) for x in assgn[0]])
+    bits = 0
+    for stage_qs in assgn.values():
+        costs = [stage_cost.of_query(x) for x in stage_qs
+                 if not isinstance(x, path_empty)]
+        cost = reduce(lambda acc, x: acc.join(x), costs)
+        assert cost.rules() <= 20
+        bits += cost.tag_bits()
+    assert bits <= MAX_TAG_BITS
+    # at most numstages stages, even if they exceed the budget
+    assert len(pack_queries_cost(qs, 2, rule_limit=20)) == 2
+
+def test_incremental_query_update():
+    q1 = atom(match(switch=1)) ^ out_atom(match(switch=2))
+    q2 = atom(match(switch=2)) ^ atom(match(srcip=ip1))
+    q3 = atom(match(switch=3)) ^ atom(match(switch=4)) ^ atom(match(switch=5))
+    q4 = atom(match(switch=3)) ^ atom(match(switch=4))
+    def stage_queries():
+        return dict([(i, set(map(id, qs)))
+                     for (i, qs) in pathcomp.ds_stages.items()])
+    def tag_offsets(parts):
+        return set([int(o) for o in re.findall(r"'vlan_offset', (\d+)",
+                                               repr(parts))])
+    virtual_field.clear()
+    pathcomp.init(NUM_PATH_TAGS, stage_workers=1, cost_pack_enabled=True,
+                  stage_rule_limit=6)
+    try:
+        dyn = dynamic_path_policy(q1 + q2 + q4)
+        pathcomp.compile_downstream(path_grouping.expand_groupby(dyn),
+                                    integrate_enabled=True,
+                                    ragel_enabled=True,
+                                    preddecomp_enabled=True)
+        assert stage_queries() == {0: set([id(q2)]),
+                                   1: set([id(q1), id(q4)])}
+        assert pathcomp.update_downstream(dyn) == {}
+        # q3 does not fit into the existing stages; stage 0 is untouched
+        dyn._path_policy = q2 + q3 + q4
+        changes = pathcomp.update_downstream(dyn)
+        assert sorted(changes.keys()) == [1, 2]
+        assert stage_queries() == {0: set([id(q2)]), 1: set([id(q4)]),
+                                   2: set([id(q3)])}
+        assert len(virtual_field.stages[1]) == 1
+        for i in [1, 2]:
+            (offset, _) = virtual_field.stage_offset_nbits[i]
+            assert tag_offsets(changes[i]) == set([offset])
+        # emptying stage 0 moves the tag bits of the other stages
+        dyn._path_policy = q3 + q4
+        changes = pathcomp.update_downstream(dyn)
+        assert changes[0] is None
+        assert sorted(changes.keys()) == [0, 1, 2]
+        assert virtual_field.stage_offset_nbits[1][0] == 0
+        assert tag_offsets(changes[1]) == set([0])
+        # with no downstream queries left, compile afresh
+        dyn._path_policy = path_empty()
+        assert pathcomp.update_downstream(dyn) is None
+    finally:
+        virtual_field.clear()
+        pathcomp.init(NUM_PATH_TAGS)
+        pathcomp.ds_stages = None
+
+def test_query_switch_dispatch():
+    def eval_by_scan(qs, pkt):
+        for tag_value in qs.policy_dic:
+            if match(**{qs.tag: tag_value}).eval(pkt):
+                return qs.policy_dic[tag_value].eval(pkt)
+        return set()
+    def tag(pkt, **fields):
+        vlan = 0
+        for (f, v) in fields.items():
+            vlan |= virtual_field.compress({f: v})[0]
+        return pkt.modify(vlan_id=vlan & 0xfff, vlan_pcp=vlan >> 12)
+    virtual_field.clear()
+    try:
+        virtual_field('path_tag_0', range(5), type="integer", stage=0)
+        virtual_field('path_tag_1', range(3), type="integer", stage=1)
+        dic = dict([(v, modify(port=v+10)) for v in range(3)])
+        dic[None] = modify(port=20)
+        qs = QuerySwitch('path_tag_1', dic, set([drop]))
+        base = Packet({'switch': 1, 'port': 1})
+        tagged = [tag(base, path_tag_0=v0, path_tag_1=v1)
+                  for v0 in range(5) + [None] for v1 in range(3) + [None]]
+        for pkt in tagged + [base]:
+            assert qs.eval(pkt) == eval_by_scan(qs, pkt)
+        assert qs.get_dispatch()[0] == 'vlan'
+        # rules are specialized once, while the tag policies are unchanged
+        c1 = qs.compile()
+        c2 = qs.compile()
+        assert [r.match for r in c1.rules] == [r.match for r in c2.rules]
+        assert all([r1.match is r2.match
+                    for (r1, r2) in zip(c1.rules, c2.rules)])
+        # moving the bits of the tag invalidates decoding and compilation
+        virtual_field.remove('path_tag_0')
+        moved = [tag(base, path_tag_1=v1)
+                 for v1 in range(3) + [None]]
+        for pkt in moved:
+            assert qs.eval(pkt) == eval_by_scan(qs, pkt)
+        c3 = qs.compile()
+        fresh = QuerySwitch('path_tag_1', dic, set([drop])).compile()
+        assert [r.match for r in c3.rules] == [r.match for r in fresh.rules]
+        assert [r.match for r in c3.rules] != [r.match for r in c1.rules]
+        # exact dispatch on a plain header
+        qs = QuerySwitch('switch', dict([(i, modify(port=i)) for i in range(4)]),
+                         set([drop]))
+        assert qs.get_dispatch()[0] == 'field'
+        for i in range(6):
+            pkt = base.modify(switch=i)
+            assert qs.eval(pkt) == eval_by_scan(qs, pkt)
+    finally:
+        virtual_field.clear()
+
+def test_upstream_stage_reuse():
+    kwargs = {'max_states': NUM_PATH_TAGS, 'integrate_enabled': True,
+              'ragel_enabled': True}
+    edge = ingress_network()
+    edge.policy = match(switch=1, port=1)
+    q = atom(edge & match(switch=1)) ^ atom(match(switch=2))
+    vvfield = 'path_tag_%d' % VIRT_STAGE
+    pathcomp.init(NUM_PATH_TAGS, stage_workers=1)
+    try:
+        res = pathcomp.get_upstream_stage(q, **kwargs)
+        cgs = pathcomp.us_stage[3]
+        assert [d.pred for cg in cgs for d in cg.dyn_preds] == [edge]
+        # unchanged queries and dynamic predicates: the stage is reused
+        assert pathcomp.get_upstream_stage(q, **kwargs) is res
+        # a dynamic predicate changes its policy, e.g., on a topology change
+        edge.policy = match(switch=1, port=2)
+        res2 = pathcomp.get_upstream_stage(q, **kwargs)
+        assert not res2 is res
+        assert pathcomp.get_upstream_stage(q, **kwargs) is res2
+        # new queries
+        q2 = atom(match(switch=3)) ^ atom(match(switch=2))
+        assert not pathcomp.get_upstream_stage(q2, **kwargs) is res2
+        # the tag field of the stage is defined afresh on recompilation
+        assert len(virtual_virtual_field.stages[VIRT_STAGE]) == 1
+        assert (virtual_virtual_field.fields[vvfield] in
+                virtual_virtual_field.stages[VIRT_STAGE])
+        for cg in cgs:
+            assert not cg in (cg.in_cg_list + cg.out_cg_list)
+    finally:
+        pathcomp.us_stage = None
+        virtual_virtual_field.remove(vvfield)
+        pathcomp.init(NUM_PATH_TAGS)
+
 # Just in case: keep these here to run unit tests in vanilla python
 if __name__ == "__main__":
 
@@ -846,6 +1296,21 @@ if __name__ == "__main__":
 
     test_ast_fold()
 
+    test_dfa_minimization()
+    test_pred_index()
+    test_indexed_partitioning()
+    test_fdd_hash_consing()
+    test_fdd_partitioning()
+    test_parallel_stage_compilation()
+    test_runtime_stage_workers()
+    test_parallel_stage_compilation_error()
+    test_lazy_groupby_expansion()
+    test_runtime_lazy_groupby()
+    test_cost_packing()
+    test_incremental_query_update()
+    test_query_switch_dispatch()
+    test_upstream_stage_reuse()
+
     print "If this message is printed without errors before it, we're good."
     print "Also ensure all unit tests are listed above this line in the source."
     sys.exit(0)
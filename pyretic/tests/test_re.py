@@ -544,6 +544,33 @@ def test_dot_vector():
         f.close()
         # output = subprocess.check_output(['dot', '-Tx11', fname])
 
+def test_hash_consing():
+    a = re_symbol('a', metadata='m1')
+    b = re_symbol('b')
+    r1 = (a | b) ^ +b
+    r2 = (re_symbol('b') | re_symbol('a', metadata='m2')) ^ +re_symbol('b')
+
+    # Structurally equal expressions share one node, regardless of metadata
+    assert r1 == r2
+    assert r1.node is r2.node
+    assert hash(r1) == hash(r2)
+    assert r1 != (a | b) ^ b
+
+    # Derivatives and nullability are cached on the shared node
+    d = deriv(r1, re_symbol('a'))
+    assert r2.node.derivs['a'] is d
+    assert deriv(r1, re_symbol('a')) is d
+    assert deriv(r2, re_symbol('a')) is d
+    assert d == +b
+    assert d.node is (+b).node
+    assert deriv(d, re_symbol('b')) is deriv(+re_symbol('b'), re_symbol('b'))
+    assert is_nullable(r1) is False
+    assert r1.node.nullable is False
+    assert is_nullable(r2) is False
+    assert is_nullable(d) is True
+    assert d.node.nullable is True
+    assert is_nullable(+re_symbol('b')) is True
+
 # Just in case: keep these here to run unit tests in vanilla python
 if __name__ == "__main__":
     test_normal_forms()
@@ -558,6 +585,7 @@ if __name__ == "__main__":
     test_dfa_metadata()
     test_dfa_vector()
     test_dot_vector()
+    test_hash_consing()
 
     print "If this message is printed without errors before it, we're good."
     print "Also ensure all unit tests are listed above this line in the source."
@@ -0,0 +1,354 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Srinivas Narayana (narayana@cs.princeton.edu)                        #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+""" Tests for pulling counting bucket stats from switches. """
+from pyretic.core.language import *
+import threading
+from pyretic.core.runtime import (Runtime, COOKIE_TABLE_MASK,
+                                  COOKIE_VERSION_MASK, STATS_ALL_TABLES,
+                                  stats_poller)
+from pyretic.lib.query import counts
+
+class stats_backend(object):
+    """ Records the flow stats requests of the runtime. """
+    def __init__(self):
+        self.requests = []
+
+    def send_flow_stats_request(self, switch, table_id, cookie, cookie_mask,
+                                pred):
+        self.requests.append((switch, table_id, cookie, cookie_mask, pred))
+
+def get_runtime(switches, use_nx=False):
+    rt = Runtime(stats_backend(), lambda: identity, None, {},
+                 mode='proactive0', use_nx=use_nx,
+                 write_log='/tmp/test_stats.log')
+    rt.network.switch_list = lambda: list(switches)
+    return rt
+
+def flow_stat(priority, cookie, packets):
+    """ A flow stat as received by the runtime from the OpenFlow client. """
+    return {'match': repr({'port': 1}), 'priority': priority,
+            'cookie': cookie, 'packet_count': packets,
+            'byte_count': 100 * packets, 'table_id': 0}
+
+def add_rule(rt, bucket, switch, priority, cookie, match={'port': 1}):
+    bucket.start_update()
+    bucket.add_match(dict(match, switch=switch), priority, cookie)
+    rt.stats_poller.add_rule(switch, cookie, priority, bucket)
+    bucket.finish_update()
+    bucket.add_pull_stats(rt.pull_stats_for_bucket(bucket))
+
+def test_scoped_stats_requests():
+    rt = get_runtime([1, 2, 3])
+    c1 = rt.get_cookie(5, 0)
+    c2 = rt.get_cookie(6, 0)
+    full_mask = COOKIE_TABLE_MASK | COOKIE_VERSION_MASK
+    b = CountBucket()
+    counts = []
+    b.register_callback(counts.append)
+    add_rule(rt, b, 1, 10, c1)
+    add_rule(rt, b, 2, 10, c1)
+    add_rule(rt, b, 2, 20, c2)
+    b.pull_stats()
+    assert sorted(rt.backend.requests) == [
+        (1, STATS_ALL_TABLES, c1, full_mask, {'port': 1}),
+        (2, STATS_ALL_TABLES, rt.get_cookie(0, 0), COOKIE_TABLE_MASK,
+         {'port': 1})]
+    ''' Replies drop the flows of other cookies, even if the OpenFlow client
+    reports them. '''
+    rt.handle_flow_stats_reply(1, [flow_stat(10, c1, 3),
+                                   flow_stat(10, c2, 50)],
+                               [STATS_ALL_TABLES, c1, full_mask,
+                                {'port': 1}])
+    assert counts == []
+    rt.handle_flow_stats_reply(2, [flow_stat(10, c1, 4),
+                                   flow_stat(20, c2, 5),
+                                   flow_stat(20, rt.get_cookie(6, 1),
+                                             50)],
+                               [STATS_ALL_TABLES, rt.get_cookie(0, 0),
+                                COOKIE_TABLE_MASK, {'port': 1}])
+    assert counts == [[12, 1200]]
+
+def test_stats_scope():
+    rt = get_runtime([1])
+    assert rt.get_stats_scope([rt.get_cookie(1, 0), rt.get_cookie(1, 2)]) == (
+        STATS_ALL_TABLES, 0, 0)
+    nx_rt = get_runtime([1], use_nx=True)
+    assert nx_rt.get_stats_scope([nx_rt.get_cookie(3, 2)]) == (
+        2, nx_rt.get_cookie(3, 2), COOKIE_TABLE_MASK | COOKIE_VERSION_MASK)
+    assert nx_rt.get_stats_scope([nx_rt.get_cookie(3, 2),
+                                  nx_rt.get_cookie(4, 2)]) == (
+        2, nx_rt.get_cookie(0, 2), COOKIE_TABLE_MASK)
+
+def test_shared_stats_poller():
+    rt = get_runtime([1, 2])
+    rt.stats_poller.interval = 60
+    c = rt.get_cookie(1, 0)
+    scope = [STATS_ALL_TABLES, c, COOKIE_TABLE_MASK | COOKIE_VERSION_MASK,
+             {'port': 1}]
+    counts = {}
+    buckets = []
+    for i in range(3):
+        b = CountBucket()
+        b.register_callback(lambda x, i=i: counts.setdefault(i, []).append(x))
+        add_rule(rt, b, 1, 10 + i, c)
+        buckets.append(b)
+    add_rule(rt, buckets[0], 2, 10, c)
+    ''' One request per switch, however many buckets pull. '''
+    for b in buckets:
+        b.pull_stats()
+    assert sorted(rt.backend.requests) == [(1,) + tuple(scope),
+                                           (2,) + tuple(scope)]
+    rt.handle_flow_stats_reply(1, [flow_stat(10 + i, c, i + 1)
+                                   for i in range(3)], scope)
+    assert counts == {1: [[2, 200]], 2: [[3, 300]]}
+    rt.handle_flow_stats_reply(2, [flow_stat(10, c, 4)], scope)
+    assert counts[0] == [[5, 500]]
+    ''' Pulls within the interval get the cached replies, outside of the
+    bucket's lock. '''
+    locked = []
+    def check_unlocked(x):
+        def try_lock(cv=buckets[1].in_update_cv):
+            if cv.acquire(False):
+                cv.release()
+                locked.append(False)
+            else:
+                locked.append(True)
+        t = threading.Thread(target=try_lock)
+        t.start()
+        t.join()
+    buckets[1].register_callback(check_unlocked)
+    buckets[1].pull_stats()
+    assert len(rt.backend.requests) == 2
+    assert counts[1] == [[2, 200], [2, 200]]
+    assert locked == [False]
+    ''' Changing the rules of a switch invalidates its cached reply. '''
+    add_rule(rt, buckets[1], 1, 20, c)
+    buckets[1].pull_stats()
+    assert rt.backend.requests[-1] == (1,) + tuple(scope)
+    assert rt.stats_poller.num_requests == 3
+
+def test_narrowed_stats_requests():
+    rt = get_runtime([1, 2])
+    c = rt.get_cookie(1, 0)
+    scope = [STATS_ALL_TABLES, c, COOKIE_TABLE_MASK | COOKIE_VERSION_MASK]
+    web = {'ethtype': 0x800, 'protocol': 6, 'dstport': 80}
+    (b1, b2) = (CountBucket(), CountBucket())
+    counts = {}
+    for b in (b1, b2):
+        b.register_callback(lambda x, b=b: counts.setdefault(b, []).append(x))
+    ''' Requests match on the header fields shared by the bucket's rules on
+    each switch. '''
+    add_rule(rt, b1, 1, 10, c, dict(web, port=1, srcip='10.0.0.0/24'))
+    add_rule(rt, b1, 1, 11, c, dict(web, port=2, srcip='10.0.0.0/24'))
+    add_rule(rt, b1, 2, 10, c, dict(web, port=1))
+    add_rule(rt, b2, 1, 12, c, {'port': 1, 'vlan_id': 3, 'vlan_pcp': 0,
+                                'vlan_total_stages': 1})
+    b1.pull_stats()
+    b2.pull_stats()
+    pred1 = dict(web, srcip='10.0.0.0/24')
+    pred2 = {'port': 1, 'vlan_id': 3, 'vlan_pcp': 0}
+    assert sorted(rt.backend.requests) == sorted(
+        [(1,) + tuple(scope) + (pred1,),
+         (2,) + tuple(scope) + (dict(web, port=1),),
+         (1,) + tuple(scope) + (pred2,)])
+    ''' Replies go to the buckets pulling with the predicate they carry, and
+    are cached for them only. '''
+    rt.handle_flow_stats_reply(1, [flow_stat(10, c, 1), flow_stat(11, c, 2)],
+                               scope + [pred1])
+    assert counts == {}
+    rt.handle_flow_stats_reply(2, [flow_stat(10, c, 4)],
+                               scope + [dict(web, port=1)])
+    assert counts == {b1: [[7, 700]]}
+    rt.handle_flow_stats_reply(1, [flow_stat(12, c, 5)], scope)
+    assert not b2 in counts
+    rt.handle_flow_stats_reply(1, [flow_stat(12, c, 5)], scope + [pred2])
+    assert counts[b2] == [[5, 500]]
+    rt.stats_poller.interval = 60
+    b1.pull_stats()
+    assert len(rt.backend.requests) == 3
+    assert counts[b1] == [[7, 700], [7, 700]]
+    ''' Rules on every switch narrow the requests to all of them, and rules
+    agreeing on nothing, or on multi-stage virtual fields, do not. '''
+    b3 = CountBucket()
+    b3.start_update()
+    b3.add_match({'ethtype': 0x800, 'port': 3}, 5, c)
+    b3.add_match({'switch': 2, 'ethtype': 0x800, 'port': 4}, 6, c)
+    b3.add_match({'switch': 2, 'vlan_id': 1, 'vlan_total_stages': 2}, 7, c)
+    b3.finish_update()
+    assert rt.get_stats_preds(b3.matches.keys(), [1, 2]) == {
+        1: util.frozendict({'ethtype': 0x800, 'port': 3}), 2: None}
+    nx_rt = get_runtime([1], use_nx=True)
+    assert nx_rt.get_stats_preds(b1.matches.keys(), [1]) == {1: None}
+
+def test_indexed_attribution():
+    b = CountBucket()
+    counts = []
+    b.register_callback(counts.append)
+    b.start_update()
+    for p in range(100):
+        b.add_match({'switch': 1, 'port': 1}, p, 3)
+    b.add_match({'switch': 2, 'port': 1}, 5, 3)
+    ''' Counters of rules on switches before the bucket was created are
+    discounted. '''
+    b.add_match({'switch': 1, 'port': 2}, 200, 2, existing_rule=True)
+    b.packet_count_persistent = 10
+    b.byte_count_persistent = 1000
+    b.finish_update()
+    b.increment_max_num_callbacks()
+    b.add_outstanding_switch_query(1)
+    reply = [flow_stat(p, 3, 1) for p in range(100)]
+    reply += [flow_stat(200, 2, 4), flow_stat(100, 3, 50),
+              flow_stat(5, 4, 50)]
+    b.handle_flow_stats_reply(1, reply)
+    assert counts == [[106, 10600]]
+    assert [c[1:] for c in b.series.samples()] == [(106, 10600)]
+    assert not b.matches[b.rule_index[(1, 200, 2)]].existing_rule
+
+def test_counter_series():
+    cs = CounterSeries(size=4, alpha=0.5)
+    assert cs.rate() == (0.0, 0.0)
+    crossings = []
+    cs.subscribe(15, lambda r, above: crossings.append((r, above)))
+    slow = cs.subscribe(5, lambda r, above: crossings.append(('slow', above)),
+                        window=3)
+    for (t, p) in [(0, 0), (1, 10), (2, 30), (3, 60), (4, 70)]:
+        cs.append(t, p, 100 * p)
+    ''' Only the last `size` samples are kept. '''
+    assert len(cs) == 4
+    assert cs.samples() == [(1, 10, 1000), (2, 30, 3000), (3, 60, 6000),
+                            (4, 70, 7000)]
+    assert cs.rate() == (10.0, 1000.0)
+    assert cs.rate(window=2) == (20.0, 2000.0)
+    assert cs.rate(window=10) == (20.0, 2000.0)
+    assert cs.window_sum(1) == (10.0, 1000.0)
+    assert cs.ewma() == (16.25, 1625.0)
+    assert crossings == [('slow', True), (20.0, True), (10.0, False)]
+    ''' A sample at the same time replaces the latest one. '''
+    cs.unsubscribe(slow)
+    cs.append(4, 80, 8000)
+    assert len(cs) == 4 and cs.rate() == (20.0, 2000.0)
+    assert crossings[-1] == (20.0, True)
+    ''' Counters going down have no rate. '''
+    cs.append(5, 0, 0)
+    assert cs.rate() == (0.0, 0.0)
+
+def test_adaptive_poll_interval():
+    cs = CounterSeries()
+    ap = AdaptivePollInterval(4, min_interval=1, max_interval=16)
+    assert ap.next(cs) == 4
+    ''' Quiet buckets back off. '''
+    for t in range(4):
+        cs.append(t, 0, 0)
+    assert [ap.next(cs) for i in range(3)] == [8, 16, 16]
+    ''' Changing rates speed polling up. '''
+    cs.append(4, 100, 100)
+    assert ap.next(cs) == 8
+    cs.append(5, 300, 300)
+    assert ap.next(cs) == 4
+    ''' Steady rates keep the interval, unless near a threshold. '''
+    cs.append(6, 500, 500)
+    assert ap.next(cs) == 4
+    cs.subscribe(180, lambda r, above: None)
+    assert ap.next(cs) == 2
+    assert ap.next(cs) == 1
+    assert ap.next(cs) == 1
+
+class fake_timer(object):
+    """ Records the requests deferred by a stats_poller, to be fired by the
+    test. """
+    def __init__(self, timers, delay, function, args):
+        self.delay = delay
+        self.function = function
+        self.args = args
+        self.daemon = False
+        self.started = False
+        timers.append(self)
+
+    def start(self):
+        self.started = True
+
+    def fire(self):
+        self.function(*self.args)
+
+def test_stats_request_budget():
+    rt = get_runtime([1])
+    now = [100.0]
+    timers = []
+    rt.stats_poller = stats_poller(
+        rt, interval=0, budget=2, clock=lambda: now[0],
+        timer=lambda *args: fake_timer(timers, *args))
+    poller = rt.stats_poller
+    c = rt.get_cookie(1, 0)
+    scope = [STATS_ALL_TABLES, c, COOKIE_TABLE_MASK | COOKIE_VERSION_MASK,
+             {'port': 1}]
+    b = CountBucket()
+    counts = []
+    b.register_callback(counts.append)
+    add_rule(rt, b, 1, 10, c)
+    for i in range(2):
+        b.pull_stats()
+        rt.handle_flow_stats_reply(1, [flow_stat(10, c, i)], scope)
+    assert len(rt.backend.requests) == 2 and timers == []
+    ''' Over the budget, the request waits for it. '''
+    b.pull_stats()
+    assert len(rt.backend.requests) == 2
+    assert len(timers) == 1
+    assert timers[0].delay == 0.5
+    assert timers[0].started and timers[0].daemon
+    now[0] += 0.5
+    timers[0].fire()
+    assert len(rt.backend.requests) == 3
+    rt.handle_flow_stats_reply(1, [flow_stat(10, c, 5)], scope)
+    assert counts == [[0, 0], [1, 100], [5, 500]]
+    metrics = poller.get_metrics()
+    assert metrics['requests'] == {1: 3}
+    assert metrics['request_rate'] == {1: 6.0}
+    assert metrics['deferred'] == 1
+    assert metrics['delivered'] == 3
+    assert metrics['max_latency'] == 0.5
+    assert metrics['max_staleness'] == 0
+
+class pending_bucket(object):
+    """ A bucket whose pulled stats are reported by the test. """
+    def pull_stats(self):
+        pass
+
+def test_counts_partial_pulls():
+    q = counts(None, ['switch'])
+    reports = []
+    q.register_callback(lambda c: reports.append(dict(c)))
+    (p1, p2) = (match(switch=1), match(switch=2))
+    q.bucket_dict = {p1: pending_bucket(), p2: pending_bucket()}
+    ''' Pulling some groupings keeps waiting for the others pulled. '''
+    q.pull_stats([p1])
+    q.pull_stats([p2])
+    q.collect_pred(p1)([1, 100])
+    assert reports == []
+    q.collect_pred(p2)([2, 200])
+    assert reports == [{p1.map: [1, 100], p2.map: [2, 200]}]
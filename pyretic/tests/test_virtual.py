@@ -177,6 +177,33 @@ def test_multi_stage_3():
     assert m2['vlan_nbits'] == 3
     success()
 
+def test_generations():
+    from pyretic.core.packet import Packet
+    start_new_test()
+    virtual_field("field1", ['a', 'b', 'c'], type="string")
+    gen = virtual_field.generation
+    assert virtual_field.compress({'field1': 'b'})[0] == 1
+    assert virtual_field.expand({'vlan_id': 1, 'vlan_pcp': 0}) == {'field1': 'b'}
+    pkt = Packet({'vlan_id': 2, 'vlan_pcp': 0, 'raw': ''})
+    m = match(field1='c')
+    assert m.eval(pkt) == {pkt}
+    # declaring fields again invalidates the encodings, including those of
+    # existing policies
+    virtual_field.remove('field1')
+    virtual_field("field1", ['c', 'a', 'b'], type="string")
+    assert virtual_field.generation > gen
+    assert virtual_field.compress({'field1': 'b'})[0] == 2
+    assert virtual_field.expand({'vlan_id': 1, 'vlan_pcp': 0}) == {'field1': 'a'}
+    assert m.eval(pkt) == set()
+    assert m.eval(pkt.modify(vlan_id=0)) == {pkt.modify(vlan_id=0)}
+    # unhashable values are encoded too
+    virtual_field("field2", [[1], [2]], type="list", stage=1)
+    m = vdict(field2=[2])
+    assert m['vlan_id'] == 1 << 2 and m['vlan_offset'] == 2
+    assert virtual_field.expand({'vlan_id': 1 << 2, 'vlan_pcp': 0}) == {
+        'field1': 'c', 'field2': [2]}
+    success()
+
 if __name__ == "__main__":
     test_single_field_1()
     test_single_field_2()
@@ -187,3 +214,4 @@ if __name__ == "__main__":
     test_multi_stage_2()
     test_decode()
     test_multi_stage_3()
+    test_generations()